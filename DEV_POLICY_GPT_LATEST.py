@@ -1,21 +1,88 @@
 import streamlit as st # Import python packages
-from snowflake.snowpark.context import get_active_session
-from snowflake.cortex import Complete
-from snowflake.core import Root
 import pandas as pd
 import json
-from datetime import datetime
+import re
+import os
+import math
+import hashlib
+import threading
+import time
+import queue
+import uuid
+import atexit
+import logging
+import tempfile
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from policy_app_common import (
+    STAGE_TIMINGS_COLUMN, CHAT_HISTORY_MIGRATED_COLUMNS, get_backend, migrate_chat_history_schema
+)
+from policy_chunk_store import ChunkStore, open_or_build
+from policy_local_index import LocalHybridIndex
 
 pd.set_option("max_colwidth",None)
 
+logger = logging.getLogger("policy_gpt")
+
 ### Default Values
-NUM_CHUNKS = 3 # Num-chunks provided as context
+NUM_CHUNKS = 3 # Num-chunks provided as context when the search service returns no relevance scores
+RETRIEVAL_FETCH_CHUNKS = 10 # Chunks fetched per search, before neighbours are merged into passages
+MAX_CONTEXT_PASSAGES = 6 # Upper bound on passages when relevance scores are available
+RELEVANCE_DROPOFF_RATIO = 0.6 # Stop adding passages once a score falls below this share of the best one
+CHUNK_OVERLAP_CHARS = 256 # Overlap used by SPLIT_TEXT_RECURSIVE_CHARACTER in cortex_search_starter.sql
+RERANK_MODEL = None # Optional model (e.g. 'llama3.1-8b') that rescores the merged passages before selection
+RERANK_CANDIDATES = 8 # Passages sent to the reranker; any beyond this keep their search order after them
+RERANK_PASSAGE_CHARS = 600 # Each candidate is cut to this length in the rerank prompt
+RERANK_TIMEOUT_SECONDS = 2.0 # Keep the search order if the reranker hasn't answered within this budget
+RERANK_MAX_IN_FLIGHT = 2 # Rerank calls allowed to run at once (timed-out calls still count until they finish)
 slide_window = 7 # Number of last conversations to remember
-
-# service parameters
-CORTEX_SEARCH_DATABASE = "POC_POLICY"
-CORTEX_SEARCH_SCHEMA = "PROCUREMENT_POLICY"
-CORTEX_SEARCH_SERVICE = "POLICY_SEARCH_SERVICE"
+CORPUS_CACHE_TTL_SECONDS = 600 # How long stage/category lookups are reused before re-checking
+PRESIGNED_URL_EXPIRY_SECONDS = 360 # Lifetime requested for stage download links
+PRESIGNED_URL_REFRESH_MARGIN_SECONDS = 30 # Evict cached links this long before they expire
+HISTORY_WRITE_BATCH_SIZE = 20 # Flush queued chat history rows once this many are waiting
+HISTORY_WRITE_INTERVAL_SECONDS = 2.0 # ...or once the oldest queued row has waited this long
+HISTORY_WRITE_MAX_ATTEMPTS = 3 # Insert attempts per batch before the rows are dropped and logged
+ANSWER_CACHE_MAX_ENTRIES = 500 # Answers kept in the process-wide answer cache (LRU)
+ANSWER_CACHE_TTL_SECONDS = 3600 # How long a cached answer may be served
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95 # Cosine similarity for near-duplicate questions (None = exact matches only)
+EMBEDDING_MODEL = 'snowflake-arctic-embed-m-v1.5' # Used to embed questions for near-duplicate lookups
+RETRIEVAL_CACHE_MAX_ENTRIES = 256 # Parsed search results kept per process (LRU)
+SEARCH_SERVICE_VERSION_TTL_SECONDS = 300 # How often to re-check whether the search index was refreshed
+LOCAL_INDEX_MODE = "off" # "off": Cortex Search only; "fallback": in-process index when the service fails or is slow; "primary": in-process index first
+LOCAL_INDEX_EMBEDDINGS = False # Embed every chunk (EMBED_TEXT_768 over the whole corpus, once per chunks version) so the in-process index is hybrid BM25 + vector
+LOCAL_INDEX_RETRY_SECONDS = 60 # Wait after a failed index load before retrying; doubles with each consecutive failure
+LOCAL_INDEX_MAX_RETRY_SECONDS = 1800 # Upper bound on that wait
+LOCAL_INDEX_STORE_DIR = os.path.join(tempfile.gettempdir(), "policy_gpt_chunk_store") # Memory-mapped chunk store shared by app processes on the host (None = in memory per process)
+SEARCH_TIMEOUT_SECONDS = 3.0 # With an in-process index loaded, stop waiting for Cortex Search after this long
+QUERY_REWRITE_MODE = "parallel" # "sequential": rewrite then search; "parallel": search the raw question while rewriting
+SKIP_REWRITE_FOR_STANDALONE = True # Skip the history rewrite for questions that don't refer back to the chat
+REWRITE_GATE_MODEL = None # Optional small model (e.g. 'llama3.1-8b') asked whether an ambiguous follow-up needs rewriting
+BACKGROUND_WORKERS = 8 # Threads shared by parallel retrieval and other background LLM/SQL work
+STREAM_RESPONSES = True # Render answer tokens as they arrive instead of waiting for the full response
+STREAM_RENDER_INTERVAL_SECONDS = 0.05 # Minimum gap between placeholder redraws while streaming
+STAGE_TIMING_WINDOW = 500 # Recent samples per stage kept for the latency breakdown in the sidebar
+AUTO_MODEL = "auto" # Model choice that routes each question to ROUTER_SMALL_MODEL or ROUTER_LARGE_MODEL
+ROUTER_SMALL_MODEL = 'llama3.1-8b' # Answers simple questions; also does the rewrite and summary in auto mode
+ROUTER_LARGE_MODEL = 'llama3.1-70b' # Answers questions whose complexity reaches the routing threshold
+ROUTER_COMPLEXITY_THRESHOLD = 0.5 # Starting threshold (0-1) before latency/feedback adjustments
+ROUTER_THRESHOLD_STEP = 0.15 # How far recent latency/feedback stats move the threshold
+ROUTER_MIN_RATED = 20 # Rated answers per model needed before feedback moves the threshold
+ROUTER_MAX_QUALITY_GAP = 0.05 # Small model may be rated thumbs-down this much more often than the large one
+ROUTER_LARGE_P95_BUDGET_MS = 15000 # Above this p95 the large model is kept for harder questions only
+ROUTER_STATS_LOOKBACK_DAYS = 7 # CHAT_HISTORY window the routing stats are computed over
+ROUTER_STATS_TTL_SECONDS = 600 # How often routing stats are re-read
+PROMPT_TOKEN_BUDGETS = { # Prompt tokens (instructions + history + context + question) per answer model
+    'llama3.1-70b': 6000,
+    'llama3.1-8b': 4000,
+    'snowflake-arctic': 3000,
+    'mistral-large2': 6000
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = 3000 # For models not listed above
+CHARS_PER_TOKEN = 4 # Rough English estimate used to size prompts without a tokenizer
+HISTORY_TOKEN_SHARE = 0.2 # At most this share of the budget goes to chat history
+HISTORY_OLDER_MESSAGE_CHARS = 300 # Messages before the latest exchange are cut to this length
+MIN_PARTIAL_CHUNK_TOKENS = 80 # Don't bother adding a truncated chunk smaller than this
 
 # columns to query in the service
 COLUMNS = [
@@ -25,97 +92,896 @@ COLUMNS = [
     "category"
 ]
 
-session = get_active_session()
-root = Root(session)                         
-svc = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE]
+### Corpus Lookup Cache
 
-### Chat History Storage Functions
+@st.cache_data(ttl=CORPUS_CACHE_TTL_SECONDS, show_spinner=False)
+def get_stage_documents():
+    """List documents on the policy stage, shared across reruns and sessions"""
+    return get_backend().list_stage_documents()
 
-def initialize_chat_history_table():
-    """Create or alter chat history table to include user column, feedback column, hallucination flag, and review column"""
+def get_corpus_version():
+    """Fingerprint of the stage contents, used to key anything derived from the corpus"""
+    fingerprint = hashlib.md5()
+    for doc in sorted(get_stage_documents(), key=lambda d: d["name"]):
+        fingerprint.update(f"{doc['name']}|{doc['md5']}|{doc['last_modified']}\n".encode("utf-8"))
+    return fingerprint.hexdigest()
+
+@st.cache_data(ttl=CORPUS_CACHE_TTL_SECONDS, show_spinner=False)
+def get_document_categories(corpus_version):
+    """Distinct chunk categories for a given corpus version"""
+    return get_backend().list_categories()
+
+def invalidate_corpus_cache():
+    """Drop cached stage/category lookups so the next rerun re-reads the stage"""
+    get_stage_documents.clear()
+    get_document_categories.clear()
+    get_chunks_version.clear()
+
+### Document Link Cache
+
+class PresignedUrlCache:
+    """Process-wide cache of presigned stage URLs keyed by relative path"""
+
+    def __init__(self, expiry_seconds, refresh_margin_seconds):
+        self.ttl_seconds = max(expiry_seconds - refresh_margin_seconds, 0)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _evict_expired(self, now):
+        expired = [path for path, (_, expires_at) in self._entries.items() if expires_at <= now]
+        for path in expired:
+            del self._entries[path]
+
+    def get_many(self, paths, loader):
+        """Return {path: url}, resolving every miss with a single loader call"""
+        urls = {}
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            for path in paths:
+                if path in self._entries:
+                    urls[path] = self._entries[path][0]
+
+        missing = [path for path in paths if path not in urls]
+        if missing:
+            fetched_at = time.monotonic()
+            fetched = loader(missing)
+            with self._lock:
+                for path, url in fetched.items():
+                    self._entries[path] = (url, fetched_at + self.ttl_seconds)
+            urls.update(fetched)
+        return urls
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+@st.cache_resource
+def get_presigned_url_cache():
+    return PresignedUrlCache(PRESIGNED_URL_EXPIRY_SECONDS, PRESIGNED_URL_REFRESH_MARGIN_SECONDS)
+
+def fetch_presigned_urls(paths):
+    """Resolve presigned URLs for several stage paths in one query"""
+    return get_backend().get_presigned_urls(paths, PRESIGNED_URL_EXPIRY_SECONDS)
+
+def get_presigned_urls(paths):
+    """Get presigned URLs for stage paths, only querying for paths not already cached"""
+    paths = list(dict.fromkeys(paths))
+    if not paths:
+        return {}
+    return get_presigned_url_cache().get_many(paths, fetch_presigned_urls)
+
+### Answer Cache
+
+def normalize_question(question):
+    """Lower-case, strip punctuation and collapse whitespace so trivial rewordings share a key"""
+    question = re.sub(r"[^\w\s]", " ", question.lower())
+    return " ".join(question.split())
+
+def embed_text(text):
+    """Embed text with Cortex; returns a unit-length list of floats"""
+    embedding = get_backend().embed_text(EMBEDDING_MODEL, text)
+    norm = math.sqrt(sum(value * value for value in embedding)) or 1.0
+    return [value / norm for value in embedding]
+
+class AnswerCache:
+    """Process-wide LRU/TTL cache of answers with exact and near-duplicate question lookup.
+
+    Entries are scoped by (model, category, corpus version) so a different model, filter
+    or document set never reuses an answer.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, similarity_threshold):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict_expired(self, now):
+        expired = [key for key, entry in self._entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, question, scope):
+        """Exact lookup on the normalized question"""
+        key = (normalize_question(question),) + tuple(scope)
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["answer"]
+
+    def get_similar(self, embedding, scope):
+        """Best near-duplicate in the same scope above the similarity threshold"""
+        if self.similarity_threshold is None or embedding is None:
+            return None
+        scope = tuple(scope)
+        with self._lock:
+            best_key, best_score = None, self.similarity_threshold
+            for key, entry in self._entries.items():
+                if key[1:] != scope or entry["embedding"] is None:
+                    continue
+                score = sum(a * b for a, b in zip(embedding, entry["embedding"]))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            self.near_hits += 1
+            return self._entries[best_key]["answer"]
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def put(self, question, scope, answer, embedding=None):
+        key = (normalize_question(question),) + tuple(scope)
+        with self._lock:
+            self._entries[key] = {
+                "answer": answer,
+                "embedding": embedding,
+                "expires_at": time.monotonic() + self.ttl_seconds
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "near_hits": self.near_hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SIMILARITY_THRESHOLD)
+
+def answer_cache_applies(settings):
+    """Follow-up questions depend on the conversation, so only standalone questions are cached"""
+    return not (settings["use_chat_history"] and settings["chat_history"])
+
+def lookup_cached_answer(question, scope):
+    """Return (answer or None, question embedding or None) from the answer cache"""
+    cache = get_answer_cache()
+    answer = cache.get(question, scope)
+    if answer is not None:
+        return answer, None
+    
+    embedding = None
+    if cache.similarity_threshold is not None:
+        try:
+            embedding = embed_text(question)
+        except Exception as e:
+            logger.warning("Question embedding failed, using exact answer cache only: %s", e)
+        answer = cache.get_similar(embedding, scope)
+        if answer is not None:
+            return answer, embedding
+    
+    cache.record_miss()
+    return None, embedding
+
+### Background Work
+
+@st.cache_resource
+def get_background_executor():
+    return ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="policy-gpt")
+
+### Local Retrieval Index
+
+@st.cache_resource
+def get_search_executor():
+    # Separate from the background pool: searches are submitted from background tasks too
+    return ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="policy-gpt-search")
+
+def build_local_index(chunks_version):
+    embedding_model = EMBEDDING_MODEL if LOCAL_INDEX_EMBEDDINGS else None
+    load_chunks = lambda: get_backend().load_chunks(embedding_model)
+    if LOCAL_INDEX_STORE_DIR is None:
+        return LocalHybridIndex(ChunkStore.from_chunks(load_chunks(), embedding_model))
+    # Only the first process to see a chunks version reads and embeds the chunks; the rest map its files
+    return LocalHybridIndex(open_or_build(LOCAL_INDEX_STORE_DIR, chunks_version, embedding_model, load_chunks))
+
+class LocalIndexLoader:
+    """Loads the in-process index on a worker thread; failed loads are retried with exponential backoff"""
+
+    def __init__(self, chunks_version):
+        self.chunks_version = chunks_version
+        self.future = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """The index if it has finished loading, else None (starts a load unless backing off)"""
+        with self._lock:
+            if self.future is None:
+                if time.monotonic() < self.retry_at:
+                    return None
+                self.future = get_background_executor().submit(build_local_index, self.chunks_version)
+            future = self.future
+        if not future.done():
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            with self._lock:
+                if self.future is future:
+                    self.failures += 1
+                    delay = min(LOCAL_INDEX_RETRY_SECONDS * 2 ** (self.failures - 1), LOCAL_INDEX_MAX_RETRY_SECONDS)
+                    self.retry_at = time.monotonic() + delay
+                    self.future = None
+                    logger.warning("Local retrieval index failed to load, retrying in %.0fs: %s", delay, e)
+            return None
+
+@st.cache_data(ttl=CORPUS_CACHE_TTL_SECONDS, show_spinner=False)
+def get_chunks_version(corpus_version):
+    """Fingerprint of POLICY_DOCS_CHUNKS; the stage can change before policy_ingest has re-chunked it"""
+    return get_backend().chunks_version()
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def get_local_index_loader(chunks_version):
+    """Background loader of the in-process index for one version of the chunks table"""
+    return LocalIndexLoader(chunks_version)
+
+def get_local_index():
+    """The in-process index if it has finished loading, else None (the first call starts the load)"""
+    if LOCAL_INDEX_MODE == "off":
+        return None
     try:
-        # Create table if it doesn't exist
-        create_table_sql = """
-        CREATE TABLE IF NOT EXISTS POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY (
-            INTERACTION_ID STRING DEFAULT UUID_STRING(),
-            TIMESTAMP TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
-            USER_QUESTION STRING,
-            AI_RESPONSE STRING,
-            MODEL_USED STRING,
-            CATEGORY_FILTER STRING,
-            SOURCE_DOCUMENTS STRING,
-            RESPONSE_TIME_MS INTEGER,
-            USER_NAME STRING,
-            RESPONSE_QUALITY STRING,
-            IS_HALLUCINATION STRING,
-            REVIEW_FEEDBACK STRING
+        chunks_version = get_chunks_version(get_corpus_version())
+    except Exception as e:
+        logger.warning("Could not read the chunks table version, local index unavailable: %s", e)
+        return None
+    return get_local_index_loader(chunks_version).get()
+
+def search_local_index(local_index, query, filter_obj):
+    query_embedding = None
+    if local_index.has_embeddings:
+        try:
+            query_embedding = embed_text(query)
+        except Exception as e:
+            logger.warning("Query embedding failed, using BM25 only: %s", e)
+    return local_index.search(query, COLUMNS, filter=filter_obj, limit=RETRIEVAL_FETCH_CHUNKS,
+                              query_embedding=query_embedding)
+
+### Retrieval Cache
+
+@st.cache_data(ttl=SEARCH_SERVICE_VERSION_TTL_SECONDS, show_spinner=False)
+def get_search_service_version():
+    """Data timestamp of the index POLICY_SEARCH_SERVICE is serving; changes on every refresh"""
+    try:
+        return get_backend().search_service_version()
+    except Exception as e:
+        logger.warning("Could not read search service version, retrieval cache bypassed: %s", e)
+        return None
+
+class RetrievalCache:
+    """Process-wide LRU of parsed search results keyed by (query, category, limit, index version)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query, category, limit, version):
+        key = (query, category, limit, version)
+        with self._lock:
+            results = self._entries.get(key)
+            if results is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return results
+
+    def put(self, query, category, limit, version, results):
+        with self._lock:
+            # A new index version makes every older entry unreachable, so drop them now
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            key = (query, category, limit, version)
+            self._entries[key] = results
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+@st.cache_resource
+def get_retrieval_cache():
+    return RetrievalCache(RETRIEVAL_CACHE_MAX_ENTRIES)
+
+### Stage Timing
+
+class StageTimer:
+    """Per-stage durations (ms) for one interaction, measured with a monotonic clock"""
+
+    def __init__(self):
+        self.durations_ms = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, (time.perf_counter() - start) * 1000)
+
+    def add(self, stage, elapsed_ms):
+        # Stages that run more than once (e.g. two searches) are summed
+        with self._lock:
+            self.durations_ms[stage] = self.durations_ms.get(stage, 0.0) + elapsed_ms
+
+    def as_dict(self):
+        with self._lock:
+            return {stage: round(elapsed_ms, 1) for stage, elapsed_ms in self.durations_ms.items()}
+
+class StageLatencyStats:
+    """Rolling per-stage latency samples for this app process"""
+
+    def __init__(self, window):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, durations_ms):
+        with self._lock:
+            for stage, elapsed_ms in durations_ms.items():
+                self._samples.setdefault(stage, deque(maxlen=self.window)).append(elapsed_ms)
+
+    def summary(self):
+        """One row per stage: sample count, p50, p95 and max in ms"""
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+        return [
+            {
+                "Stage": stage,
+                "Samples": len(values),
+                "p50 ms": values[(len(values) - 1) // 2],
+                "p95 ms": values[min(int(len(values) * 0.95), len(values) - 1)],
+                "Max ms": values[-1]
+            }
+            for stage, values in sorted(samples.items())
+        ]
+
+@st.cache_resource
+def get_stage_latency_stats():
+    return StageLatencyStats(STAGE_TIMING_WINDOW)
+
+### Model Routing
+
+COMPLEX_QUESTION_PATTERN = re.compile(
+    r"\b(compare|comparison|differ(ence|ences|ent)?|versus|vs|why|explain|steps|process|exceptions?|"
+    r"unless|otherwise|conditions?|requirements?|summari[sz]e|each|every|both|scenario)\b",
+    re.IGNORECASE
+)
+
+def question_complexity(question, chunks):
+    """0-1 score from the question's length and wording and how spread out the retrieved context is"""
+    score = min(len(question.split()) / 40, 1.0) * 0.35
+    score += min(len(COMPLEX_QUESTION_PATTERN.findall(question)) / 2, 1.0) * 0.3
+    if question.count("?") > 1:
+        score += 0.1
+    # Spread: share of the retrieved passages that come from distinct documents
+    documents = len({chunk['relative_path'] for chunk in chunks})
+    score += max(documents - 1, 0) / max(len(chunks) - 1, 1) * 0.15
+    score += min(sum(len(chunk['chunk']) for chunk in chunks) / 6000, 1.0) * 0.1
+    return min(score, 1.0)
+
+@st.cache_data(ttl=ROUTER_STATS_TTL_SECONDS, show_spinner=False)
+def get_model_routing_stats():
+    """Recent latency and thumbs-down rate per model from CHAT_HISTORY; {} if unavailable"""
+    try:
+        return get_backend().model_feedback_stats(ROUTER_STATS_LOOKBACK_DAYS)
+    except Exception as e:
+        logger.warning("Model routing stats unavailable, using the default threshold: %s", e)
+        return {}
+
+def routing_threshold(stats):
+    """Complexity at which the large model answers, nudged by recent feedback and latency"""
+    threshold = ROUTER_COMPLEXITY_THRESHOLD
+    small = stats.get(ROUTER_SMALL_MODEL) or {}
+    large = stats.get(ROUTER_LARGE_MODEL) or {}
+    
+    if (small.get("rated") or 0) >= ROUTER_MIN_RATED and (large.get("rated") or 0) >= ROUTER_MIN_RATED:
+        quality_gap = (small.get("thumbs_down_rate") or 0) - (large.get("thumbs_down_rate") or 0)
+        if quality_gap > ROUTER_MAX_QUALITY_GAP:
+            # Quality comes first: the small model is rated worse, so send it less
+            return max(threshold - ROUTER_THRESHOLD_STEP, 0.0)
+        if quality_gap <= 0:
+            threshold += ROUTER_THRESHOLD_STEP
+    
+    if (large.get("p95_ms") or 0) > ROUTER_LARGE_P95_BUDGET_MS:
+        threshold += ROUTER_THRESHOLD_STEP
+    return min(threshold, 1.0)
+
+def choose_answer_model(model_name, question, chunks):
+    """Model that writes the answer; in auto mode picked from the question and retrieved context"""
+    if model_name != AUTO_MODEL:
+        return model_name
+    if question_complexity(question, chunks) >= routing_threshold(get_model_routing_stats()):
+        return ROUTER_LARGE_MODEL
+    return ROUTER_SMALL_MODEL
+
+def auxiliary_model(model_name):
+    """Model for the history rewrite and chat summary; auto mode always uses the small one"""
+    return ROUTER_SMALL_MODEL if model_name == AUTO_MODEL else model_name
+
+### Reranking
+
+RERANK_PROMPT = """Rate how well each passage answers the question, from 0 (irrelevant) to 10 (answers it directly).
+Reply with only a JSON array of {count} integers, one per passage, in passage order.
+
+<question>
+{question}
+</question>
+
+{passages}"""
+
+class RerankStats:
+    """How often reranking ran, fell back to the search order, and changed the top passages"""
+
+    def __init__(self):
+        self.reranked = 0
+        self.changed = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def record(self, outcome, changed=False):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if changed:
+                self.changed += 1
+
+    def stats(self):
+        with self._lock:
+            return {"reranked": self.reranked, "changed": self.changed,
+                    "timeouts": self.timeouts, "failures": self.failures, "skipped": self.skipped}
+
+@st.cache_resource
+def get_rerank_stats():
+    return RerankStats()
+
+@st.cache_resource
+def get_rerank_slots():
+    # A timed-out rerank can't be cancelled once running; it keeps its slot until it returns
+    return threading.BoundedSemaphore(RERANK_MAX_IN_FLIGHT)
+
+def parse_rerank_scores(response, count):
+    """The first JSON array of count numbers in the reranker's reply"""
+    match = re.search(r"\[[\d\s,.]*\]", response)
+    if match is None:
+        raise ValueError("no score array in rerank response")
+    scores = [float(score) for score in json.loads(match.group(0))]
+    if len(scores) != count:
+        raise ValueError(f"expected {count} rerank scores, got {len(scores)}")
+    return scores
+
+def score_passages(question, passages, model_name):
+    """Relevance of each passage to the question, as judged by model_name; runs on a worker thread"""
+    prompt = RERANK_PROMPT.format(
+        count=len(passages),
+        question=question,
+        passages="\n\n".join(
+            f"<passage {number}>\n{passage['chunk'][:RERANK_PASSAGE_CHARS]}\n</passage {number}>"
+            for number, passage in enumerate(passages, start=1)
         )
-        """
-        session.sql(create_table_sql).collect()
-        
-        # Check if required columns exist, if not add them
-        columns_to_check = ['USER_NAME', 'RESPONSE_QUALITY', 'IS_HALLUCINATION', 'REVIEW_FEEDBACK']
-        
-        for column_name in columns_to_check:
+    )
+    return parse_rerank_scores(get_backend().complete(model_name, prompt), len(passages))
+
+def rerank_passages(question, passages):
+    """Reorder the top passages by reranker score within RERANK_TIMEOUT_SECONDS; search order otherwise"""
+    candidates = passages[:RERANK_CANDIDATES]
+    if RERANK_MODEL is None or len(candidates) < 2:
+        return passages
+    
+    stats = get_rerank_stats()
+    slots = get_rerank_slots()
+    if not slots.acquire(blocking=False):
+        # Earlier reranks (possibly abandoned after a timeout) are still running: don't pile more on
+        stats.record("skipped")
+        return passages
+    try:
+        future = get_background_executor().submit(score_passages, question, candidates, RERANK_MODEL)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        scores = future.result(timeout=RERANK_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        stats.record("timeouts")
+        logger.warning("Reranker exceeded %.1fs; keeping the search order", RERANK_TIMEOUT_SECONDS)
+        return passages
+    except Exception as e:
+        stats.record("failures")
+        logger.warning("Reranking failed, keeping the search order: %s", e)
+        return passages
+    
+    # Stable sort: equal scores keep their search order
+    order = sorted(range(len(candidates)), key=lambda i: -scores[i])
+    reranked = [
+        dict(candidates[i], **{'@scores': dict(candidates[i].get('@scores') or {}, rerank_score=scores[i])})
+        for i in order
+    ]
+    top_k = min(NUM_CHUNKS, len(candidates))
+    stats.record("reranked", changed=set(order[:top_k]) != set(range(top_k)))
+    return reranked + passages[RERANK_CANDIDATES:]
+
+### Prompt Packing
+
+PROMPT_INSTRUCTIONS = """You are an expert chat assistant that extracts information from the CONTEXT provided between <context> and </context> tags.
+You offer a chat experience considering the information included in the CHAT HISTORY provided between <chat_history> and </chat_history> tags.
+When answering the question contained between <question> and </question> tags be detailed, covering all the relevant information but do not hallucinate.
+If you don't have the information just say so.
+Do not answer any general questions apart from those that might be based on the CONTEXT documents.
+Do not mention the CONTEXT used in your answer.
+Do not mention the CHAT HISTORY used in your answer.
+Only answer the question if you can extract it from the CONTEXT provided."""
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to roughly max_tokens, at a word boundary"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + " ..."
+
+def prompt_token_budget(model_name):
+    return PROMPT_TOKEN_BUDGETS.get(model_name, DEFAULT_PROMPT_TOKEN_BUDGET)
+
+def format_chat_history(chat_history, max_tokens):
+    """Chat history as compact "User:/Assistant:" lines, newest kept first, within max_tokens"""
+    lines = []
+    used = 0
+    for age, message in enumerate(reversed(chat_history)):
+        content = " ".join(message["content"].split())
+        if age >= 2:
+            # Only the latest exchange is kept in full; older turns just give the thread
+            content = content[:HISTORY_OLDER_MESSAGE_CHARS]
+        line = f"{'User' if message['role'] == 'user' else 'Assistant'}: {content}"
+        line_tokens = estimate_tokens(line)
+        if used + line_tokens > max_tokens:
+            if not lines:
+                lines.append(truncate_to_tokens(line, max_tokens))
+            break
+        lines.append(line)
+        used += line_tokens
+    return "\n".join(reversed(lines))
+
+def pack_context(search_results, max_tokens):
+    """Chunk text with a compact source tag, in rank order, until the token budget is spent.
+
+    Returns (context text, results actually included).
+    """
+    blocks = []
+    included = []
+    remaining = max_tokens
+    for item in search_results:
+        tag = f"[{len(blocks) + 1}] {item['relative_path'].split('/')[-1]}"
+        text = " ".join(item['chunk'].split())
+        block_tokens = estimate_tokens(tag) + estimate_tokens(text) + 1
+        if block_tokens > remaining:
+            # The top chunk always goes in, cut down if it has to be
+            if not blocks or remaining - estimate_tokens(tag) >= MIN_PARTIAL_CHUNK_TOKENS:
+                blocks.append(f"{tag}\n{truncate_to_tokens(text, max(remaining - estimate_tokens(tag) - 1, 0))}")
+                included.append(item)
+            break
+        blocks.append(f"{tag}\n{text}")
+        included.append(item)
+        remaining -= block_tokens
+    return "\n\n".join(blocks), included
+
+def build_prompt(question, search_results, chat_history, model_name):
+    """Fit instructions, history, context and question into the model's prompt token budget"""
+    budget = prompt_token_budget(model_name)
+    history_text = ""
+    if chat_history:
+        fixed_tokens = estimate_tokens(PROMPT_INSTRUCTIONS) + estimate_tokens(question) + 30
+        history_text = format_chat_history(chat_history, int(max(budget - fixed_tokens, 0) * HISTORY_TOKEN_SHARE))
+    
+    def assemble(context_text):
+        return f"""{PROMPT_INSTRUCTIONS}
+
+<chat_history>
+{history_text}
+</chat_history>
+<context>
+{context_text}
+</context>
+<question>
+{question}
+</question>
+Answer: """
+    
+    context_text, included = pack_context(search_results, budget - estimate_tokens(assemble("")))
+    prompt = assemble(context_text)
+    logger.debug("Prompt for %s: ~%d of %d tokens, %d of %d chunks", model_name,
+                 estimate_tokens(prompt), budget, len(included), len(search_results))
+    return prompt, included
+
+### Chat History Writer
+
+CHAT_HISTORY_INSERT_COLUMNS = [
+    "INTERACTION_ID",
+    "USER_QUESTION",
+    "AI_RESPONSE",
+    "MODEL_USED",
+    "CATEGORY_FILTER",
+    "SOURCE_DOCUMENTS",
+    "RESPONSE_TIME_MS",
+    "USER_NAME"
+]
+
+# Feedback columns written through submit_feedback()
+FEEDBACK_COLUMNS = [
+    "RESPONSE_QUALITY",
+    "IS_HALLUCINATION",
+    "REVIEW_FEEDBACK"
+]
+
+class FeedbackUpdate:
+    """Feedback values for one interaction; None means leave the column unchanged"""
+
+    def __init__(self, interaction_id, values):
+        self.interaction_id = interaction_id
+        self.values = values
+
+class ChatHistoryWriter:
+    """Queues chat interactions and feedback and writes them in batches on a background thread"""
+
+    _STOP = object()
+
+    def __init__(self, backend, schema, url_cache, latency_stats, batch_size, flush_interval_seconds, max_attempts):
+        self.backend = backend
+        # USER_NAME is a migrated column too; the rest were in the original table
+        self.insert_columns = [column for column in CHAT_HISTORY_INSERT_COLUMNS
+                               if column not in CHAT_HISTORY_MIGRATED_COLUMNS or schema.has(column)]
+        self.feedback_columns = [column for column in FEEDBACK_COLUMNS if schema.has(column)]
+        self.timing_columns = [STAGE_TIMINGS_COLUMN] if schema.has(STAGE_TIMINGS_COLUMN) else []
+        self.latency_stats = latency_stats
+        self.url_cache = url_cache
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_attempts = max_attempts
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, record):
+        """Queue one interaction record; returns immediately"""
+        record.setdefault("feedback", {})
+        record.setdefault("stage_timings", {})
+        record["queued_at"] = time.perf_counter()
+        if self._closed:
+            self._write_batch([record])
+            return
+        with self._pending_lock:
+            self._pending[record["interaction_id"]] = record
+        self._queue.put(record)
+
+    def submit_feedback(self, interaction_id, values):
+        """Queue feedback for an interaction; returns immediately"""
+        with self._pending_lock:
+            record = self._pending.get(interaction_id)
+            if record is not None:
+                # Row not inserted yet: the INSERT carries the feedback, no UPDATE needed
+                record["feedback"].update(values)
+                return
+        update = FeedbackUpdate(interaction_id, dict(values))
+        if self._closed:
+            self._write_batch([update])
+            return
+        self._queue.put(update)
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written"""
+        if self._closed:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        """Flush outstanding writes and stop the writer thread (also runs at interpreter exit)"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
             try:
-                check_column_sql = f"""
-                SELECT COLUMN_NAME 
-                FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_SCHEMA = 'PROCUREMENT_POLICY' 
-                AND TABLE_NAME = 'CHAT_HISTORY' 
-                AND COLUMN_NAME = '{column_name}'
-                """
-                result = session.sql(check_column_sql).collect()
-                
-                if len(result) == 0:
-                    # Add column if it doesn't exist
-                    alter_table_sql = f"""
-                    ALTER TABLE POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-                    ADD COLUMN {column_name} STRING
-                    """
-                    session.sql(alter_table_sql).collect()
-                    st.sidebar.success(f"Added {column_name} column to chat history table!")
-                    
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, (dict, FeedbackUpdate)):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval_seconds
+                if len(batch) < self.batch_size:
+                    continue
+
+            # Size trigger, time trigger, explicit flush or shutdown
+            if batch:
+                self._write_batch(batch)
+                batch = []
+            deadline = None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is self._STOP:
+                return
+
+    def _write_batch(self, batch):
+        records = [item for item in batch if isinstance(item, dict)]
+        updates = [item for item in batch if isinstance(item, FeedbackUpdate)]
+
+        # Claim the rows so feedback arriving from now on is queued as an update behind them
+        with self._pending_lock:
+            for record in records:
+                self._pending.pop(record["interaction_id"], None)
+
+        # Inserts go first so feedback for rows in the same batch finds them
+        if records:
+            self._with_retry(f"insert of {len(records)} chat history rows", self._insert_rows, records)
+        if updates:
+            self._with_retry(f"feedback update for {len(updates)} interactions", self._merge_feedback, updates)
+
+    def _with_retry(self, description, write, items):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                write(items)
+                return True
             except Exception as e:
-                st.sidebar.warning(f"Column check/add issue for {column_name}: {str(e)}")
-        
-        return True
-        
-    except Exception as e:
-        st.sidebar.error(f"Error with chat history table: {str(e)}")
+                if attempt == self.max_attempts:
+                    logger.error("Dropping %s after %d attempts: %s", description, attempt, e)
+                else:
+                    logger.warning("Chat history %s failed (attempt %d): %s", description, attempt, e)
+                    time.sleep(0.5 * attempt)
         return False
 
-def update_review_feedback(interaction_id, review_text):
-    """Update review feedback for a specific interaction"""
+    def _insert_rows(self, records):
+        batch_start = time.perf_counter()
+        # One presigned URL lookup covers every source document in the batch
+        all_paths = list(dict.fromkeys(path for record in records for path in record["source_docs"]))
+        try:
+            urls = self.url_cache.get_many(all_paths, fetch_presigned_urls) if all_paths else {}
+        except Exception as e:
+            logger.warning("Could not resolve source document links: %s", e)
+            urls = {}
+        link_lookup_ms = round((time.perf_counter() - batch_start) * 1000, 1)
+
+        # The lookup is shared by the batch, so every row carries the batch's lookup time
+        for record in records:
+            record["stage_timings"]["history_queue_wait"] = round((batch_start - record["queued_at"]) * 1000, 1)
+            record["stage_timings"]["link_lookup"] = link_lookup_ms
+
+        rows = []
+        for record in records:
+            source_links = format_source_document_links(record["source_docs"], urls)
+            values = {
+                "INTERACTION_ID": record["interaction_id"],
+                "USER_QUESTION": record["question"],
+                "AI_RESPONSE": record["response"],
+                "MODEL_USED": record["model_name"],
+                "CATEGORY_FILTER": record["category"],
+                "SOURCE_DOCUMENTS": source_links[:2000] if source_links else "",
+                "RESPONSE_TIME_MS": record["response_time_ms"],
+                "USER_NAME": record["user_name"]
+            }
+            rows.append([values[column] for column in self.insert_columns]
+                        + [record["feedback"].get(column) for column in self.feedback_columns]
+                        + [json.dumps(record["stage_timings"]) for column in self.timing_columns])
+
+        insert_start = time.perf_counter()
+        self.backend.insert_chat_history(self.insert_columns + self.feedback_columns + self.timing_columns, rows)
+        # The insert can't time itself into its own rows; it only feeds the process-wide stats
+        self.latency_stats.record({"history_insert": (time.perf_counter() - insert_start) * 1000})
+        for record in records:
+            self.latency_stats.record({
+                "history_queue_wait": record["stage_timings"]["history_queue_wait"],
+                "link_lookup": record["stage_timings"]["link_lookup"]
+            })
+
+    def _merge_feedback(self, updates):
+        # Collapse every click on the same interaction into one row of the MERGE source
+        merged = {}
+        for update in updates:
+            merged.setdefault(update.interaction_id, {}).update(update.values)
+
+        rows = [
+            (interaction_id, [values.get(column) for column in self.feedback_columns])
+            for interaction_id, values in merged.items()
+        ]
+        self.backend.merge_chat_feedback(self.feedback_columns, rows)
+
+@st.cache_resource
+def get_chat_history_writer():
+    return ChatHistoryWriter(
+        get_backend(),
+        migrate_chat_history_schema(),
+        get_presigned_url_cache(),
+        get_stage_latency_stats(),
+        HISTORY_WRITE_BATCH_SIZE,
+        HISTORY_WRITE_INTERVAL_SECONDS,
+        HISTORY_WRITE_MAX_ATTEMPTS
+    )
+
+def submit_feedback(interaction_id, response_quality=None, is_hallucination=None, review_feedback=None):
+    """Record rating, hallucination flag and/or review for an interaction without waiting on the warehouse"""
+    values = {
+        "RESPONSE_QUALITY": response_quality,
+        "IS_HALLUCINATION": is_hallucination,
+        "REVIEW_FEEDBACK": review_feedback
+    }
+    values = {column: value for column, value in values.items() if value is not None}
+    if values:
+        get_chat_history_writer().submit_feedback(interaction_id, values)
+
+### Chat History Storage Functions
+
+def initialize_chat_history_table():
+    """Run the schema migration (cached per process) and report the outcome in the sidebar"""
     try:
-        # Escape single quotes in the review text
-        review_text_escaped = review_text.replace("'", "''") if review_text else ""
-        
-        update_sql = f"""
-        UPDATE POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-        SET REVIEW_FEEDBACK = '{review_text_escaped}'
-        WHERE INTERACTION_ID = '{interaction_id}'
-        """
-        
-        # Execute the update
-        session.sql(update_sql).collect()
-        
-        # Verify the update worked by checking the row
-        verify_sql = f"""
-        SELECT REVIEW_FEEDBACK, INTERACTION_ID
-        FROM POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-        WHERE INTERACTION_ID = '{interaction_id}'
-        """
-        verify_result = session.sql(verify_sql).collect()
+        schema = migrate_chat_history_schema()
+        for column_name in schema.added_columns:
+            st.sidebar.success(f"Added {column_name} column to chat history table!")
+        for column_name in CHAT_HISTORY_MIGRATED_COLUMNS:
+            if not schema.has(column_name):
+                st.sidebar.warning(f"Chat history table has no {column_name} column; it is not being stored")
+        return True
         
-        if verify_result:
-            updated_review = verify_result[0]['REVIEW_FEEDBACK']
-            return updated_review == review_text_escaped
-        else:
-            return False
-            
     except Exception as e:
-        st.error(f"Error updating review feedback: {str(e)}")
+        st.sidebar.error(f"Error with chat history table: {str(e)}")
         return False
 
 def handle_feedback_buttons():
@@ -135,47 +1001,14 @@ def handle_feedback_buttons():
         hallucination_session_key not in st.session_state or 
         review_session_key not in st.session_state):
         try:
-            # Check which columns exist
-            check_columns_sql = """
-            SELECT COLUMN_NAME 
-            FROM INFORMATION_SCHEMA.COLUMNS 
-            WHERE TABLE_SCHEMA = 'PROCUREMENT_POLICY' 
-            AND TABLE_NAME = 'CHAT_HISTORY' 
-            AND COLUMN_NAME IN ('RESPONSE_QUALITY', 'IS_HALLUCINATION', 'REVIEW_FEEDBACK')
-            """
-            column_result = session.sql(check_columns_sql).collect()
-            existing_columns = [row['COLUMN_NAME'] for row in column_result]
-            
-            # Build query based on existing columns
-            select_fields = ['RESPONSE_QUALITY'] 
-            if 'IS_HALLUCINATION' in existing_columns:
-                select_fields.append('IS_HALLUCINATION')
-            if 'REVIEW_FEEDBACK' in existing_columns:
-                select_fields.append('REVIEW_FEEDBACK')
+            # Column capabilities come from the startup migration, not INFORMATION_SCHEMA
+            schema = migrate_chat_history_schema()
+            select_fields = [column for column in FEEDBACK_COLUMNS if schema.has(column)]
             
-            check_sql = f"""
-            SELECT {', '.join(select_fields)}
-            FROM POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-            WHERE INTERACTION_ID = '{interaction_id}'
-            """
-            result = session.sql(check_sql).collect()
-            
-            if result:
-                st.session_state[feedback_session_key] = result[0]['RESPONSE_QUALITY']
-                # Handle IS_HALLUCINATION column
-                if 'IS_HALLUCINATION' in existing_columns:
-                    st.session_state[hallucination_session_key] = result[0]['IS_HALLUCINATION']
-                else:
-                    st.session_state[hallucination_session_key] = None
-                # Handle REVIEW_FEEDBACK column
-                if 'REVIEW_FEEDBACK' in existing_columns:
-                    st.session_state[review_session_key] = result[0]['REVIEW_FEEDBACK']
-                else:
-                    st.session_state[review_session_key] = None
-            else:
-                st.session_state[feedback_session_key] = None
-                st.session_state[hallucination_session_key] = None
-                st.session_state[review_session_key] = None
+            row = get_backend().get_chat_feedback(interaction_id, select_fields)
+            st.session_state[feedback_session_key] = row.get('RESPONSE_QUALITY')
+            st.session_state[hallucination_session_key] = row.get('IS_HALLUCINATION')
+            st.session_state[review_session_key] = row.get('REVIEW_FEEDBACK')
                 
         except Exception as e:
             st.error(f"Error checking feedback: {str(e)}")
@@ -195,6 +1028,8 @@ def handle_feedback_buttons():
     st.caption("**Was this response helpful?**")
     col1, col2, col3, col4 = st.columns([1, 1, 1, 3])
     
+    # Buttons use on_click callbacks: state is updated before the rerun the click already
+    # triggers, so the ✓ labels are correct without a second st.rerun()
     with col1:
         # Thumbs up button
         if current_feedback == 'good':
@@ -204,16 +1039,12 @@ def handle_feedback_buttons():
             button_label = "👍 "
             button_help = "Rate as good"
         
-        if st.button(button_label, 
-                    key=f"thumbs_up_{interaction_id}",
-                    help=button_help):
-            
-            if current_feedback != 'good':
-                if update_feedback(interaction_id, 'good'):
-                    st.session_state[feedback_session_key] = 'good'
-                    st.rerun()
-                else:
-                    st.error("Failed to save feedback. Please try again.")
+        st.button(button_label, 
+                  key=f"thumbs_up_{interaction_id}",
+                  help=button_help,
+                  on_click=record_feedback_click,
+                  args=(interaction_id, feedback_session_key, 'good'),
+                  kwargs={"response_quality": 'good'})
     
     with col2:
         # Thumbs down button
@@ -224,16 +1055,12 @@ def handle_feedback_buttons():
             button_label = "👎 "
             button_help = "Rate as bad"
         
-        if st.button(button_label, 
-                    key=f"thumbs_down_{interaction_id}",
-                    help=button_help):
-            
-            if current_feedback != 'bad':
-                if update_feedback(interaction_id, 'bad'):
-                    st.session_state[feedback_session_key] = 'bad'
-                    st.rerun()
-                else:
-                    st.error("Failed to save feedback. Please try again.")
+        st.button(button_label, 
+                  key=f"thumbs_down_{interaction_id}",
+                  help=button_help,
+                  on_click=record_feedback_click,
+                  args=(interaction_id, feedback_session_key, 'bad'),
+                  kwargs={"response_quality": 'bad'})
     
     with col3:
         # Hallucination - Yes button
@@ -244,16 +1071,12 @@ def handle_feedback_buttons():
             button_label = "🚫"
             button_help = "Mark as hallucination"
         
-        if st.button(button_label, 
-                    key=f"hallucination_yes_{interaction_id}",
-                    help=button_help):
-            
-            if current_hallucination != 'Yes':
-                if update_hallucination_flag(interaction_id, 'Yes'):
-                    st.session_state[hallucination_session_key] = 'Yes'
-                    st.rerun()
-                else:
-                    st.error("Failed to save hallucination flag. Please try again.")
+        st.button(button_label, 
+                  key=f"hallucination_yes_{interaction_id}",
+                  help=button_help,
+                  on_click=record_feedback_click,
+                  args=(interaction_id, hallucination_session_key, 'Yes'),
+                  kwargs={"is_hallucination": 'Yes'})
     
     with col4:
         # Review text input with submit button
@@ -268,86 +1091,61 @@ def handle_feedback_buttons():
         
         # Only show submit button if there's text and it's different from current stored review
         if review_text.strip() and review_text.strip() != (current_review or "").strip():
-            if st.button("Save", 
-                        key=f"save_review_{interaction_id}",
-                        help="Save your review"):
-                if update_review_feedback(interaction_id, review_text.strip()):
-                    st.session_state[review_session_key] = review_text.strip()
-                    st.success("Review saved successfully!")
-                    st.rerun()
-                else:
-                    st.error("Failed to save review. Please try again.")
+            st.button("Save", 
+                      key=f"save_review_{interaction_id}",
+                      help="Save your review",
+                      on_click=record_review_click,
+                      args=(interaction_id, review_session_key))
+        elif current_review and st.session_state.get(f"review_saved_{interaction_id}"):
+            st.caption("Review saved.")
 
-def store_chat_interaction(question, response, model_name, category, source_docs, response_time_ms):
-    """Store chat interaction - UPDATED VERSION with review feedback column (with fallback)"""
+def record_feedback_click(interaction_id, session_key, session_value, **feedback):
+    """Button callback: show the new state straight away and hand the write to the background writer"""
+    if st.session_state.get(session_key) == session_value:
+        return
+    try:
+        submit_feedback(interaction_id, **feedback)
+        st.session_state[session_key] = session_value
+        if "review_feedback" in feedback:
+            st.session_state[f"review_saved_{interaction_id}"] = True
+    except Exception as e:
+        st.error(f"Failed to save feedback: {str(e)}")
+
+def record_review_click(interaction_id, session_key):
+    """Save button callback: read the review as typed now, not as it was when the button was drawn"""
+    review_text = (st.session_state.get(f"review_input_{interaction_id}") or "").strip()
+    if review_text:
+        record_feedback_click(interaction_id, session_key, review_text, review_feedback=review_text)
+
+def store_chat_interaction(question, response, model_name, category, source_docs, response_time_ms,
+                           interaction_id, user_name, stage_timings=None):
+    """Queue the chat interaction for the background writer"""
     try:
-        # Get current user
-        current_user = get_current_user()
-        
-        # Create source document links
-        source_links = create_source_document_links(source_docs)
-        
         # Truncate fields to avoid size issues
-        question_safe = question[:500] if question else ""
-        response_safe = response[:1000] if response else ""
-        source_links_safe = source_links[:2000] if source_links else ""
-        
-        # Check if REVIEW_FEEDBACK column exists
-        check_review_column_sql = """
-        SELECT COLUMN_NAME 
-        FROM INFORMATION_SCHEMA.COLUMNS 
-        WHERE TABLE_SCHEMA = 'PROCUREMENT_POLICY' 
-        AND TABLE_NAME = 'CHAT_HISTORY' 
-        AND COLUMN_NAME = 'REVIEW_FEEDBACK'
-        """
-        review_column_exists = len(session.sql(check_review_column_sql).collect()) > 0
-        
-        if review_column_exists:
-            # Use the full insert with REVIEW_FEEDBACK column
-            insert_sql = """
-            INSERT INTO POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-            (USER_QUESTION, AI_RESPONSE, MODEL_USED, CATEGORY_FILTER, SOURCE_DOCUMENTS, RESPONSE_TIME_MS, USER_NAME, RESPONSE_QUALITY, IS_HALLUCINATION, REVIEW_FEEDBACK)
-            VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL, NULL)
-            """
-        else:
-            # Fallback to insert without REVIEW_FEEDBACK column
-            insert_sql = """
-            INSERT INTO POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-            (USER_QUESTION, AI_RESPONSE, MODEL_USED, CATEGORY_FILTER, SOURCE_DOCUMENTS, RESPONSE_TIME_MS, USER_NAME, RESPONSE_QUALITY, IS_HALLUCINATION)
-            VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL)
-            """
-        
-        session.sql(insert_sql, params=[
-            question_safe,
-            response_safe, 
-            model_name,
-            category,
-            source_links_safe,
-            response_time_ms,
-            current_user
-        ]).collect()
-        
-        # Get the interaction ID of the just-inserted record
-        get_latest_sql = """
-        SELECT INTERACTION_ID 
-        FROM POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-        WHERE USER_NAME = ? 
-        ORDER BY TIMESTAMP DESC 
-        LIMIT 1
-        """
-        result = session.sql(get_latest_sql, params=[current_user]).collect()
-        
-        if result:
-            latest_interaction_id = result[0]['INTERACTION_ID']
-            st.session_state.latest_interaction_id = latest_interaction_id
-            return True
-        else:
-            return False
+        get_chat_history_writer().submit({
+            "interaction_id": interaction_id,
+            "question": question[:500] if question else "",
+            "response": response[:1000] if response else "",
+            "model_name": model_name,
+            "category": category,
+            "source_docs": list(source_docs or []),
+            "response_time_ms": response_time_ms,
+            "user_name": user_name,
+            "stage_timings": dict(stage_timings or {})
+        })
+        return True
         
     except Exception as e:
-        st.sidebar.error(f"Storage failed: {str(e)}")
+        logger.error("Storage failed: %s", e)
         return False
 
+def bind_feedback_to_interaction(interaction_id):
+    """Point the feedback buttons at a new interaction; it has no feedback yet, so no lookup is needed"""
+    st.session_state.latest_interaction_id = interaction_id
+    st.session_state[f"feedback_status_{interaction_id}"] = None
+    st.session_state[f"hallucination_status_{interaction_id}"] = None
+    st.session_state[f"review_status_{interaction_id}"] = None
+
 def clear_feedback_state():
     """Clear feedback state when starting new conversation"""
     # Clear all feedback-related session state including review feedback
@@ -375,93 +1173,33 @@ def get_current_user():
                 return str(user_info)
         else:
             # Fallback to Snowflake user
-            user_sql = "SELECT CURRENT_USER()"
-            result = session.sql(user_sql).collect()
-            user_name = result[0][0]
+            user_name = get_backend().current_user()
             return user_name if user_name and str(user_name) != 'None' else "Anonymous_User"
             
     except Exception as e:
         return "System_User"
 
-def create_source_document_links(source_docs):
-    """Convert source documents to links"""
+def get_session_user():
+    """Current user, resolved once per browser session"""
+    if "current_user" not in st.session_state:
+        st.session_state.current_user = get_current_user()
+    return st.session_state.current_user
+
+def format_source_document_links(source_docs, urls):
+    """Convert source documents to links using already-resolved presigned URLs"""
     if not source_docs:
         return ""
     
     links = []
     for path in source_docs:
-        try:
-            cmd = f"select GET_PRESIGNED_URL(@policy_documents, '{path}', 360) as URL_LINK from directory(@policy_documents)"
-            df_url_link = session.sql(cmd).to_pandas()
-            url_link = df_url_link._get_value(0,'URL_LINK')
-            doc_name = path.split('/')[-1]
-            links.append(f"{doc_name}: {url_link}")
-        except:
-            links.append(f"{path.split('/')[-1]}: Error getting link")
+        doc_name = path.split('/')[-1]
+        if path in urls:
+            links.append(f"{doc_name}: {urls[path]}")
+        else:
+            links.append(f"{doc_name}: Error getting link")
     
     return " | ".join(links)
 
-def update_feedback(interaction_id, feedback):
-    """Update feedback for a specific interaction"""
-    try:
-        # Simple, direct update using proper SQL escaping
-        update_sql = f"""
-        UPDATE POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-        SET RESPONSE_QUALITY = '{feedback}'
-        WHERE INTERACTION_ID = '{interaction_id}'
-        """
-        
-        # Execute the update
-        session.sql(update_sql).collect()
-        
-        # Verify the update worked by checking the row
-        verify_sql = f"""
-        SELECT RESPONSE_QUALITY, INTERACTION_ID
-        FROM POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-        WHERE INTERACTION_ID = '{interaction_id}'
-        """
-        verify_result = session.sql(verify_sql).collect()
-        
-        if verify_result:
-            updated_feedback = verify_result[0]['RESPONSE_QUALITY']
-            return updated_feedback == feedback
-        else:
-            return False
-            
-    except Exception as e:
-        st.error(f"Error updating feedback: {str(e)}")
-        return False
-
-def update_hallucination_flag(interaction_id, is_hallucination):
-    """Update hallucination flag for a specific interaction"""
-    try:
-        # Simple, direct update using proper SQL escaping
-        update_sql = f"""
-        UPDATE POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-        SET IS_HALLUCINATION = '{is_hallucination}'
-        WHERE INTERACTION_ID = '{interaction_id}'
-        """
-        
-        # Execute the update
-        session.sql(update_sql).collect()
-        
-        # Verify the update worked by checking the row
-        verify_sql = f"""
-        SELECT IS_HALLUCINATION, INTERACTION_ID
-        FROM POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY 
-        WHERE INTERACTION_ID = '{interaction_id}'
-        """
-        verify_result = session.sql(verify_sql).collect()
-        
-        if verify_result:
-            updated_hallucination = verify_result[0]['IS_HALLUCINATION']
-            return updated_hallucination == is_hallucination
-        else:
-            return False
-            
-    except Exception as e:
-        st.error(f"Error updating hallucination flag: {str(e)}")
-        return False
 
 ### Config/Init Functions
      
@@ -469,19 +1207,18 @@ def config_options():
     st.sidebar.title("**Chat Configuration**")
     
     st.sidebar.selectbox('**Select LLM Model**',
-                         ( 'llama3.1-70b',     
+                         ('llama3.1-70b',     
                           'llama3.1-8b', 
                           'snowflake-arctic',
-                         'mistral-large2'), 
+                         'mistral-large2',
+                          AUTO_MODEL), 
                     key="model_name")
 
-    categories = session.table('policy_docs_chunks').select('category').distinct().collect()
-
-    cat_list = ['ALL']
-    for cat in categories:
-        cat_list.append(cat.CATEGORY)
+    cat_list = ['ALL'] + get_document_categories(get_corpus_version())
             
     st.sidebar.selectbox('**Select document category**', cat_list, key = "category_value")
+    st.sidebar.button("Refresh document list", key="refresh_corpus", on_click=invalidate_corpus_cache,
+                      help="Re-read the document stage after uploading or removing policy documents")
    
     # Add horizontal line separator
     st.sidebar.markdown("---")
@@ -493,37 +1230,80 @@ def config_options():
 
     st.sidebar.checkbox('Summary of previous chat', key="debug", value = True)
     
+    cache_stats = get_answer_cache().stats()
+    retrieval_stats = get_retrieval_cache().stats()
+    st.sidebar.caption(
+        f"Answer cache: {cache_stats['hits']} hits, {cache_stats['near_hits']} near-duplicate hits, "
+        f"{cache_stats['misses']} misses ({cache_stats['entries']} cached)  \n"
+        f"Retrieval cache: {retrieval_stats['hits']} hits, {retrieval_stats['misses']} misses "
+        f"({retrieval_stats['entries']} cached)"
+    )
+    if RERANK_MODEL is not None:
+        rerank_stats = get_rerank_stats().stats()
+        st.sidebar.caption(
+            f"Reranker ({RERANK_MODEL}): {rerank_stats['reranked']} reranked, {rerank_stats['changed']} changed the "
+            f"top {NUM_CHUNKS}, {rerank_stats['timeouts']} timeouts, {rerank_stats['failures']} failures, "
+            f"{rerank_stats['skipped']} skipped while busy"
+        )
+    if LOCAL_INDEX_MODE != "off":
+        local_index = get_local_index()
+        st.sidebar.caption(
+            f"Local index ({LOCAL_INDEX_MODE}): " + (
+                f"{len(local_index.store)} chunks{', hybrid' if local_index.has_embeddings else ', BM25 only'}"
+                if local_index is not None else "loading..."
+            )
+        )
+    
+    latency_rows = get_stage_latency_stats().summary()
+    if latency_rows:
+        with st.sidebar.expander("Stage latency (this app process)"):
+            st.dataframe(pd.DataFrame(latency_rows).round(1), use_container_width=True, hide_index=True)
+    
     # FIXED: Show previous conversation summary using actual response
+    # The summary is generated on a background worker; until it's ready a placeholder is shown
     if st.session_state.debug:
         if hasattr(st.session_state, 'messages') and st.session_state.messages and len(st.session_state.messages) >= 2:
-            # Get the last question-answer pair
-            previous_question = st.session_state.messages[-2]['content']
-            previous_answer = st.session_state.messages[-1]['content']  # Get the actual answer
-            
-            # Check if we need to generate a new summary
             summary_key = f"summary_{len(st.session_state.messages)}"
             if summary_key not in st.session_state:
-                summary_prompt = f"""
-                    Summarize the following answer in 1-2 sentences. Be concise and capture the key points:
-                    
-                    Question: {previous_question}
-                    Answer: {previous_answer}
-                    
-                    Provide only a brief summary of the answer:
-                    """
-                try:
-                    summary = Complete(st.session_state.model_name, summary_prompt).replace("'", "")
-                    st.session_state[summary_key] = f"Question: {previous_question}\n\nSummary: {summary}"
-                except Exception as e:
-                    # Fallback to truncated answer if summary generation fails
-                    st.session_state[summary_key] = f"Question: {previous_question}\n\nAnswer: {previous_answer[:200]}..."
+                future = schedule_chat_summary()
+                if future.done():
+                    st.session_state[summary_key] = future.result()
             
             st.sidebar.text("Previous Chat Summary:")
-            st.sidebar.caption(st.session_state[summary_key])
+            st.sidebar.caption(st.session_state.get(summary_key, "Summarising the previous answer..."))
     
     st.sidebar.button("Start Over", key="clear_conversation", on_click=init_messages, type="primary")
     st.sidebar.markdown("---")
 
+def generate_chat_summary(model_name, previous_question, previous_answer):
+    """Summarise the last question/answer pair; runs on a worker thread, so no Streamlit state here"""
+    summary_prompt = f"""
+        Summarize the following answer in 1-2 sentences. Be concise and capture the key points:
+        
+        Question: {previous_question}
+        Answer: {previous_answer}
+        
+        Provide only a brief summary of the answer:
+        """
+    try:
+        summary = get_backend().complete(model_name, summary_prompt).replace("'", "")
+        return f"Question: {previous_question}\n\nSummary: {summary}"
+    except Exception as e:
+        # Fallback to truncated answer if summary generation fails
+        return f"Question: {previous_question}\n\nAnswer: {previous_answer[:200]}..."
+
+def schedule_chat_summary():
+    """Start (once per message index) the background summary of the latest question/answer pair"""
+    future_key = f"summary_future_{len(st.session_state.messages)}"
+    if future_key not in st.session_state:
+        st.session_state[future_key] = get_background_executor().submit(
+            generate_chat_summary,
+            auxiliary_model(st.session_state.model_name),
+            st.session_state.messages[-2]['content'],
+            st.session_state.messages[-1]['content']
+        )
+    return st.session_state[future_key]
+
 def init_messages():
     if st.session_state.clear_conversation or "messages" not in st.session_state:
         st.session_state.messages = []
@@ -540,111 +1320,365 @@ def init_messages():
             del st.session_state[key]
 
 def get_similar_chunks_search_service(query):
-    if st.session_state.category_value == "ALL":
-        response = svc.search(query, COLUMNS, limit=NUM_CHUNKS)
-    else: 
-        filter_obj = {"@eq": {"category": st.session_state.category_value} }
-        response = svc.search(query, COLUMNS, filter=filter_obj, limit=NUM_CHUNKS)
+    """Search results for the query as a list of dicts (chunk, chunk_index, relative_path, category)"""
+    return search_policy_chunks(query, st.session_state.category_value, get_search_service_version(),
+                                get_retrieval_cache(), get_local_index())
+
+def search_policy_chunks(query, category, version, cache, local_index=None):
+    """Cached Cortex Search lookup; touches no Streamlit state so it can run on a worker thread"""
+    filter_obj = None if category == "ALL" else {"@eq": {"category": category}}
+    if local_index is not None and LOCAL_INDEX_MODE == "primary":
+        return search_local_index(local_index, query, filter_obj)
     
-    return response.json()  
+    if version is not None:
+        results = cache.get(query, category, RETRIEVAL_FETCH_CHUNKS, version)
+        if results is not None:
+            return results
+    
+    if local_index is None:
+        results = get_backend().search(query, COLUMNS, filter=filter_obj, limit=RETRIEVAL_FETCH_CHUNKS)
+    else:
+        try:
+            results = get_search_executor().submit(
+                get_backend().search, query, COLUMNS, filter=filter_obj, limit=RETRIEVAL_FETCH_CHUNKS
+            ).result(timeout=SEARCH_TIMEOUT_SECONDS)
+        except Exception as e:
+            # Slow, refreshing or failing service: answer from memory, and don't cache the fallback
+            logger.warning("Cortex Search unavailable (%s); using the local index", str(e) or type(e).__name__)
+            return search_local_index(local_index, query, filter_obj)
+    
+    if version is not None:
+        cache.put(query, category, RETRIEVAL_FETCH_CHUNKS, version, results)
+    return results
+
+def merge_search_results(primary, secondary, limit):
+    """Interleave two result lists (primary first), dropping repeated chunks"""
+    merged = []
+    seen = set()
+    for pair in zip(primary + [None] * len(secondary), secondary + [None] * len(primary)):
+        for item in pair:
+            if item is None:
+                continue
+            key = (item['relative_path'], item['chunk_index'])
+            if key not in seen:
+                seen.add(key)
+                merged.append(item)
+    return merged[:limit]
+
+def relevance_score(item, score_name):
+    scores = item.get('@scores') or {}
+    value = scores.get(score_name)
+    return float(value) if value is not None else None
+
+def join_overlapping(first, second, max_overlap, min_overlap):
+    """Concatenate neighbouring chunks, dropping the text the splitter repeated between them.
+
+    Only a match of at least min_overlap characters that starts on whitespace in first counts as
+    overlap; shorter or mid-word matches are coincidences, and the chunks are joined with a newline.
+    """
+    tail = first[-max_overlap:]
+    for size in range(min(len(tail), len(second)), min(min_overlap, len(second)) - 1, -1):
+        if size and tail.endswith(second[:size]) and (size == len(first) or first[-size - 1].isspace()):
+            return first + second[size:]
+    return first + "\n" + second
+
+def merge_neighbor_chunks(search_results):
+    """Collapse hits on the same or adjacent chunk_index of one document into a single passage.
+
+    Passages keep the rank of their best hit; chunk_index is the first chunk of the passage.
+    """
+    runs = {}
+    for rank, item in enumerate(search_results):
+        runs.setdefault(item['relative_path'], []).append((int(item['chunk_index']), rank, item))
+    
+    passages = []
+    for path_hits in runs.values():
+        path_hits.sort(key=lambda hit: hit[0])
+        current = None
+        for chunk_index, rank, item in path_hits:
+            if current is not None and chunk_index <= current['last_index'] + 1:
+                if chunk_index > current['last_index']:
+                    current['passage']['chunk'] = join_overlapping(current['passage']['chunk'], item['chunk'],
+                                                                   CHUNK_OVERLAP_CHARS + 16, CHUNK_OVERLAP_CHARS // 4)
+                    current['last_index'] = chunk_index
+                current['rank'] = min(current['rank'], rank)
+                current['scores'].append(item.get('@scores') or {})
+                continue
+            current = {'passage': dict(item), 'last_index': chunk_index, 'rank': rank, 'scores': [item.get('@scores') or {}]}
+            passages.append(current)
+    
+    merged = []
+    for current in sorted(passages, key=lambda run: run['rank']):
+        passage = current['passage']
+        # A passage is as relevant as its best chunk
+        score_names = {name for scores in current['scores'] for name in scores}
+        passage['@scores'] = {
+            name: max(float(scores[name]) for scores in current['scores'] if scores.get(name) is not None)
+            for name in score_names
+        }
+        merged.append(passage)
+    return merged
+
+def select_passages(passages):
+    """Keep merged passages, best first, until relevance drops off"""
+    if not passages:
+        return passages
+    
+    top_scores = passages[0].get('@scores') or {}
+    score_name = next((name for name in ('rerank_score', 'reranker_score', 'cosine_similarity', 'text_match') if name in top_scores), None)
+    if score_name is None:
+        # No scores to judge relevance by: fall back to the fixed count
+        return passages[:NUM_CHUNKS]
+    
+    top_score = relevance_score(passages[0], score_name)
+    selected = [passages[0]]
+    for passage in passages[1:MAX_CONTEXT_PASSAGES]:
+        score = relevance_score(passage, score_name)
+        if score is None or top_score <= 0 or score < top_score * RELEVANCE_DROPOFF_RATIO:
+            break
+        selected.append(passage)
+    return selected
+
+def trim_chat_history(history):
+    """The earlier messages sent along with a new question: the last slide_window - 1 of them"""
+    return history[-(slide_window - 1):] if slide_window > 1 else []
 
 def get_chat_history():
-    chat_history = []
-    start_index = max(0, len(st.session_state.messages) - slide_window)
-    for i in range (start_index , len(st.session_state.messages) -1):
-         chat_history.append(st.session_state.messages[i])
-    return chat_history
+    # The last message is the question being answered
+    return trim_chat_history(st.session_state.messages[:-1])
 
-def summarize_question_with_history(chat_history, question):
+def summarize_question_with_history(chat_history, question, model_name):
     prompt = f"""
         Based on the chat history below and the question, generate a query that extends the question
         with the chat history provided. The query should be in natural language. 
         Answer with only the query. Do not add any explanation.
         
         <chat_history>
-        {chat_history}
+        {format_chat_history(chat_history, int(prompt_token_budget(model_name) * HISTORY_TOKEN_SHARE))}
         </chat_history>
         <question>
         {question}
         </question>
         """
     
-    summary = Complete(st.session_state.model_name, prompt)   
+    summary = get_backend().complete(model_name, prompt)   
     summary = summary.replace("'", "")
     return summary
 
-def create_prompt(myquestion):
-    if st.session_state.use_chat_history:
-        chat_history = get_chat_history()
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|she|above|previous|earlier|"
+    r"same|such|also|more|else|again|another|other|former|latter)\b",
+    re.IGNORECASE
+)
+
+def is_standalone_question(question):
+    """Cheap check: a reasonably long question with no back-references doesn't need the chat history"""
+    return len(question.split()) >= 5 and not FOLLOW_UP_PATTERN.search(question)
+
+def needs_history_rewrite(question):
+    """Decide whether to spend an LLM call rewriting the question with the chat history"""
+    if not SKIP_REWRITE_FOR_STANDALONE:
+        return True
+    if is_standalone_question(question):
+        return False
+    if REWRITE_GATE_MODEL:
+        gate_prompt = f"""
+            Does the question below only make sense together with the earlier conversation?
+            Answer with only YES or NO.
+            
+            <question>
+            {question}
+            </question>
+            """
+        try:
+            return get_backend().complete(REWRITE_GATE_MODEL, gate_prompt).strip().upper().startswith("YES")
+        except Exception as e:
+            logger.warning("Rewrite gate failed, rewriting anyway: %s", e)
+    return True
+
+def get_chat_settings():
+    """Answer-pipeline settings for the current Streamlit session.
+
+    Headless callers (benchmark, batch runs) build the same dict themselves.
+    """
+    return {
+        "model_name": st.session_state.model_name,
+        "category": st.session_state.category_value,
+        "use_chat_history": st.session_state.use_chat_history,
+        "chat_history": get_chat_history() if st.session_state.use_chat_history else [],
+        "user_name": get_session_user(),
+        "store_conversations": st.session_state.get('store_conversations', True)
+    }
+
+def create_prompt(myquestion, settings, timer=None):
+    """Retrieve context and pack the prompt; returns (prompt, source paths, chunks used, answer model)"""
+    if timer is None:
+        timer = StageTimer()
+    category = settings["category"]
+    version = get_search_service_version()
+    cache = get_retrieval_cache()
+    local_index = get_local_index()
 
-        if chat_history != []:
-            question_summary = summarize_question_with_history(chat_history, myquestion)
-            prompt_context =  get_similar_chunks_search_service(question_summary)
+    def timed_search(query, stage="search"):
+        with timer.span(stage):
+            return search_policy_chunks(query, category, version, cache, local_index)
+
+    def timed_rewrite(chat_history):
+        with timer.span("rewrite"):
+            return summarize_question_with_history(chat_history, myquestion, auxiliary_model(settings["model_name"]))
+    
+    search_query = myquestion
+    if settings["use_chat_history"]:
+        chat_history = settings["chat_history"]
+
+        if chat_history != [] and needs_history_rewrite(myquestion):
+            if QUERY_REWRITE_MODE == "parallel":
+                # Search the raw question while the rewrite runs, then merge both result sets
+                # (search_raw overlaps rewrite, so it doesn't add to the response time)
+                raw_search = get_background_executor().submit(timed_search, myquestion, "search_raw")
+                # Either branch alone is enough to answer from, so one failing doesn't fail the question
+                try:
+                    question_summary = timed_rewrite(chat_history)
+                    rewritten_results = timed_search(question_summary)
+                except Exception as e:
+                    logger.warning("Query rewrite or rewritten search failed, using the raw question: %s", e)
+                    question_summary, rewritten_results = myquestion, None
+                try:
+                    raw_results = raw_search.result()
+                except Exception as e:
+                    if rewritten_results is None:
+                        raise
+                    logger.warning("Raw question search failed, using the rewritten query only: %s", e)
+                    raw_results = []
+                if rewritten_results is None:
+                    search_results = raw_results
+                else:
+                    search_results = merge_search_results(rewritten_results, raw_results, RETRIEVAL_FETCH_CHUNKS)
+            else:
+                try:
+                    question_summary = timed_rewrite(chat_history)
+                    search_results = timed_search(question_summary)
+                except Exception as e:
+                    # Same fallback as parallel mode, just without the head start
+                    logger.warning("Query rewrite or rewritten search failed, using the raw question: %s", e)
+                    question_summary = myquestion
+                    search_results = timed_search(myquestion, "search_raw")
+            search_query = question_summary
         else:
-            prompt_context = get_similar_chunks_search_service(myquestion)
+            search_results = timed_search(myquestion)
     else:
-        prompt_context = get_similar_chunks_search_service(myquestion)
-        chat_history = ""
-  
-    prompt = f"""
-           You are an expert chat assistant that extracts information from the CONTEXT provided
-           between <context> and </context> tags.
-           You offer a chat experience considering the information included in the CHAT HISTORY
-           provided between <chat_history> and </chat_history> tags..
-           When answering the question contained between <question> and </question> tags
-           be detailed, covering all the relevant information but do not hallucinate. 
-           If you don´t have the information just say so.
-           Do not answer any general questions apart from those that might be based on the CONTEXT documents.
-           
-           Do not mention the CONTEXT used in your answer.
-           Do not mention the CHAT HISTORY used in your asnwer.
-
-           Only answer the question if you can extract it from the CONTEXT provided.
-           
-           <chat_history>
-           {chat_history}
-           </chat_history>
-           <context>          
-           {prompt_context}
-           </context>
-           <question>  
-           {myquestion}
-           </question>
-           Answer: 
-           """
-    
-    json_data = json.loads(prompt_context)
-    relative_paths = set(item['relative_path'] for item in json_data['results'])
-    return prompt, relative_paths, json_data['results']
-
-def answer_question(myquestion):
+        search_results = timed_search(myquestion)
+        chat_history = []
+    
+    passages = merge_neighbor_chunks(search_results)
+    if RERANK_MODEL is not None:
+        with timer.span("rerank"):
+            passages = rerank_passages(search_query, passages)
+    search_results = select_passages(passages)
+    
+    # The budget depends on the model that will answer, so route before packing
+    answer_model = choose_answer_model(settings["model_name"], myquestion, search_results)
+    with timer.span("prompt_build"):
+        prompt, included_results = build_prompt(myquestion, search_results, chat_history, answer_model)
+    
+    # Only the chunks that made it into the prompt are reported as sources
+    relative_paths = set(item['relative_path'] for item in included_results)
+    return prompt, relative_paths, included_results, answer_model
+
+def stream_completion(model_name, prompt, message_placeholder, timer=None):
+    """Stream the answer into the placeholder as tokens arrive and return the full text"""
+    tokens = get_backend().complete_stream(
+                      model_name,
+                      prompt,
+                      options={'guardrails': True}
+                     )
+    response = ""
+    last_render = 0.0
+    stream_start = time.perf_counter()
+    for token in tokens:
+        if not response and timer is not None:
+            timer.add("first_token", (time.perf_counter() - stream_start) * 1000)
+        response += token
+        now = time.monotonic()
+        if now - last_render >= STREAM_RENDER_INTERVAL_SECONDS:
+            message_placeholder.markdown(response.replace("'", "") + "▌")
+            last_render = now
+    message_placeholder.markdown(response.replace("'", ""))
+    return response
+
+def answer_question(myquestion, message_placeholder=None, settings=None, interaction_id=None):
+    """Answer one question; settings default to the current Streamlit session's"""
+    if settings is None:
+        settings = get_chat_settings()
+    result = run_answer_pipeline(myquestion, settings, message_placeholder, interaction_id)
+    return result["response"], result["relative_paths"], result["chunks"]
+
+def run_answer_pipeline(myquestion, settings, message_placeholder=None, interaction_id=None):
+    """Retrieve, generate and store one answer; returns the answer with its sources, model and timings"""
+    model_name = settings["model_name"]
+    
     # Start timing for performance tracking
-    start_time = datetime.now()
+    start_time = time.perf_counter()
+    timer = StageTimer()
+    
+    # Standalone questions can be served from the answer cache
+    cache_scope = None
+    cached_answer = None
+    if answer_cache_applies(settings):
+        cache_scope = (model_name, settings["category"], get_corpus_version())
+        with timer.span("answer_cache"):
+            cached_answer, question_embedding = lookup_cached_answer(myquestion, cache_scope)
     
-    prompt, relative_paths, chunks_data = create_prompt(myquestion)
-    # response = Complete(st.session_state.model_name, prompt)
-    response = Complete(
-                        model=st.session_state.model_name,
-                        prompt=prompt,
-                        options={'guardrails': True}
-                       )
+    prompt_tokens = 0
+    if cached_answer is not None:
+        response, relative_paths, chunks_data, answer_model = cached_answer
+    else:
+        prompt, relative_paths, chunks_data, answer_model = create_prompt(myquestion, settings, timer)
+        prompt_tokens = estimate_tokens(prompt)
+        # response = Complete(st.session_state.model_name, prompt)
+        with timer.span("generation"):
+            if STREAM_RESPONSES and message_placeholder is not None:
+                response = stream_completion(answer_model, prompt, message_placeholder, timer)
+            else:
+                response = get_backend().complete(
+                                    answer_model,
+                                    prompt,
+                                    options={'guardrails': True}
+                                   )
+        if cache_scope is not None:
+            get_answer_cache().put(myquestion, cache_scope, (response, relative_paths, chunks_data, answer_model),
+                                   question_embedding)
     
     # Calculate response time
-    end_time = datetime.now()
-    response_time_ms = int((end_time - start_time).total_seconds() * 1000)
+    response_time_ms = int((time.perf_counter() - start_time) * 1000)
+    stage_timings = timer.as_dict()
+    get_stage_latency_stats().record(dict(stage_timings, response=response_time_ms))
     
     # Store in database if enabled
-    if st.session_state.get('store_conversations', True):
+    if settings.get("store_conversations", True) and interaction_id is not None:
         store_chat_interaction(
             question=myquestion,
             response=response,
-            model_name=st.session_state.model_name,
-            category=st.session_state.category_value,
+            model_name=answer_model,
+            category=settings["category"],
             source_docs=relative_paths,
-            response_time_ms=response_time_ms
+            response_time_ms=response_time_ms,
+            interaction_id=interaction_id,
+            user_name=settings.get("user_name"),
+            stage_timings=stage_timings
         )
     
-    return response, relative_paths, chunks_data
+    return {
+        "response": response,
+        "relative_paths": relative_paths,
+        "chunks": chunks_data,
+        "answer_model": answer_model,
+        "cached": cached_answer is not None,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": estimate_tokens(response) if cached_answer is None else 0,
+        "response_time_ms": response_time_ms,
+        "stage_timings": stage_timings
+    }
 
 def show_chunks_content(chunks_data):
     """Display chunks content in sidebar"""
@@ -663,35 +1697,7 @@ def get_document_links(relative_paths):
         if not relative_paths:
             return {}
         
-        # Convert set to list for SQL IN clause
-        paths_list = list(relative_paths)
-        
-        # Create placeholders for the IN clause
-        placeholders = ','.join(['?' for _ in paths_list])
-        
-        # Query to get links for documents that have them
-        links_sql = f"""
-        SELECT DISTINCT 
-            A.RELATIVE_PATH, 
-            B.DOCUMENT_NAME, 
-            B.LINK 
-        FROM POLICY_DOCS_CHUNKS A 
-        INNER JOIN GPT_DOCUMENT_LINKS B 
-            ON A.RELATIVE_PATH = SUBSTRING(B.DOCUMENT_NAME, POSITION('/' IN B.DOCUMENT_NAME) + 1)
-        WHERE A.RELATIVE_PATH IN ({placeholders})
-        """
-        
-        result = session.sql(links_sql, params=paths_list).collect()
-        
-        # Create dictionary mapping relative_path to link
-        links_dict = {}
-        for row in result:
-            links_dict[row['RELATIVE_PATH']] = {
-                'document_name': row['DOCUMENT_NAME'],
-                'link': row['LINK']
-            }
-        
-        return links_dict
+        return get_backend().get_document_links(list(relative_paths))
         
     except Exception as e:
         st.sidebar.error(f"Error fetching document links: {str(e)}")
@@ -708,6 +1714,15 @@ def show_context_documentation():
     # Get available links from database
     available_links = get_document_links(st.session_state.last_relative_paths)
     
+    # Resolve download links for everything else in one batch
+    fallback_paths = [path for path in st.session_state.last_relative_paths if path not in available_links]
+    url_error = None
+    try:
+        download_urls = get_presigned_urls(fallback_paths)
+    except Exception as e:
+        download_urls = {}
+        url_error = e
+    
     for path in st.session_state.last_relative_paths:
         doc_name = path.split('/')[-1]
         
@@ -719,20 +1734,16 @@ def show_context_documentation():
                 f'🔗 <a href="{link_info["link"]}" target="_blank">{doc_name}</a>', 
                 unsafe_allow_html=True
             )
-        else:
+        elif path in download_urls:
             # Show download link as fallback
-            try:
-                cmd2 = f"select GET_PRESIGNED_URL(@policy_documents, '{path}', 360) as URL_LINK from directory(@policy_documents)"
-                df_url_link = session.sql(cmd2).to_pandas()
-                url_link = df_url_link._get_value(0,'URL_LINK')
-                
-                st.sidebar.markdown(
-                    f'📄 <a href="{url_link}" target="_blank">{doc_name}</a>', 
-                    unsafe_allow_html=True
-                )
-                
-            except Exception as e:
-                st.sidebar.caption(f"Error loading {doc_name}: {str(e)}")
+            st.sidebar.markdown(
+                f'📄 <a href="{download_urls[path]}" target="_blank">{doc_name}</a>', 
+                unsafe_allow_html=True
+            )
+        elif url_error is not None:
+            st.sidebar.caption(f"Error loading {doc_name}: {str(url_error)}")
+        else:
+            st.sidebar.caption(f"Error loading {doc_name}: document not found on stage")
 
 
 def main():
@@ -755,10 +1766,7 @@ def main():
 
     
     st.write("List of documents provided in context")
-    docs_available = session.sql("ls @policy_documents").collect()
-    list_docs = []
-    for doc in docs_available:
-        list_docs.append(doc["name"])
+    list_docs = [doc["name"] for doc in get_stage_documents()]
     
     df_docs = pd.DataFrame(list_docs, columns=["Document Name"])
     st.dataframe(df_docs, use_container_width=True, hide_index=True)
@@ -785,7 +1793,11 @@ def main():
             question = question.replace("'","")
     
             with st.spinner(f"{st.session_state.model_name} thinking..."):
-                response, relative_paths, chunks_data = answer_question(question)            
+                # Minted here rather than by the table default, so the row never has to be looked up again
+                interaction_id = str(uuid.uuid4())
+                response, relative_paths, chunks_data = answer_question(question, message_placeholder,
+                                                                        interaction_id=interaction_id)
+                bind_feedback_to_interaction(interaction_id)
                 response = response.replace("'", "")
                 message_placeholder.markdown(response)
 
@@ -801,6 +1813,10 @@ def main():
                 st.session_state.last_chunks_data = chunks_data
 
         st.session_state.messages.append({"role": "assistant", "content": response})
+        
+        # Kick off the sidebar summary now so it is usually ready by the next rerun
+        if st.session_state.debug:
+            schedule_chat_summary()
     
     # ALWAYS show feedback buttons if there's a latest interaction
     # This ensures they persist even after page refreshes or new questions
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import importlib
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from policy_backend import LocalBackend, chunk_documents_dir, load_chunks_jsonl, set_default_backend
+
+### Load benchmark for Procurement GPT against the offline LocalBackend
+#
+#   python benchmark_policy_gpt.py --docs ./sample_policies --users 16 --questions-per-user 10
+#
+# Every simulated user asks questions through answer_question() with a growing chat history and
+# then rates the answer through submit_feedback(). After the first turn, a share of the questions
+# (--follow-up-share) are turned into back-referencing follow-ups ("Does that also apply to ...?"),
+# so the history rewrite is exercised alongside standalone questions that skip it.
+# Backend calls are timed per method, so the report shows p50/p95/p99 per stage.
+
+APP_MODULE = "DEV_POLICY_GPT_LATEST"
+FOLLOW_UP_TEMPLATES = (
+    "Does that also apply to {topic}?",
+    "And what does it say about {topic}?",
+    "Is this different for {topic}?"
+)
+
+class StageRecorder:
+    """Thread-safe collection of latency samples (seconds) per stage"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def report(self):
+        rows = []
+        with self._lock:
+            for stage, values in sorted(self.samples.items()):
+                ordered = sorted(values)
+                rows.append({
+                    "stage": stage,
+                    "count": len(ordered),
+                    "p50_ms": percentile(ordered, 50) * 1000,
+                    "p95_ms": percentile(ordered, 95) * 1000,
+                    "p99_ms": percentile(ordered, 99) * 1000,
+                    "mean_ms": sum(ordered) / len(ordered) * 1000
+                })
+        return rows
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+class TimedBackend:
+    """Wraps a backend and records how long each method call takes"""
+
+    def __init__(self, backend, recorder):
+        self._backend = backend
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self._backend, name)
+        if not callable(attribute):
+            return attribute
+        if name == "complete_stream":
+            return self._timed_stream(attribute)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self._recorder.record(f"backend.{name}", time.perf_counter() - start)
+        return timed
+
+    def _timed_stream(self, stream):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            first_token = None
+            for piece in stream(*args, **kwargs):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    self._recorder.record("backend.complete_stream.first_token", first_token - start)
+                yield piece
+            self._recorder.record("backend.complete_stream", time.perf_counter() - start)
+        return timed
+
+class TimingPlaceholder:
+    """Stands in for st.empty(): records when the first text is rendered"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_render = None
+
+    def markdown(self, text):
+        if self.first_render is None:
+            self.first_render = time.perf_counter()
+
+def sample_questions(chunks, count, seed):
+    """Deterministic questions built from chunk text when no question file is given"""
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        words = rng.choice(chunks)['chunk'].split()
+        start = rng.randrange(max(len(words) - 8, 1))
+        questions.append("What does the policy say about " + " ".join(words[start:start + 8]) + "?")
+    return questions
+
+def load_questions(path):
+    """Questions from a .txt file (one per line) or a JSONL file with a "question" field"""
+    with open(path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if path.endswith(".jsonl"):
+        return [json.loads(line)["question"] for line in lines]
+    return lines
+
+def follow_up_question(question, rng):
+    """A follow-up on the last few words of question that only makes sense with the chat history"""
+    topic = " ".join(question.rstrip("?").split()[-3:])
+    return rng.choice(FOLLOW_UP_TEMPLATES).format(topic=topic)
+
+def run_user(app, user_number, questions, args, recorder):
+    rng = random.Random(args.seed * 1000 + user_number)
+    messages = []
+    for question in questions:
+        if messages and rng.random() < args.follow_up_share:
+            question = follow_up_question(question, rng)
+        interaction_id = str(uuid.uuid4())
+        settings = {
+            "model_name": args.model,
+            "category": "ALL",
+            "use_chat_history": True,
+            "chat_history": app.trim_chat_history(messages),
+            "user_name": f"BENCH_USER_{user_number}",
+            "store_conversations": True
+        }
+        placeholder = TimingPlaceholder() if args.stream else None
+
+        start = time.perf_counter()
+        response, _, _ = app.answer_question(question, placeholder, settings=settings, interaction_id=interaction_id)
+        recorder.record("answer_question", time.perf_counter() - start)
+        if placeholder is not None and placeholder.first_render is not None:
+            recorder.record("time_to_first_token", placeholder.first_render - placeholder.started)
+
+        start = time.perf_counter()
+        app.submit_feedback(interaction_id, response_quality=random.choice(["good", "bad"]))
+        recorder.record("submit_feedback", time.perf_counter() - start)
+
+        messages.append({"role": "user", "content": question})
+        messages.append({"role": "assistant", "content": response})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test answer_question() and feedback against the local backend")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--chunks", help="JSONL file of chunks (chunk, chunk_index, relative_path[, category])")
+    source.add_argument("--docs", help="Directory of .txt/.md policy documents to chunk")
+    parser.add_argument("--questions", help="Question file (.txt one per line, or .jsonl with a question field)")
+    parser.add_argument("--users", type=int, default=8, help="Concurrent simulated users")
+    parser.add_argument("--questions-per-user", type=int, default=10)
+    parser.add_argument("--model", default="llama3.1-70b")
+    parser.add_argument("--follow-up-share", type=float, default=0.3,
+                        help="Share of questions after the first turn asked as follow-ups that need the history rewrite")
+    parser.add_argument("--complete-latency-ms", type=float, default=800)
+    parser.add_argument("--search-latency-ms", type=float, default=150)
+    parser.add_argument("--sql-latency-ms", type=float, default=50)
+    parser.add_argument("--stream", action="store_true", help="Stream answers and report time to first token")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    chunks = load_chunks_jsonl(args.chunks) if args.chunks else chunk_documents_dir(args.docs)
+    if not chunks:
+        parser.error("no chunks found")
+
+    recorder = StageRecorder()
+    backend = LocalBackend(
+        chunks,
+        complete_latency_seconds=args.complete_latency_ms / 1000,
+        search_latency_seconds=args.search_latency_ms / 1000,
+        sql_latency_seconds=args.sql_latency_ms / 1000,
+        seed=args.seed
+    )
+    set_default_backend(TimedBackend(backend, recorder))
+    os.environ["POLICY_GPT_BACKEND"] = "local"
+    app = importlib.import_module(APP_MODULE)
+    # Bare mode warns about the missing script run context on every cached call
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    random.seed(args.seed)
+    questions = load_questions(args.questions) if args.questions else sample_questions(chunks, 50, args.seed)
+    per_user = [
+        [questions[(user * args.questions_per_user + i) % len(questions)] for i in range(args.questions_per_user)]
+        for user in range(args.users)
+    ]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        futures = [pool.submit(run_user, app, user, per_user[user], args, recorder) for user in range(args.users)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    flush_start = time.perf_counter()
+    app.get_chat_history_writer().flush()
+    recorder.record("history_writer_drain", time.perf_counter() - flush_start)
+
+    rows = recorder.report()
+    total_questions = args.users * args.questions_per_user
+    stored = len(backend.chat_history_rows())
+    if args.json:
+        print(json.dumps({
+            "users": args.users,
+            "questions": total_questions,
+            "elapsed_s": elapsed,
+            "throughput_qps": total_questions / elapsed,
+            "rows_stored": stored,
+            "stages": rows
+        }, indent=2))
+        return 0
+
+    print(f"{args.users} users x {args.questions_per_user} questions in {elapsed:.2f}s "
+          f"({total_questions / elapsed:.2f} q/s), {stored} CHAT_HISTORY rows stored")
+    print(f"{'stage':40} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    for row in rows:
+        print(f"{row['stage']:40} {row['count']:>7} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['mean_ms']:>9.1f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
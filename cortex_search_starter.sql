@@ -1,6 +1,9 @@
 
 create or replace stage policy_documents encryption = (TYPE = 'SNOWFLAKE_SSE') DIRECTORY = (ENABLE = TRUE);
 
+-- Initial full load. To add, change or remove documents afterwards run policy_ingest.py, which only
+-- parses files whose MD5 changed (tracked in POLICY_DOCS_MANIFEST) instead of rebuilding everything.
+
 
 ls @policy_documents;
 
@@ -0,0 +1,190 @@
+import streamlit as st # Import python packages
+import pandas as pd
+
+from policy_app_common import CHAT_HISTORY_TABLE, STAGE_TIMINGS_COLUMN, get_backend, migrate_chat_history_schema
+
+### Default Values
+DASHBOARD_ADMIN_USERS = () # Emails/user names allowed to open this page; st.secrets["policy_gpt"]["dashboard_admins"] adds more
+DASHBOARD_CACHE_TTL_SECONDS = 120 # Aggregates are reused for this long, so opening the page stays cheap
+LOOKBACK_DAYS_OPTIONS = (1, 7, 30, 90)
+TIME_GRAINS = ("hour", "day", "week") # Whitelisted: DATE_TRUNC's part can't be a bind parameter
+
+### Access
+
+def get_viewer_identities():
+    """Lower-cased email and user name of the signed-in viewer (empty if Streamlit can't tell)"""
+    user_info = getattr(st, "user", None) or getattr(st, "experimental_user", None)
+    identities = set()
+    for field in ("email", "user_name", "name"):
+        try:
+            value = getattr(user_info, field, None) or user_info.get(field)
+        except Exception:
+            value = None
+        if value:
+            identities.add(str(value).lower())
+    return identities
+
+def get_dashboard_admins():
+    admins = set(DASHBOARD_ADMIN_USERS)
+    try:
+        admins.update(st.secrets["policy_gpt"]["dashboard_admins"])
+    except Exception:
+        pass
+    return {str(admin).lower() for admin in admins}
+
+def is_dashboard_admin():
+    # The viewer's own identity only: inside Snowflake CURRENT_USER() is the app owner, not the viewer
+    return bool(get_viewer_identities() & get_dashboard_admins())
+
+### Queries
+# All aggregation runs in the warehouse; only the aggregated rows come back to the app
+
+def run_aggregate(query, params):
+    return pd.DataFrame([row.as_dict() for row in get_backend().run_sql(query, params=params)])
+
+@st.cache_data(ttl=DASHBOARD_CACHE_TTL_SECONDS, show_spinner=False)
+def get_latency_over_time(days, grain, category):
+    """Response time percentiles per period and model, optionally for one category filter"""
+    if grain not in TIME_GRAINS:
+        raise ValueError(f"Unsupported time grain: {grain}")
+    params = [days]
+    category_clause = ""
+    if category is not None:
+        category_clause = "AND CATEGORY_FILTER = ?"
+        params.append(category)
+    query = f"""
+    SELECT DATE_TRUNC('{grain}', TIMESTAMP) AS PERIOD,
+           MODEL_USED,
+           COUNT(*) AS INTERACTIONS,
+           APPROX_PERCENTILE(RESPONSE_TIME_MS, 0.5) AS P50_MS,
+           APPROX_PERCENTILE(RESPONSE_TIME_MS, 0.95) AS P95_MS,
+           APPROX_PERCENTILE(RESPONSE_TIME_MS, 0.99) AS P99_MS
+    FROM {CHAT_HISTORY_TABLE}
+    WHERE TIMESTAMP >= DATEADD(day, -?, CURRENT_TIMESTAMP())
+    {category_clause}
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    """
+    return run_aggregate(query, params)
+
+@st.cache_data(ttl=DASHBOARD_CACHE_TTL_SECONDS, show_spinner=False)
+def get_model_category_summary(days):
+    """Latency percentiles, thumbs-down rate and hallucination rate per model and category"""
+    query = f"""
+    SELECT MODEL_USED,
+           CATEGORY_FILTER,
+           COUNT(*) AS INTERACTIONS,
+           APPROX_PERCENTILE(RESPONSE_TIME_MS, 0.5) AS P50_MS,
+           APPROX_PERCENTILE(RESPONSE_TIME_MS, 0.95) AS P95_MS,
+           APPROX_PERCENTILE(RESPONSE_TIME_MS, 0.99) AS P99_MS,
+           COUNT_IF(RESPONSE_QUALITY IS NOT NULL) AS RATED,
+           (COUNT_IF(RESPONSE_QUALITY = 'bad') / NULLIF(COUNT_IF(RESPONSE_QUALITY IS NOT NULL), 0))::FLOAT AS THUMBS_DOWN_RATE,
+           (COUNT_IF(IS_HALLUCINATION = 'Yes') / COUNT(*))::FLOAT AS HALLUCINATION_RATE
+    FROM {CHAT_HISTORY_TABLE}
+    WHERE TIMESTAMP >= DATEADD(day, -?, CURRENT_TIMESTAMP())
+    GROUP BY 1, 2
+    ORDER BY INTERACTIONS DESC
+    """
+    return run_aggregate(query, [days])
+
+@st.cache_data(ttl=DASHBOARD_CACHE_TTL_SECONDS, show_spinner=False)
+def get_quality_over_time(days, grain):
+    """Thumbs-down and hallucination rates per period"""
+    if grain not in TIME_GRAINS:
+        raise ValueError(f"Unsupported time grain: {grain}")
+    query = f"""
+    SELECT DATE_TRUNC('{grain}', TIMESTAMP) AS PERIOD,
+           (COUNT_IF(RESPONSE_QUALITY = 'bad') / NULLIF(COUNT_IF(RESPONSE_QUALITY IS NOT NULL), 0))::FLOAT AS THUMBS_DOWN_RATE,
+           (COUNT_IF(IS_HALLUCINATION = 'Yes') / COUNT(*))::FLOAT AS HALLUCINATION_RATE
+    FROM {CHAT_HISTORY_TABLE}
+    WHERE TIMESTAMP >= DATEADD(day, -?, CURRENT_TIMESTAMP())
+    GROUP BY 1
+    ORDER BY 1
+    """
+    return run_aggregate(query, [days])
+
+@st.cache_data(ttl=DASHBOARD_CACHE_TTL_SECONDS, show_spinner=False)
+def get_stage_latency(days):
+    """Percentiles per pipeline stage from the STAGE_TIMINGS breakdown"""
+    query = f"""
+    SELECT f.KEY AS STAGE,
+           COUNT(*) AS SAMPLES,
+           APPROX_PERCENTILE(f.VALUE::FLOAT, 0.5) AS P50_MS,
+           APPROX_PERCENTILE(f.VALUE::FLOAT, 0.95) AS P95_MS,
+           APPROX_PERCENTILE(f.VALUE::FLOAT, 0.99) AS P99_MS
+    FROM {CHAT_HISTORY_TABLE},
+         LATERAL FLATTEN(input => TRY_PARSE_JSON({STAGE_TIMINGS_COLUMN})) f
+    WHERE TIMESTAMP >= DATEADD(day, -?, CURRENT_TIMESTAMP())
+    GROUP BY 1
+    ORDER BY P95_MS DESC
+    """
+    return run_aggregate(query, [days])
+
+### Page
+
+def main():
+    st.title("Procurement GPT Performance")
+    if not is_dashboard_admin():
+        st.warning("This page is restricted to Procurement GPT administrators.")
+        return
+    st.caption(f"Aggregated from {CHAT_HISTORY_TABLE}; figures refresh every {DASHBOARD_CACHE_TTL_SECONDS // 60} minutes")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        days = st.selectbox("**Lookback (days)**", LOOKBACK_DAYS_OPTIONS, index=1)
+    with col2:
+        grain = st.selectbox("**Time grain**", TIME_GRAINS, index=1)
+
+    try:
+        schema = migrate_chat_history_schema()
+        summary = get_model_category_summary(days)
+    except NotImplementedError:
+        st.info("The performance dashboard needs the Snowflake backend; it is not available in local mode.")
+        return
+    except Exception as e:
+        st.error(f"Error loading chat history metrics: {str(e)}")
+        return
+
+    if summary.empty:
+        st.info("No interactions recorded in this period.")
+        return
+
+    total = summary["INTERACTIONS"].sum()
+    rated = summary["RATED"].sum()
+    thumbs_down = (summary["THUMBS_DOWN_RATE"].fillna(0) * summary["RATED"]).sum()
+    hallucinations = (summary["HALLUCINATION_RATE"] * summary["INTERACTIONS"]).sum()
+    metric1, metric2, metric3 = st.columns(3)
+    metric1.metric("Interactions", f"{total:,}")
+    metric2.metric("Thumbs-down rate", f"{thumbs_down / rated:.1%}" if rated else "n/a")
+    metric3.metric("Hallucination rate", f"{hallucinations / total:.1%}")
+
+    st.subheader("Response time by model over time")
+    categories = ["ALL categories"] + sorted(summary["CATEGORY_FILTER"].dropna().unique().tolist())
+    category = st.selectbox("**Category filter**", categories)
+    try:
+        latency = get_latency_over_time(days, grain, None if category == "ALL categories" else category)
+        percentile = st.radio("Percentile", ("P50_MS", "P95_MS", "P99_MS"), index=1, horizontal=True)
+        if not latency.empty:
+            st.line_chart(latency.pivot(index="PERIOD", columns="MODEL_USED", values=percentile))
+    except Exception as e:
+        st.error(f"Error loading latency trend: {str(e)}")
+
+    st.subheader("By model and category")
+    st.dataframe(summary, use_container_width=True, hide_index=True)
+
+    st.subheader("Feedback rates over time")
+    try:
+        quality = get_quality_over_time(days, grain)
+        if not quality.empty:
+            st.line_chart(quality.set_index("PERIOD")[["THUMBS_DOWN_RATE", "HALLUCINATION_RATE"]])
+    except Exception as e:
+        st.error(f"Error loading feedback trend: {str(e)}")
+
+    if schema.has(STAGE_TIMINGS_COLUMN):
+        st.subheader("Latency by pipeline stage")
+        try:
+            st.dataframe(get_stage_latency(days), use_container_width=True, hide_index=True)
+        except Exception as e:
+            st.error(f"Error loading stage timings: {str(e)}")
+
+main()
@@ -0,0 +1,75 @@
+import streamlit as st # Import python packages
+
+from policy_backend import SnowflakeBackend, get_default_backend
+
+### Shared by the chat app and its pages
+#
+# Only definitions live here: importing this module runs no queries and creates no caches, so
+# DEV_POLICY_GPT_LATEST.py and the pages/ scripts share one backend and one cached schema
+# check instead of re-executing the main script under a second module name.
+
+### Default Values
+SESSION_POOL_SIZE = 4 # Snowpark sessions shared by all users of this app process
+SESSION_HEALTH_CHECK_IDLE_SECONDS = 120 # Sessions idle longer than this are pinged before being reused
+SESSION_CHECKOUT_TIMEOUT_SECONDS = 30 # Give up waiting for a free session after this long
+
+# service parameters
+CORTEX_SEARCH_DATABASE = "POC_POLICY"
+CORTEX_SEARCH_SCHEMA = "PROCUREMENT_POLICY"
+CORTEX_SEARCH_SERVICE = "POLICY_SEARCH_SERVICE"
+CHAT_HISTORY_TABLE = "POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY"
+
+# Per-stage breakdown (JSON) written with each interaction
+STAGE_TIMINGS_COLUMN = "STAGE_TIMINGS"
+
+CHAT_HISTORY_SCHEMA_VERSION = 4 # Bump whenever CHAT_HISTORY_MIGRATED_COLUMNS changes
+
+# Columns added after the table was first created, with their types
+CHAT_HISTORY_MIGRATED_COLUMNS = {
+    "USER_NAME": "STRING",
+    "RESPONSE_QUALITY": "STRING",
+    "IS_HALLUCINATION": "STRING",
+    "REVIEW_FEEDBACK": "STRING",
+    STAGE_TIMINGS_COLUMN: "STRING"
+}
+
+### Backend
+
+def get_connection_parameters():
+    """Snowflake connection settings from st.secrets; None inside Streamlit in Snowflake"""
+    try:
+        return dict(st.secrets["connections"]["snowflake"])
+    except Exception:
+        return None
+
+def get_backend():
+    """Process-wide data/LLM backend: Snowflake, or the offline stand-in when POLICY_GPT_BACKEND=local"""
+    return get_default_backend(lambda: SnowflakeBackend(
+        (CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CORTEX_SEARCH_SERVICE),
+        CHAT_HISTORY_TABLE,
+        connection_parameters=get_connection_parameters(),
+        pool_size=SESSION_POOL_SIZE,
+        health_check_idle_seconds=SESSION_HEALTH_CHECK_IDLE_SECONDS,
+        checkout_timeout_seconds=SESSION_CHECKOUT_TIMEOUT_SECONDS
+    ))
+
+### Chat History Schema
+
+class ChatHistorySchema:
+    """Column capabilities of CHAT_HISTORY, resolved once per process"""
+
+    def __init__(self, version, columns, added_columns):
+        self.version = version
+        self.columns = frozenset(columns)
+        self.added_columns = added_columns
+
+    def has(self, column):
+        return column in self.columns
+
+@st.cache_resource(show_spinner=False)
+def migrate_chat_history_schema():
+    """Create or upgrade CHAT_HISTORY and record its schema version (runs once per process)"""
+    existing_columns, missing_columns = get_backend().migrate_chat_history(
+        CHAT_HISTORY_MIGRATED_COLUMNS, CHAT_HISTORY_SCHEMA_VERSION
+    )
+    return ChatHistorySchema(CHAT_HISTORY_SCHEMA_VERSION, existing_columns, missing_columns)
@@ -0,0 +1,804 @@
+import os
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger("policy_gpt")
+
+### Backends
+#
+# Procurement GPT talks to Snowflake only through a PolicyBackend. SnowflakeBackend is what
+# runs in production; LocalBackend is an in-process stand-in (in-memory CHAT_HISTORY, BM25
+# search over a local chunk set, deterministic Complete with configurable latency) so the app
+# and benchmark_policy_gpt.py can run without a Snowflake account.
+
+STAGE_NAME = "@policy_documents"
+CHUNKS_TABLE = "POLICY_DOCS_CHUNKS"
+DOCUMENT_LINKS_TABLE = "GPT_DOCUMENT_LINKS"
+
+def category_for_path(relative_path):
+    """Document category from its file name: the part before the first hyphen (as in cortex_search_starter.sql)"""
+    if '-' not in relative_path:
+        return 'UNCATEGORIZED'
+    return relative_path.split('/')[-1].split('-')[0]
+
+class PolicyBackend:
+    """Everything the app needs from the warehouse, search service and LLM"""
+
+    # Search / LLM
+    def search(self, query, columns, filter=None, limit=10):
+        """Cortex Search results as a list of dicts with the requested columns"""
+        raise NotImplementedError
+
+    def complete(self, model, prompt, options=None):
+        raise NotImplementedError
+
+    def complete_stream(self, model, prompt, options=None):
+        """Yield the completion in pieces as they are generated"""
+        raise NotImplementedError
+
+    def embed_text(self, model, text):
+        raise NotImplementedError
+
+    def search_service_version(self):
+        """Identifier of the index the search service is serving; changes on refresh"""
+        raise NotImplementedError
+
+    # Corpus
+    def list_stage_documents(self):
+        """[{name, md5, last_modified}] for every file on the document stage"""
+        raise NotImplementedError
+
+    def list_categories(self):
+        raise NotImplementedError
+
+    def load_chunks(self, embedding_model=None):
+        """Every chunk (chunk, chunk_index, relative_path, category), with an "embedding" if a model is given"""
+        raise NotImplementedError
+
+    def chunks_version(self):
+        """Fingerprint of the current POLICY_DOCS_CHUNKS contents; changes whenever chunks are re-ingested"""
+        raise NotImplementedError
+
+    def get_presigned_urls(self, paths, expiry_seconds):
+        """{relative_path: url} for the paths that exist on the stage"""
+        raise NotImplementedError
+
+    def get_document_links(self, paths):
+        """{relative_path: {document_name, link}} from GPT_DOCUMENT_LINKS"""
+        raise NotImplementedError
+
+    def current_user(self):
+        raise NotImplementedError
+
+    # Chat history
+    def migrate_chat_history(self, migrated_columns, schema_version):
+        """Create/upgrade CHAT_HISTORY; returns (all column names, columns added now)"""
+        raise NotImplementedError
+
+    def insert_chat_history(self, columns, rows):
+        """Insert rows (lists of values in column order) in one statement"""
+        raise NotImplementedError
+
+    def merge_chat_feedback(self, columns, rows):
+        """rows: [(interaction_id, [values in column order])]; None leaves a column unchanged"""
+        raise NotImplementedError
+
+    def get_chat_feedback(self, interaction_id, columns):
+        """{column: value} for one interaction, or {} if it isn't stored"""
+        raise NotImplementedError
+
+    def model_feedback_stats(self, lookback_days):
+        """{model: {interactions, p50_ms, p95_ms, rated, thumbs_down_rate}} over recent CHAT_HISTORY"""
+        raise NotImplementedError
+
+    def chat_history_export(self, lookback_days):
+        """Recent CHAT_HISTORY rows as dicts (upper-case column names), ordered by user then time"""
+        raise NotImplementedError
+
+    def run_sql(self, query, params=None):
+        """Ad-hoc SQL, for the pieces that only make sense against a real warehouse"""
+        raise NotImplementedError
+
+### Snowflake
+
+# Connector errnos that mean the session itself is gone rather than that one statement failed:
+# can't connect, connection closed, request failed, session expired or no longer exists
+SESSION_ERRNOS = {250001, 250002, 250003, 390111, 390112, 390114}
+
+def is_session_error(error):
+    """True if error leaves a Snowpark session unusable (as opposed to a failed SQL statement)"""
+    if isinstance(error, ConnectionError) or getattr(error, "errno", None) in SESSION_ERRNOS:
+        return True
+    try:
+        from snowflake.connector.errors import InterfaceError, OperationalError
+        from snowflake.snowpark.exceptions import SnowparkSessionException
+    except ImportError:
+        return False
+    return isinstance(error, (InterfaceError, OperationalError, SnowparkSessionException))
+
+class SessionPool:
+    """Fixed-size pool of Snowpark sessions, checked out per request.
+
+    Inside Streamlit in Snowflake there is only the active session (owns_sessions=False); a
+    pool of one shared session adds no concurrency, so checkouts are then neither bounded nor
+    queued and simply hand out the factory's session.
+    """
+
+    def __init__(self, factory, size, health_check_idle_seconds, checkout_timeout_seconds, owns_sessions=True):
+        self.factory = factory
+        self.size = size
+        self.health_check_idle_seconds = health_check_idle_seconds
+        self.checkout_timeout_seconds = checkout_timeout_seconds
+        self.owns_sessions = owns_sessions
+        self._idle = [] # (session, last used), most recently used last
+        self._created = 0
+        self._search_services = {}
+        self._lock = threading.Lock()
+        # Signalled whenever a session is returned or a slot is freed by a discard
+        self._available = threading.Condition(self._lock)
+
+    @contextmanager
+    def checkout(self):
+        """Borrow a session for the duration of the with-block.
+
+        A failed statement (e.g. a ProgrammingError) returns the session to the pool; only errors
+        that leave the session itself unusable discard it.
+        """
+        if not self.owns_sessions:
+            yield self.factory()
+            return
+        pooled_session = self._acquire()
+        try:
+            yield pooled_session
+        except Exception as e:
+            if is_session_error(e):
+                logger.warning("Discarding pooled Snowflake session after a connection error: %s", e)
+                self._discard(pooled_session)
+            else:
+                self._release(pooled_session)
+            raise
+        except BaseException:
+            self._release(pooled_session)
+            raise
+        self._release(pooled_session)
+
+    def search_service(self, pooled_session, database, schema, service_name):
+        """Cortex Search handle bound to the given pooled session"""
+        from snowflake.core import Root
+
+        with self._lock:
+            service = self._search_services.get(id(pooled_session))
+            if service is None:
+                service = Root(pooled_session).databases[database].schemas[schema].cortex_search_services[service_name]
+                self._search_services[id(pooled_session)] = service
+            return service
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.checkout_timeout_seconds
+        while True:
+            with self._available:
+                while not self._idle and self._created >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No Snowflake session free after {self.checkout_timeout_seconds}s")
+                    self._available.wait(remaining)
+                if self._idle:
+                    pooled_session, last_used = self._idle.pop()
+                else:
+                    pooled_session = None
+                    self._created += 1
+
+            if pooled_session is None:
+                return self._create()
+            if time.monotonic() - last_used < self.health_check_idle_seconds or self._is_healthy(pooled_session):
+                return pooled_session
+            logger.warning("Discarding unhealthy pooled Snowflake session")
+            self._discard(pooled_session)
+
+    def _create(self):
+        try:
+            return self.factory()
+        except BaseException:
+            with self._available:
+                self._created -= 1
+                self._available.notify()
+            raise
+
+    def _is_healthy(self, pooled_session):
+        try:
+            pooled_session.sql("SELECT 1").collect()
+            return True
+        except Exception:
+            return False
+
+    def _release(self, pooled_session):
+        with self._available:
+            self._idle.append((pooled_session, time.monotonic()))
+            self._available.notify()
+
+    def _discard(self, pooled_session):
+        with self._available:
+            self._created -= 1
+            self._search_services.pop(id(pooled_session), None)
+            # The freed slot lets a waiting checkout create a replacement session
+            self._available.notify()
+        if self.owns_sessions:
+            try:
+                pooled_session.close()
+            except Exception:
+                pass
+
+class SnowflakeBackend(PolicyBackend):
+    """Snowpark/Cortex implementation over a SessionPool"""
+
+    def __init__(self, search_service, chat_history_table, connection_parameters=None,
+                 pool_size=4, health_check_idle_seconds=120, checkout_timeout_seconds=30):
+        from snowflake.snowpark import Session
+        from snowflake.snowpark.context import get_active_session
+
+        self.search_database, self.search_schema, self.search_service_name = search_service
+        self.chat_history_table = chat_history_table
+        if connection_parameters:
+            self.pool = SessionPool(
+                lambda: Session.builder.configs(connection_parameters).create(),
+                pool_size,
+                health_check_idle_seconds,
+                checkout_timeout_seconds
+            )
+        else:
+            self.pool = SessionPool(
+                get_active_session,
+                pool_size,
+                health_check_idle_seconds,
+                checkout_timeout_seconds,
+                owns_sessions=False
+            )
+
+    def run_sql(self, query, params=None):
+        with self.pool.checkout() as pooled_session:
+            return pooled_session.sql(query, params=params).collect()
+
+    def search(self, query, columns, filter=None, limit=10):
+        with self.pool.checkout() as pooled_session:
+            service = self.pool.search_service(
+                pooled_session, self.search_database, self.search_schema, self.search_service_name
+            )
+            if filter:
+                response = service.search(query, columns, filter=filter, limit=limit)
+            else:
+                response = service.search(query, columns, limit=limit)
+            return response.results
+
+    def complete(self, model, prompt, options=None):
+        from snowflake.cortex import Complete
+
+        with self.pool.checkout() as pooled_session:
+            return Complete(model, prompt, options=options, session=pooled_session)
+
+    def complete_stream(self, model, prompt, options=None):
+        from snowflake.cortex import Complete
+
+        # The request is sent when Complete returns; the slot is free again while tokens are read
+        with self.pool.checkout() as pooled_session:
+            tokens = Complete(model, prompt, options=options, session=pooled_session, stream=True)
+        yield from tokens
+
+    def embed_text(self, model, text):
+        result = self.run_sql("SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768(?, ?) AS EMBEDDING", params=[model, text])
+        return [float(value) for value in result[0]['EMBEDDING']]
+
+    def search_service_version(self):
+        describe_sql = f"DESCRIBE CORTEX SEARCH SERVICE {self.search_database}.{self.search_schema}.{self.search_service_name}"
+        result = self.run_sql(describe_sql)
+        return str(result[0].as_dict().get('data_timestamp')) if result else None
+
+    def list_stage_documents(self):
+        docs_available = self.run_sql(f"ls {STAGE_NAME}")
+        return [
+            {"name": doc["name"], "md5": doc["md5"], "last_modified": doc["last_modified"]}
+            for doc in docs_available
+        ]
+
+    def list_categories(self):
+        categories = self.run_sql(f"SELECT DISTINCT CATEGORY FROM {CHUNKS_TABLE}")
+        return [cat.CATEGORY for cat in categories]
+
+    def load_chunks(self, embedding_model=None):
+        # Embedding the corpus costs one EMBED_TEXT_768 call per chunk, so callers load once per corpus version
+        embedding_column = ", SNOWFLAKE.CORTEX.EMBED_TEXT_768(?, CHUNK) AS EMBEDDING" if embedding_model else ""
+        rows = self.run_sql(
+            f"SELECT CHUNK, CHUNK_INDEX, RELATIVE_PATH, CATEGORY{embedding_column} FROM {CHUNKS_TABLE}",
+            params=[embedding_model] if embedding_model else None
+        )
+        chunks = []
+        for row in rows:
+            chunk = {
+                "chunk": row['CHUNK'],
+                "chunk_index": row['CHUNK_INDEX'],
+                "relative_path": row['RELATIVE_PATH'],
+                "category": row['CATEGORY']
+            }
+            if embedding_model:
+                chunk["embedding"] = [float(value) for value in row['EMBEDDING']]
+            chunks.append(chunk)
+        return chunks
+
+    def chunks_version(self):
+        # HASH_AGG reads the table but returns one row, far cheaper than reloading (or re-embedding) the chunks
+        rows = self.run_sql(
+            f"SELECT COUNT(*) AS CHUNKS, HASH_AGG(RELATIVE_PATH, CHUNK_INDEX, CHUNK, CATEGORY) AS CONTENT_HASH FROM {CHUNKS_TABLE}"
+        )
+        return f"{rows[0]['CHUNKS']}-{rows[0]['CONTENT_HASH']}"
+
+    def get_presigned_urls(self, paths, expiry_seconds):
+        placeholders = ','.join(['?' for _ in paths])
+        url_sql = f"""
+        SELECT RELATIVE_PATH,
+               GET_PRESIGNED_URL({STAGE_NAME}, RELATIVE_PATH, {int(expiry_seconds)}) AS URL_LINK
+        FROM DIRECTORY({STAGE_NAME})
+        WHERE RELATIVE_PATH IN ({placeholders})
+        """
+        result = self.run_sql(url_sql, params=list(paths))
+        return {row['RELATIVE_PATH']: row['URL_LINK'] for row in result}
+
+    def get_document_links(self, paths):
+        paths_list = list(paths)
+        placeholders = ','.join(['?' for _ in paths_list])
+        links_sql = f"""
+        SELECT DISTINCT
+            A.RELATIVE_PATH,
+            B.DOCUMENT_NAME,
+            B.LINK
+        FROM {CHUNKS_TABLE} A
+        INNER JOIN {DOCUMENT_LINKS_TABLE} B
+            ON A.RELATIVE_PATH = SUBSTRING(B.DOCUMENT_NAME, POSITION('/' IN B.DOCUMENT_NAME) + 1)
+        WHERE A.RELATIVE_PATH IN ({placeholders})
+        """
+        result = self.run_sql(links_sql, params=paths_list)
+        return {
+            row['RELATIVE_PATH']: {'document_name': row['DOCUMENT_NAME'], 'link': row['LINK']}
+            for row in result
+        }
+
+    def current_user(self):
+        result = self.run_sql("SELECT CURRENT_USER()")
+        return result[0][0]
+
+    def migrate_chat_history(self, migrated_columns, schema_version):
+        # Create table if it doesn't exist
+        create_table_sql = f"""
+        CREATE TABLE IF NOT EXISTS {self.chat_history_table} (
+            INTERACTION_ID STRING DEFAULT UUID_STRING(),
+            TIMESTAMP TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
+            USER_QUESTION STRING,
+            AI_RESPONSE STRING,
+            MODEL_USED STRING,
+            CATEGORY_FILTER STRING,
+            SOURCE_DOCUMENTS STRING,
+            RESPONSE_TIME_MS INTEGER,
+            {', '.join(f"{column} {column_type}" for column, column_type in migrated_columns.items())}
+        )
+        """
+        try:
+            self.run_sql(create_table_sql)
+        except Exception as e:
+            # A role that can only INSERT still writes to a table created by its owner
+            logger.warning("Could not create %s: %s", self.chat_history_table, e)
+
+        # One introspection query for every column plus the recorded schema version
+        database, schema, table = self.chat_history_table.split('.')
+        introspect_sql = f"""
+        SELECT c.COLUMN_NAME, t.COMMENT
+        FROM {database}.INFORMATION_SCHEMA.COLUMNS c
+        JOIN {database}.INFORMATION_SCHEMA.TABLES t
+          ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+        WHERE c.TABLE_SCHEMA = ?
+        AND c.TABLE_NAME = ?
+        """
+        result = self.run_sql(introspect_sql, params=[schema, table])
+        existing_columns = {row['COLUMN_NAME'] for row in result}
+        table_comment = result[0]['COMMENT'] if result else None
+
+        # Add every missing column in a single ALTER; without the privilege, write the columns that exist
+        missing_columns = [column for column in migrated_columns if column not in existing_columns]
+        added_columns = []
+        if missing_columns:
+            alter_table_sql = f"""
+            ALTER TABLE {self.chat_history_table}
+            ADD COLUMN {', '.join(f"{column} {migrated_columns[column]}" for column in missing_columns)}
+            """
+            try:
+                self.run_sql(alter_table_sql)
+                existing_columns.update(missing_columns)
+                added_columns = missing_columns
+            except Exception as e:
+                logger.warning("Could not add %s to %s, storing chat history without them: %s",
+                               ", ".join(missing_columns), self.chat_history_table, e)
+
+        # The version marker is informational: it never replaces a comment someone else wrote,
+        # is only recorded once the schema is complete, and needs a privilege the app may lack
+        version_comment = f"schema_version={schema_version}"
+        owns_comment = not table_comment or table_comment.startswith("schema_version=")
+        if table_comment != version_comment and owns_comment and len(added_columns) == len(missing_columns):
+            try:
+                self.run_sql(f"COMMENT ON TABLE {self.chat_history_table} IS '{version_comment}'")
+            except Exception as e:
+                logger.info("Could not record %s on %s: %s", version_comment, self.chat_history_table, e)
+
+        return existing_columns, added_columns
+
+    def insert_chat_history(self, columns, rows):
+        row_placeholder = "(" + ", ".join(["?"] * len(columns)) + ")"
+        insert_sql = f"""
+        INSERT INTO {self.chat_history_table}
+        ({', '.join(columns)})
+        VALUES {', '.join([row_placeholder] * len(rows))}
+        """
+        self.run_sql(insert_sql, params=[value for row in rows for value in row])
+
+    def merge_chat_feedback(self, columns, rows):
+        row_placeholder = "(" + ", ".join(["?"] * (len(columns) + 1)) + ")"
+        params = []
+        for interaction_id, values in rows:
+            params.append(interaction_id)
+            params.extend(values)
+
+        source_columns = ", ".join(f"column{i + 2} AS {column}" for i, column in enumerate(columns))
+        set_clause = ", ".join(f"{column} = COALESCE(s.{column}, t.{column})" for column in columns)
+        merge_sql = f"""
+        MERGE INTO {self.chat_history_table} t
+        USING (
+            SELECT column1 AS INTERACTION_ID, {source_columns}
+            FROM VALUES {', '.join([row_placeholder] * len(rows))}
+        ) s
+        ON t.INTERACTION_ID = s.INTERACTION_ID
+        WHEN MATCHED THEN UPDATE SET {set_clause}
+        """
+        self.run_sql(merge_sql, params=params)
+
+    def get_chat_feedback(self, interaction_id, columns):
+        check_sql = f"""
+        SELECT {', '.join(columns)}
+        FROM {self.chat_history_table}
+        WHERE INTERACTION_ID = ?
+        """
+        result = self.run_sql(check_sql, params=[interaction_id])
+        return result[0].as_dict() if result else {}
+
+    def model_feedback_stats(self, lookback_days):
+        stats_sql = f"""
+        SELECT MODEL_USED,
+               COUNT(*) AS INTERACTIONS,
+               APPROX_PERCENTILE(RESPONSE_TIME_MS, 0.5) AS P50_MS,
+               APPROX_PERCENTILE(RESPONSE_TIME_MS, 0.95) AS P95_MS,
+               COUNT_IF(RESPONSE_QUALITY IS NOT NULL) AS RATED,
+               (COUNT_IF(RESPONSE_QUALITY = 'bad') / NULLIF(COUNT_IF(RESPONSE_QUALITY IS NOT NULL), 0))::FLOAT AS THUMBS_DOWN_RATE
+        FROM {self.chat_history_table}
+        WHERE TIMESTAMP >= DATEADD(day, -?, CURRENT_TIMESTAMP())
+        GROUP BY MODEL_USED
+        """
+        return {
+            row['MODEL_USED']: {
+                "interactions": row['INTERACTIONS'],
+                "p50_ms": row['P50_MS'],
+                "p95_ms": row['P95_MS'],
+                "rated": row['RATED'],
+                "thumbs_down_rate": row['THUMBS_DOWN_RATE']
+            }
+            for row in self.run_sql(stats_sql, params=[lookback_days])
+        }
+
+    def chat_history_export(self, lookback_days):
+        export_sql = f"""
+        SELECT INTERACTION_ID, TIMESTAMP, USER_NAME, USER_QUESTION, AI_RESPONSE, MODEL_USED,
+               CATEGORY_FILTER, SOURCE_DOCUMENTS, RESPONSE_TIME_MS,
+               RESPONSE_QUALITY, IS_HALLUCINATION, REVIEW_FEEDBACK
+        FROM {self.chat_history_table}
+        WHERE TIMESTAMP >= DATEADD(day, -?, CURRENT_TIMESTAMP())
+        ORDER BY USER_NAME, TIMESTAMP
+        """
+        return [row.as_dict() for row in self.run_sql(export_sql, params=[lookback_days])]
+
+### Local stand-in
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class Bm25Index:
+    """Small pure-Python BM25 over a list of chunk dicts"""
+
+    def __init__(self, chunks, k1=1.2, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(tokenize(chunk['chunk'])) for chunk in chunks]
+        self.doc_lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_doc_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if chunks else 0.0
+        doc_freqs = Counter(term for tf in self.term_freqs for term in tf)
+        n = len(chunks)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()}
+
+    def top_k(self, query, limit, category=None):
+        return [chunk for _, chunk in self.scored(query, limit, category)]
+
+    def scored(self, query, limit, category=None):
+        """[(bm25 score, chunk)] for the best matches, highest first"""
+        terms = [term for term in tokenize(query) if term in self.idf]
+        scored = []
+        for i, tf in enumerate(self.term_freqs):
+            if category is not None and self.chunks[i].get('category') != category:
+                continue
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[i] / (self.avg_doc_length or 1.0))
+            score = sum(self.idf[t] * tf[t] * (self.k1 + 1) / (tf[t] + norm) for t in terms if t in tf)
+            if score > 0:
+                scored.append((score, i))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+        return [(score, self.chunks[i]) for score, i in scored[:limit]]
+
+def load_chunks_jsonl(path):
+    """Chunk dicts (chunk, chunk_index, relative_path[, category]) from a JSONL file"""
+    chunks = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                chunk = json.loads(line)
+                chunk.setdefault('category', category_for_path(chunk['relative_path']))
+                chunks.append(chunk)
+    return chunks
+
+def chunk_documents_dir(path, chunk_size=1512, overlap=256):
+    """Fixed-window chunks of every .txt/.md file under a directory"""
+    chunks = []
+    for root_dir, _, files in os.walk(path):
+        for file_name in sorted(files):
+            if not file_name.lower().endswith(('.txt', '.md')):
+                continue
+            full_path = os.path.join(root_dir, file_name)
+            relative_path = os.path.relpath(full_path, path).replace(os.sep, '/')
+            with open(full_path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            step = max(chunk_size - overlap, 1)
+            for chunk_index, start in enumerate(range(0, max(len(text), 1), step)):
+                chunks.append({
+                    'chunk': text[start:start + chunk_size],
+                    'chunk_index': chunk_index,
+                    'relative_path': relative_path,
+                    'category': category_for_path(relative_path)
+                })
+                if start + chunk_size >= len(text):
+                    break
+    return chunks
+
+class LocalBackend(PolicyBackend):
+    """In-process stand-in for Snowpark, Cortex Search and Complete.
+
+    Latencies are simulated with sleeps (plus optional jitter), so concurrency behaves like
+    I/O-bound calls against the real services.
+    """
+
+    EMBEDDING_DIMENSIONS = 768
+
+    def __init__(self, chunks, complete_latency_seconds=0.8, stream_tokens_per_second=50.0,
+                 search_latency_seconds=0.15, sql_latency_seconds=0.05, jitter=0.2, seed=0):
+        self.chunks = chunks
+        self.index = Bm25Index(chunks)
+        self.complete_latency_seconds = complete_latency_seconds
+        self.stream_tokens_per_second = stream_tokens_per_second
+        self.search_latency_seconds = search_latency_seconds
+        self.sql_latency_seconds = sql_latency_seconds
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._chat_history = {}
+        self._chat_history_lock = threading.Lock()
+        self._modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+
+    @classmethod
+    def from_env(cls):
+        """Build from POLICY_GPT_LOCAL_CHUNKS (JSONL) or POLICY_GPT_LOCAL_DOCS (directory of .txt/.md)"""
+        if os.environ.get("POLICY_GPT_LOCAL_CHUNKS"):
+            chunks = load_chunks_jsonl(os.environ["POLICY_GPT_LOCAL_CHUNKS"])
+        elif os.environ.get("POLICY_GPT_LOCAL_DOCS"):
+            chunks = chunk_documents_dir(os.environ["POLICY_GPT_LOCAL_DOCS"])
+        else:
+            raise ValueError("Set POLICY_GPT_LOCAL_CHUNKS or POLICY_GPT_LOCAL_DOCS to use the local backend")
+        latency_ms = float(os.environ.get("POLICY_GPT_LOCAL_COMPLETE_LATENCY_MS", "800"))
+        return cls(chunks, complete_latency_seconds=latency_ms / 1000)
+
+    def _sleep(self, seconds):
+        if seconds <= 0:
+            return
+        with self._random_lock:
+            factor = 1 + self._random.uniform(-self.jitter, self.jitter)
+        time.sleep(seconds * factor)
+
+    # Search / LLM
+
+    def search(self, query, columns, filter=None, limit=10):
+        self._sleep(self.search_latency_seconds)
+        category = filter["@eq"]["category"] if filter else None
+        # Scores are reported the way Cortex Search does, under "@scores"
+        return [
+            dict({column: chunk.get(column) for column in columns}, **{"@scores": {"text_match": score}})
+            for score, chunk in self.index.scored(query, limit, category)
+        ]
+
+    def _fake_answer(self, model, prompt):
+        # Deterministic: the same model and prompt always give the same text
+        context = prompt.split("<context>")[-1].split("</context>")[0] if "<context>" in prompt else prompt
+        words = tokenize(context)[:60]
+        digest = hashlib.sha1(f"{model}\n{prompt}".encode("utf-8")).hexdigest()[:8]
+        return f"[{model} {digest}] " + " ".join(words)
+
+    def complete(self, model, prompt, options=None):
+        self._sleep(self.complete_latency_seconds)
+        return self._fake_answer(model, prompt)
+
+    def complete_stream(self, model, prompt, options=None):
+        # Time to first token is a fifth of the full latency; the rest streams at a fixed rate
+        self._sleep(self.complete_latency_seconds * 0.2)
+        for i, word in enumerate(self._fake_answer(model, prompt).split(" ")):
+            if i:
+                time.sleep(1 / self.stream_tokens_per_second)
+            yield word if i == 0 else " " + word
+
+    def embed_text(self, model, text):
+        self._sleep(self.sql_latency_seconds)
+        return self._hashed_embedding(text)
+
+    def _hashed_embedding(self, text):
+        # Feature-hashed bag of words: similar questions get similar vectors
+        vector = [0.0] * self.EMBEDDING_DIMENSIONS
+        for token in tokenize(text):
+            digest = int(hashlib.md5(token.encode("utf-8")).hexdigest(), 16)
+            vector[digest % self.EMBEDDING_DIMENSIONS] += 1.0 if (digest >> 64) & 1 else -1.0
+        return vector
+
+    def search_service_version(self):
+        return "local-1"
+
+    # Corpus
+
+    def list_stage_documents(self):
+        self._sleep(self.sql_latency_seconds)
+        paths = sorted({chunk['relative_path'] for chunk in self.chunks})
+        return [
+            {"name": f"policy_documents/{path}",
+             "md5": hashlib.md5("".join(c['chunk'] for c in self.chunks if c['relative_path'] == path).encode("utf-8")).hexdigest(),
+             "last_modified": self._modified}
+            for path in paths
+        ]
+
+    def list_categories(self):
+        self._sleep(self.sql_latency_seconds)
+        return sorted({chunk['category'] for chunk in self.chunks})
+
+    def load_chunks(self, embedding_model=None):
+        self._sleep(self.sql_latency_seconds)
+        chunks = []
+        for chunk in self.chunks:
+            chunk = {column: chunk.get(column) for column in ("chunk", "chunk_index", "relative_path", "category")}
+            if embedding_model:
+                chunk["embedding"] = self._hashed_embedding(chunk["chunk"])
+            chunks.append(chunk)
+        return chunks
+
+    def chunks_version(self):
+        self._sleep(self.sql_latency_seconds)
+        fingerprint = hashlib.md5()
+        for chunk in self.chunks:
+            fingerprint.update(f"{chunk['relative_path']}|{chunk['chunk_index']}|{chunk.get('category')}|{chunk['chunk']}\n".encode("utf-8"))
+        return f"{len(self.chunks)}-{fingerprint.hexdigest()}"
+
+    def get_presigned_urls(self, paths, expiry_seconds):
+        self._sleep(self.sql_latency_seconds)
+        known = {chunk['relative_path'] for chunk in self.chunks}
+        expires = int(time.time() + expiry_seconds)
+        return {path: f"https://local.invalid/{path}?expires={expires}" for path in paths if path in known}
+
+    def get_document_links(self, paths):
+        self._sleep(self.sql_latency_seconds)
+        return {}
+
+    def current_user(self):
+        return "LOCAL_USER"
+
+    # Chat history
+
+    def migrate_chat_history(self, migrated_columns, schema_version):
+        self._sleep(self.sql_latency_seconds)
+        base_columns = {
+            "INTERACTION_ID", "TIMESTAMP", "USER_QUESTION", "AI_RESPONSE", "MODEL_USED",
+            "CATEGORY_FILTER", "SOURCE_DOCUMENTS", "RESPONSE_TIME_MS"
+        }
+        return base_columns | set(migrated_columns), []
+
+    def insert_chat_history(self, columns, rows):
+        self._sleep(self.sql_latency_seconds)
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self._chat_history_lock:
+            for row in rows:
+                record = dict(zip(columns, row))
+                record.setdefault("TIMESTAMP", timestamp)
+                self._chat_history[record["INTERACTION_ID"]] = record
+
+    def merge_chat_feedback(self, columns, rows):
+        self._sleep(self.sql_latency_seconds)
+        with self._chat_history_lock:
+            for interaction_id, values in rows:
+                record = self._chat_history.get(interaction_id)
+                if record is None:
+                    continue
+                for column, value in zip(columns, values):
+                    if value is not None:
+                        record[column] = value
+
+    def get_chat_feedback(self, interaction_id, columns):
+        self._sleep(self.sql_latency_seconds)
+        with self._chat_history_lock:
+            record = self._chat_history.get(interaction_id)
+            return {column: record.get(column) for column in columns} if record else {}
+
+    def model_feedback_stats(self, lookback_days):
+        # Everything in the in-memory table is recent, so the lookback is not applied
+        self._sleep(self.sql_latency_seconds)
+        by_model = {}
+        for record in self.chat_history_rows():
+            by_model.setdefault(record.get("MODEL_USED"), []).append(record)
+        stats = {}
+        for model, records in by_model.items():
+            times = sorted(record.get("RESPONSE_TIME_MS") or 0 for record in records)
+            ratings = [record.get("RESPONSE_QUALITY") for record in records if record.get("RESPONSE_QUALITY")]
+            stats[model] = {
+                "interactions": len(records),
+                "p50_ms": times[(len(times) - 1) // 2],
+                "p95_ms": times[min(int(len(times) * 0.95), len(times) - 1)],
+                "rated": len(ratings),
+                "thumbs_down_rate": ratings.count("bad") / len(ratings) if ratings else None
+            }
+        return stats
+
+    def chat_history_export(self, lookback_days):
+        # As in model_feedback_stats, everything in the in-memory table counts as recent
+        self._sleep(self.sql_latency_seconds)
+        return sorted(self.chat_history_rows(), key=lambda record: (record.get("USER_NAME") or "", record["TIMESTAMP"]))
+
+    def chat_history_rows(self):
+        """Snapshot of the in-memory CHAT_HISTORY table"""
+        with self._chat_history_lock:
+            return [dict(record) for record in self._chat_history.values()]
+
+    def run_sql(self, query, params=None):
+        raise NotImplementedError("LocalBackend does not execute SQL")
+
+### Process-wide backend
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+def set_default_backend(backend):
+    """Install the backend the app should use (e.g. a LocalBackend from a benchmark)"""
+    global _default_backend
+    with _default_backend_lock:
+        _default_backend = backend
+
+def get_default_backend(snowflake_factory):
+    """Process-wide backend, created on first use: local if POLICY_GPT_BACKEND=local, else Snowflake"""
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            if os.environ.get("POLICY_GPT_BACKEND", "snowflake").lower() == "local":
+                _default_backend = LocalBackend.from_env()
+            else:
+                _default_backend = snowflake_factory()
+        return _default_backend
@@ -0,0 +1,162 @@
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark_policy_gpt import percentile
+from policy_app_common import (
+    SESSION_POOL_SIZE, SESSION_HEALTH_CHECK_IDLE_SECONDS, SESSION_CHECKOUT_TIMEOUT_SECONDS,
+    CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CORTEX_SEARCH_SERVICE, CHAT_HISTORY_TABLE
+)
+from policy_backend import LocalBackend, SnowflakeBackend, chunk_documents_dir, load_chunks_jsonl, set_default_backend
+
+logger = logging.getLogger("policy_gpt")
+
+### Batch question answering over the Procurement GPT pipeline
+#
+#   python policy_batch.py faq.jsonl --output answers.jsonl --connection my_conn
+#   python policy_batch.py faq.jsonl --output answers.jsonl --local-docs ./sample_policies
+#
+# Each input line is a JSON object:
+#
+#   {"id": "faq-001", "question": "...", "model": "auto", "category": "ALL",
+#    "history": [{"role": "user", "content": "..."}, {"role": "assistant", "content": "..."}]}
+#
+# Only "question" is required; "id" defaults to the line number, and "model"/"category" to the
+# command-line defaults. Questions go through run_answer_pipeline() on a bounded worker pool in
+# one process, so the retrieval cache, answer cache, local index and session pool are shared by
+# the whole batch. One output line per input line, in input order, with the answer, sources,
+# routed model and per-stage timings; a question that fails is written with its error instead.
+
+APP_MODULE = "DEV_POLICY_GPT_LATEST"
+BATCH_WORKERS = 4 # Questions answered concurrently
+BATCH_USER_NAME = "BATCH_RUN" # USER_NAME on CHAT_HISTORY rows when --store is given
+
+def load_batch(path):
+    """Input records with defaults applied; raises ValueError naming the bad line"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON ({e})")
+            if not isinstance(record, dict) or not str(record.get("question") or "").strip():
+                raise ValueError(f"{path}:{line_number}: missing \"question\"")
+            record.setdefault("id", record.get("request_id") or str(line_number))
+            records.append(record)
+    return records
+
+def answer_record(app, record, args):
+    """One output record for one input record; errors are captured, not raised"""
+    history = record.get("history") or []
+    settings = {
+        "model_name": record.get("model") or args.model,
+        "category": record.get("category") or args.category,
+        "use_chat_history": bool(history),
+        "chat_history": app.trim_chat_history(history),
+        "user_name": BATCH_USER_NAME,
+        "store_conversations": args.store
+    }
+    output = {
+        "id": record["id"],
+        "question": record["question"],
+        "model": settings["model_name"],
+        "category": settings["category"]
+    }
+    try:
+        result = app.run_answer_pipeline(record["question"], settings,
+                                         interaction_id=str(uuid.uuid4()) if args.store else None)
+    except Exception as e:
+        logger.warning("Question %s failed: %s", record["id"], e)
+        return dict(output, error=f"{type(e).__name__}: {e}")
+    return dict(
+        output,
+        answer_model=result["answer_model"],
+        answer=result["response"],
+        sources=sorted(result["relative_paths"]),
+        passages=[{"relative_path": chunk["relative_path"], "chunk_index": chunk["chunk_index"]}
+                  for chunk in result["chunks"]],
+        cached=result["cached"],
+        response_time_ms=result["response_time_ms"],
+        stage_timings=result["stage_timings"],
+        error=None
+    )
+
+def run_batch(app, records, args, output_file):
+    """Answer every record with args.workers threads, writing results in input order as they finish"""
+    results = []
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="policy-batch") as pool:
+        for result in pool.map(lambda record: answer_record(app, record, args), records):
+            output_file.write(json.dumps(result, default=str) + "\n")
+            output_file.flush()
+            results.append(result)
+    return results
+
+def install_backend(app, args):
+    if args.local_docs or args.local_chunks:
+        chunks = load_chunks_jsonl(args.local_chunks) if args.local_chunks else chunk_documents_dir(args.local_docs)
+        set_default_backend(LocalBackend(chunks))
+    elif args.connection:
+        set_default_backend(SnowflakeBackend(
+            (CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CORTEX_SEARCH_SERVICE),
+            CHAT_HISTORY_TABLE,
+            connection_parameters={"connection_name": args.connection},
+            # A question can hold a search and a completion session at the same time
+            pool_size=max(SESSION_POOL_SIZE, args.workers * 2),
+            health_check_idle_seconds=SESSION_HEALTH_CHECK_IDLE_SECONDS,
+            checkout_timeout_seconds=SESSION_CHECKOUT_TIMEOUT_SECONDS
+        ))
+    # Otherwise the app's own backend: st.secrets, the active session, or POLICY_GPT_BACKEND=local
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions through the Procurement GPT pipeline")
+    parser.add_argument("input", help="JSONL file with a \"question\" per line (optional id, model, category, history)")
+    parser.add_argument("--output", required=True, help="JSONL file the answers are written to")
+    parser.add_argument("--model", default="llama3.1-70b", help="Model for records without a \"model\" field")
+    parser.add_argument("--category", default="ALL", help="Category for records without a \"category\" field")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--store", action="store_true", help="Also record the interactions in CHAT_HISTORY")
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument("--connection", help="Connection name from connections.toml")
+    backend.add_argument("--local-docs", help="Answer from this directory of .txt/.md documents with the offline backend")
+    backend.add_argument("--local-chunks", help="Answer from this chunk JSONL file with the offline backend")
+    args = parser.parse_args(argv)
+
+    try:
+        records = load_batch(args.input)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    app = importlib.import_module(APP_MODULE)
+    # Bare mode warns about the missing script run context on every cached call
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+    install_backend(app, args)
+
+    start = time.perf_counter()
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        results = run_batch(app, records, args, output_file)
+    elapsed = time.perf_counter() - start
+    if args.store:
+        app.get_chat_history_writer().flush()
+
+    failed = [result for result in results if result["error"]]
+    latencies = sorted(result["response_time_ms"] for result in results if not result["error"])
+    print(f"{len(results) - len(failed)} answered, {len(failed)} failed in {elapsed:.1f}s "
+          f"(p50 {percentile(latencies, 50):.0f} ms, p95 {percentile(latencies, 95):.0f} ms); "
+          f"{sum(1 for result in results if result.get('cached'))} from the answer cache")
+    for result in failed:
+        print(f"FAILED {result['id']}: {result['error']}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import os
+import json
+import math
+import shutil
+import uuid
+from collections import Counter
+
+import numpy as np
+
+from policy_backend import tokenize
+
+### Compact chunk store
+#
+# Chunks, their embeddings and the BM25 postings as flat arrays instead of per-chunk dicts:
+#
+#   texts.bin             every chunk's UTF-8 text, back to back
+#   text_offsets.npy      int64[n + 1]: chunk i is texts.bin[offsets[i]:offsets[i + 1]]
+#   chunk_index.npy       int32[n]
+#   path_ids.npy          int32[n] into meta.json "paths"
+#   category_ids.npy      int32[n] into meta.json "categories"
+#   embeddings.npy        float32[n, dims], unit length (optional)
+#   doc_lengths.npy       float32[n], BM25 token counts
+#   posting_offsets.npy   int64[terms + 1]: postings of term k are posting_*[offsets[k]:offsets[k + 1]]
+#   posting_ids.npy       int32 chunk ids
+#   posting_freqs.npy     float32 term frequencies
+#   meta.json             count, embedding model, paths, categories, vocabulary (term k at position k)
+#
+# ChunkStore.open() memory-maps the arrays, so every Streamlit worker process on the host shares
+# one page-cache copy and opening a store is near-instant.
+
+META_FILE = "meta.json"
+TEXTS_FILE = "texts.bin"
+ARRAY_NAMES = (
+    "text_offsets", "chunk_index", "path_ids", "category_ids", "doc_lengths",
+    "posting_offsets", "posting_ids", "posting_freqs"
+)
+
+class ChunkStore:
+    """Array-backed chunks; in memory from from_chunks(), memory-mapped from open()"""
+
+    def __init__(self, meta, texts, arrays, embeddings=None):
+        self.meta = meta
+        self.paths = meta["paths"]
+        self.categories = meta["categories"]
+        self.vocabulary = {term: k for k, term in enumerate(meta["vocabulary"])}
+        self.texts = texts
+        self.embeddings = embeddings
+        for name in ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.chunk_index)
+
+    @classmethod
+    def from_chunks(cls, chunks, embedding_model=None):
+        """Build from chunk dicts (chunk, chunk_index, relative_path, category[, embedding])"""
+        paths = sorted({chunk['relative_path'] for chunk in chunks})
+        categories = sorted({chunk.get('category') or '' for chunk in chunks})
+        path_codes = {path: code for code, path in enumerate(paths)}
+        category_codes = {category: code for code, category in enumerate(categories)}
+
+        encoded = [chunk['chunk'].encode("utf-8") for chunk in chunks]
+        text_offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+        text_offsets[1:] = np.cumsum([len(text) for text in encoded])
+
+        # BM25 postings in CSR form
+        postings = {}
+        doc_lengths = np.zeros(len(chunks), dtype=np.float32)
+        for chunk_id, chunk in enumerate(chunks):
+            term_freqs = Counter(tokenize(chunk['chunk']))
+            doc_lengths[chunk_id] = sum(term_freqs.values())
+            for term, freq in term_freqs.items():
+                postings.setdefault(term, []).append((chunk_id, freq))
+        vocabulary = sorted(postings)
+        posting_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        posting_offsets[1:] = np.cumsum([len(postings[term]) for term in vocabulary])
+        flat = [pair for term in vocabulary for pair in postings[term]]
+
+        embeddings = None
+        if chunks and all(chunk.get('embedding') is not None for chunk in chunks):
+            matrix = np.array([chunk['embedding'] for chunk in chunks], dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            embeddings = matrix / np.where(norms == 0, 1, norms)
+
+        meta = {
+            "count": len(chunks),
+            "embedding_model": embedding_model if embeddings is not None else None,
+            "paths": paths,
+            "categories": categories,
+            "vocabulary": vocabulary
+        }
+        arrays = {
+            "text_offsets": text_offsets,
+            "chunk_index": np.array([int(chunk['chunk_index']) for chunk in chunks], dtype=np.int32),
+            "path_ids": np.array([path_codes[chunk['relative_path']] for chunk in chunks], dtype=np.int32),
+            "category_ids": np.array([category_codes[chunk.get('category') or ''] for chunk in chunks], dtype=np.int32),
+            "doc_lengths": doc_lengths,
+            "posting_offsets": posting_offsets,
+            "posting_ids": np.array([chunk_id for chunk_id, _ in flat], dtype=np.int32),
+            "posting_freqs": np.array([freq for _, freq in flat], dtype=np.float32)
+        }
+        return cls(meta, np.frombuffer(b"".join(encoded), dtype=np.uint8), arrays, embeddings)
+
+    @classmethod
+    def open(cls, directory):
+        """Memory-map a store written by save()"""
+        with open(os.path.join(directory, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in ARRAY_NAMES}
+        texts_path = os.path.join(directory, TEXTS_FILE)
+        # np.memmap can't map an empty file
+        texts = np.memmap(texts_path, dtype=np.uint8, mode="r") if os.path.getsize(texts_path) else np.zeros(0, np.uint8)
+        embeddings_path = os.path.join(directory, "embeddings.npy")
+        embeddings = np.load(embeddings_path, mmap_mode="r") if os.path.exists(embeddings_path) else None
+        return cls(meta, texts, arrays, embeddings)
+
+    def save(self, directory):
+        """Write the store to directory atomically; if another process got there first, keep theirs"""
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        staging = os.path.join(parent, f".{os.path.basename(directory)}.{uuid.uuid4().hex}.tmp")
+        os.makedirs(staging)
+        try:
+            with open(os.path.join(staging, META_FILE), "w", encoding="utf-8") as f:
+                json.dump(self.meta, f)
+            with open(os.path.join(staging, TEXTS_FILE), "wb") as f:
+                f.write(np.asarray(self.texts).tobytes())
+            for name in ARRAY_NAMES:
+                np.save(os.path.join(staging, f"{name}.npy"), np.asarray(getattr(self, name)))
+            if self.embeddings is not None:
+                np.save(os.path.join(staging, "embeddings.npy"), np.asarray(self.embeddings))
+            os.rename(staging, directory)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.exists(os.path.join(directory, META_FILE)):
+                raise
+
+    # Record access
+
+    def text(self, chunk_id):
+        return bytes(self.texts[self.text_offsets[chunk_id]:self.text_offsets[chunk_id + 1]]).decode("utf-8")
+
+    def relative_path(self, chunk_id):
+        return self.paths[self.path_ids[chunk_id]]
+
+    def category(self, chunk_id):
+        return self.categories[self.category_ids[chunk_id]]
+
+    def record(self, chunk_id, columns):
+        """The chunk as a dict with just the requested columns"""
+        getters = {
+            "chunk": self.text,
+            "chunk_index": lambda i: int(self.chunk_index[i]),
+            "relative_path": self.relative_path,
+            "category": self.category
+        }
+        return {column: getters[column](chunk_id) if column in getters else None for column in columns}
+
+    # BM25 statistics
+
+    def postings(self, term):
+        """(chunk ids, term frequencies) for a term, or None if it never occurs"""
+        k = self.vocabulary.get(term)
+        if k is None:
+            return None
+        start, end = self.posting_offsets[k], self.posting_offsets[k + 1]
+        return self.posting_ids[start:end], self.posting_freqs[start:end]
+
+    def idf(self, term_postings):
+        count = len(self)
+        document_freq = len(term_postings[0])
+        return math.log(1 + (count - document_freq + 0.5) / (document_freq + 0.5))
+
+def store_directory(root, chunks_version, embedding_model):
+    return os.path.join(root, f"{chunks_version}-{embedding_model or 'bm25'}")
+
+def prune_store_directories(root, keep):
+    """Remove stores for older chunk versions (processes that still map them keep working on POSIX)"""
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if path != keep and not name.startswith(".") and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+def open_or_build(root, chunks_version, embedding_model, load_chunks):
+    """Memory-map the store for this chunks version, building it first if no process has yet.
+
+    chunks_version must fingerprint the chunks themselves (PolicyBackend.chunks_version), not the
+    stage listing: files can land on the stage before they are ingested into the chunks table.
+    """
+    directory = store_directory(root, chunks_version, embedding_model)
+    if not os.path.exists(os.path.join(directory, META_FILE)):
+        ChunkStore.from_chunks(load_chunks(), embedding_model).save(directory)
+        prune_store_directories(root, directory)
+    return ChunkStore.open(directory)
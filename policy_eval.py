@@ -0,0 +1,409 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark_policy_gpt import percentile
+from policy_app_common import (
+    SESSION_POOL_SIZE, SESSION_HEALTH_CHECK_IDLE_SECONDS, SESSION_CHECKOUT_TIMEOUT_SECONDS,
+    CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CHAT_HISTORY_TABLE, get_connection_parameters
+)
+from policy_batch import install_backend
+from policy_backend import (LocalBackend, SnowflakeBackend, chunk_documents_dir, load_chunks_jsonl,
+                            set_default_backend, tokenize)
+
+logger = logging.getLogger("policy_gpt")
+
+### Offline evaluation against CHAT_HISTORY feedback
+#
+#   python policy_eval.py export --connection my_conn --days 90 --output gold.jsonl
+#   python policy_eval.py run gold.jsonl --connection my_conn --configs configs.json --output report.json
+#   python policy_eval.py run gold.jsonl --local-docs ./sample_policies      # offline smoke run
+#
+# export turns rated CHAT_HISTORY interactions (RESPONSE_QUALITY, IS_HALLUCINATION or
+# REVIEW_FEEDBACK set) into a frozen gold set. Each item carries the recorded answer and
+# source documents and the user's preceding turns from the same conversation, so
+# slide_window changes are exercised too.
+#
+# run replays the gold set through run_answer_pipeline() once per configuration. A
+# configuration is a JSON object:
+#
+#   {"name": "baseline"}
+#   {"name": "8b", "model": "llama3.1-8b"}
+#   {"name": "wider", "settings": {"NUM_CHUNKS": 5, "MAX_CONTEXT_PASSAGES": 8, "slide_window": 5}}
+#   {"name": "chunks-800", "search_service": "POLICY_SEARCH_SERVICE_800"}   # or "local_chunks": path
+#
+# "settings" overrides app module settings for the run. Chunk size is fixed at ingestion,
+# so it is compared by pointing a configuration at a search service (or chunk file) built
+# with the other size. Without "model", each item is answered by the model that was rated.
+#
+# Quality is reported next to latency and token cost for every configuration:
+#   retrieval_hit_rate   trusted items (rated good, not flagged) whose recorded sources were retrieved again
+#   source_recall        share of those recorded sources retrieved again
+#   answer_f1            token F1 against trusted recorded answers
+#   rejected_overlap     token F1 against answers rated bad or flagged (lower is better)
+#   groundedness         share of answer words that appear in the retrieved context
+# The first configuration is the baseline; the run exits non-zero if another configuration's
+# hit rate or answer F1 falls more than --max-quality-drop below it.
+
+APP_MODULE = "DEV_POLICY_GPT_LATEST"
+EVAL_WORKERS = 4 # Gold items answered concurrently per configuration
+EXPORT_LOOKBACK_DAYS = 90 # CHAT_HISTORY window exported as the gold set
+CONVERSATION_GAP_MINUTES = 30 # A user's earlier turn counts as the same conversation within this gap
+HISTORY_TURNS = 3 # Preceding question/answer pairs kept as an item's chat history
+STORED_RESPONSE_CHARS = 1000 # AI_RESPONSE is truncated to this on insert; replayed answers are cut to match
+GROUNDEDNESS_MIN_WORD_CHARS = 4 # Shorter words (articles, "the", "and") are ignored by groundedness
+MAX_QUALITY_DROP = 0.05 # Allowed drop in hit rate / answer F1 against the baseline configuration
+
+### Gold set export
+
+def parse_timestamp(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S") if isinstance(value, str) else value
+
+def source_names(source_documents):
+    """Document names from a SOURCE_DOCUMENTS value ("name: link | name: link")"""
+    if not source_documents:
+        return []
+    return [part.split(": ", 1)[0].strip() for part in source_documents.split(" | ") if part.strip()]
+
+def is_labelled(row):
+    return any(row.get(column) for column in ("RESPONSE_QUALITY", "IS_HALLUCINATION", "REVIEW_FEEDBACK"))
+
+def build_gold_set(rows):
+    """Gold items from CHAT_HISTORY rows ordered by user then time; the latest rating of a repeated question wins"""
+    items = {}
+    previous = []
+    for row in rows:
+        if previous and (
+            previous[-1].get("USER_NAME") != row.get("USER_NAME")
+            or (parse_timestamp(row["TIMESTAMP"]) - parse_timestamp(previous[-1]["TIMESTAMP"])).total_seconds()
+            > CONVERSATION_GAP_MINUTES * 60
+        ):
+            previous = []
+        if is_labelled(row) and row.get("USER_QUESTION"):
+            history = []
+            for turn in previous[-HISTORY_TURNS:]:
+                history.append({"role": "user", "content": turn["USER_QUESTION"]})
+                history.append({"role": "assistant", "content": turn.get("AI_RESPONSE") or ""})
+            key = (" ".join(row["USER_QUESTION"].lower().split()), row.get("CATEGORY_FILTER"), bool(history))
+            items[key] = {
+                "id": row["INTERACTION_ID"],
+                "timestamp": str(row["TIMESTAMP"]),
+                "question": row["USER_QUESTION"],
+                "category": row.get("CATEGORY_FILTER") or "ALL",
+                "model": row.get("MODEL_USED"),
+                "history": history,
+                "reference_answer": row.get("AI_RESPONSE") or "",
+                "sources": source_names(row.get("SOURCE_DOCUMENTS")),
+                "response_quality": row.get("RESPONSE_QUALITY"),
+                "hallucination": row.get("IS_HALLUCINATION") == "Yes",
+                "review_feedback": row.get("REVIEW_FEEDBACK"),
+                "recorded_response_time_ms": row.get("RESPONSE_TIME_MS")
+            }
+        previous.append(row)
+    return sorted(items.values(), key=lambda item: item["timestamp"])
+
+def load_gold_set(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+### Metrics
+
+def token_f1(answer, reference):
+    answer_tokens = tokenize(answer)
+    reference_tokens = tokenize(reference)
+    if not answer_tokens or not reference_tokens:
+        return 0.0
+    reference_counts = {}
+    for token in reference_tokens:
+        reference_counts[token] = reference_counts.get(token, 0) + 1
+    common = 0
+    for token in answer_tokens:
+        if reference_counts.get(token):
+            reference_counts[token] -= 1
+            common += 1
+    if not common:
+        return 0.0
+    precision = common / len(answer_tokens)
+    recall = common / len(reference_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+def groundedness(answer, chunks):
+    """Share of the answer's content words that occur in the retrieved context"""
+    words = [word for word in tokenize(answer) if len(word) >= GROUNDEDNESS_MIN_WORD_CHARS]
+    if not words:
+        return None
+    context = set(tokenize(" ".join(chunk['chunk'] for chunk in chunks)))
+    return sum(1 for word in words if word in context) / len(words)
+
+def is_trusted(item):
+    return item.get("response_quality") == "good" and not item.get("hallucination")
+
+def is_rejected(item):
+    return item.get("response_quality") == "bad" or item.get("hallucination")
+
+def score_item(item, result):
+    """Per-item metrics; None where the item's labels don't support a metric"""
+    answer = result["response"][:STORED_RESPONSE_CHARS]
+    retrieved = {path.split('/')[-1] for path in result["relative_paths"]}
+    gold_sources = set(item.get("sources") or [])
+    trusted = is_trusted(item)
+    return {
+        "retrieval_hit": (1.0 if retrieved & gold_sources else 0.0) if trusted and gold_sources else None,
+        "source_recall": len(retrieved & gold_sources) / len(gold_sources) if trusted and gold_sources else None,
+        "answer_f1": token_f1(answer, item["reference_answer"]) if trusted and item.get("reference_answer") else None,
+        "rejected_overlap": token_f1(answer, item["reference_answer"]) if is_rejected(item) and item.get("reference_answer") else None,
+        "groundedness": groundedness(result["response"], result["chunks"])
+    }
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+### Replay
+
+CONFIG_KEYS = {"name", "model", "settings", "search_service", "local_chunks", "local_docs"}
+
+def validate_configs(app, configs):
+    """Problems with the configurations (empty if none), found before anything is replayed"""
+    if not isinstance(configs, list) or not configs:
+        return ["configurations must be a non-empty JSON list"]
+    problems = []
+    names = [config.get("name") if isinstance(config, dict) else None for config in configs]
+    for number, config in enumerate(configs, start=1):
+        if not isinstance(config, dict):
+            problems.append(f"configuration {number}: not a JSON object")
+            continue
+        label = config.get("name") or f"configuration {number}"
+        if not config.get("name"):
+            problems.append(f"{label}: missing \"name\"")
+        elif config["name"] in names[:number - 1]:
+            problems.append(f"{label}: duplicate name")
+        for key in sorted(set(config) - CONFIG_KEYS):
+            problems.append(f"{label}: unknown key {key!r}")
+        for name in sorted(config.get("settings") or {}):
+            if not hasattr(app, name):
+                problems.append(f"{label}: unknown app setting {name!r}")
+        for key in ("local_chunks", "local_docs"):
+            if config.get(key) and not os.path.exists(config[key]):
+                problems.append(f"{label}: {key} {config[key]!r} does not exist")
+    return problems
+
+def apply_settings(app, overrides, previous):
+    """Set app module settings, recording each original value in previous as it goes"""
+    for name, value in overrides.items():
+        previous.setdefault(name, getattr(app, name))
+        setattr(app, name, value)
+
+def restore_settings(app, previous):
+    for name, value in previous.items():
+        setattr(app, name, value)
+
+def config_backend(app, config, args):
+    """Backend for a configuration that brings its own corpus or search service, else None"""
+    if config.get("local_chunks") or config.get("local_docs"):
+        return LocalBackend(load_chunks_jsonl(config["local_chunks"]) if config.get("local_chunks")
+                            else chunk_documents_dir(config["local_docs"]))
+    if config.get("search_service"):
+        return SnowflakeBackend(
+            (CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, config["search_service"]),
+            CHAT_HISTORY_TABLE,
+            connection_parameters={"connection_name": args.connection} if args.connection else get_connection_parameters(),
+            pool_size=max(SESSION_POOL_SIZE, args.workers * 2),
+            health_check_idle_seconds=SESSION_HEALTH_CHECK_IDLE_SECONDS,
+            checkout_timeout_seconds=SESSION_CHECKOUT_TIMEOUT_SECONDS
+        )
+    return None
+
+def reset_app_caches(app):
+    """Start each configuration cold: nothing retrieved or answered under another configuration is reused"""
+    app.get_answer_cache.clear()
+    app.get_retrieval_cache.clear()
+    app.get_search_service_version.clear()
+    app.get_local_index_loader.clear()
+    app.invalidate_corpus_cache()
+
+def replay_item(app, item, config):
+    history = item.get("history") or []
+    settings = {
+        # Items exported before MODEL_USED was recorded are routed automatically
+        "model_name": config.get("model") or item.get("model") or app.AUTO_MODEL,
+        "category": item.get("category") or "ALL",
+        "use_chat_history": bool(history),
+        "chat_history": app.trim_chat_history(history),
+        "user_name": None,
+        "store_conversations": False
+    }
+    try:
+        result = app.run_answer_pipeline(item["question"], settings)
+    except Exception as e:
+        logger.warning("Gold item %s failed under %s: %s", item["id"], config["name"], e)
+        return {"id": item["id"], "error": f"{type(e).__name__}: {e}"}
+    return dict(
+        score_item(item, result),
+        id=item["id"],
+        answer_model=result["answer_model"],
+        sources=sorted(result["relative_paths"]),
+        response_time_ms=result["response_time_ms"],
+        prompt_tokens=result["prompt_tokens"],
+        completion_tokens=result["completion_tokens"],
+        stage_timings=result["stage_timings"],
+        error=None
+    )
+
+def summarize(config, results, elapsed):
+    ok = [result for result in results if not result["error"]]
+    latencies = sorted(result["response_time_ms"] for result in ok)
+    stages = {}
+    for result in ok:
+        for stage, elapsed_ms in result["stage_timings"].items():
+            stages.setdefault(stage, []).append(elapsed_ms)
+    return {
+        "name": config["name"],
+        "questions": len(results),
+        "failed": len(results) - len(ok),
+        "retrieval_hit_rate": mean(result["retrieval_hit"] for result in ok),
+        "source_recall": mean(result["source_recall"] for result in ok),
+        "answer_f1": mean(result["answer_f1"] for result in ok),
+        "rejected_overlap": mean(result["rejected_overlap"] for result in ok),
+        "groundedness": mean(result["groundedness"] for result in ok),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "stage_p50_ms": {stage: percentile(sorted(values), 50) for stage, values in sorted(stages.items())},
+        "prompt_tokens_per_question": mean(result["prompt_tokens"] for result in ok),
+        "completion_tokens_per_question": mean(result["completion_tokens"] for result in ok),
+        "total_tokens": sum(result["prompt_tokens"] + result["completion_tokens"] for result in ok),
+        "elapsed_s": elapsed
+    }
+
+def run_configuration(app, gold, config, args):
+    """Replay the gold set under one configuration; returns (summary, per-item results)"""
+    previous_backend = app.get_backend()
+    previous_settings = {}
+    try:
+        apply_settings(app, config.get("settings") or {}, previous_settings)
+        backend = config_backend(app, config, args)
+        if backend is not None:
+            set_default_backend(backend)
+        reset_app_caches(app)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="policy-eval") as pool:
+            results = list(pool.map(lambda item: replay_item(app, item, config), gold))
+        return summarize(config, results, time.perf_counter() - start), results
+    finally:
+        restore_settings(app, previous_settings)
+        set_default_backend(previous_backend)
+
+def find_regressions(summaries, max_drop):
+    """Names of configurations whose hit rate or answer F1 fell more than max_drop below the first one"""
+    baseline = summaries[0]
+    regressed = []
+    for summary in summaries[1:]:
+        for metric in ("retrieval_hit_rate", "answer_f1"):
+            if baseline[metric] is not None and summary[metric] is not None and summary[metric] < baseline[metric] - max_drop:
+                regressed.append(summary["name"])
+                break
+    return regressed
+
+def format_metric(value, pattern="{:.3f}"):
+    return "-" if value is None else pattern.format(value)
+
+def print_report(summaries, regressed):
+    print(f"{'configuration':20} {'n':>4} {'fail':>4} {'hit':>6} {'recall':>6} {'f1':>6} {'reject':>6} "
+          f"{'ground':>6} {'p50 ms':>8} {'p95 ms':>8} {'tok/q':>7}")
+    for summary in summaries:
+        tokens_per_question = (summary["prompt_tokens_per_question"] or 0) + (summary["completion_tokens_per_question"] or 0)
+        print(f"{summary['name'][:20]:20} {summary['questions']:>4} {summary['failed']:>4} "
+              f"{format_metric(summary['retrieval_hit_rate']):>6} {format_metric(summary['source_recall']):>6} "
+              f"{format_metric(summary['answer_f1']):>6} {format_metric(summary['rejected_overlap']):>6} "
+              f"{format_metric(summary['groundedness']):>6} {summary['p50_ms']:>8.0f} {summary['p95_ms']:>8.0f} "
+              f"{tokens_per_question:>7.0f}"
+              + ("  REGRESSED" if summary["name"] in regressed else ""))
+
+### CLI
+
+def import_app(args):
+    app = importlib.import_module(APP_MODULE)
+    # Bare mode warns about the missing script run context on every cached call
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+    install_backend(app, args)
+    return app
+
+def export_command(args):
+    app = import_app(args)
+    gold = build_gold_set(app.get_backend().chat_history_export(args.days))
+    with open(args.output, "w", encoding="utf-8") as f:
+        for item in gold:
+            f.write(json.dumps(item, default=str) + "\n")
+    trusted = sum(1 for item in gold if is_trusted(item))
+    rejected = sum(1 for item in gold if is_rejected(item))
+    print(f"{len(gold)} labelled interactions exported to {args.output} "
+          f"({trusted} trusted, {rejected} rated bad or flagged)")
+    return 0
+
+def run_command(args):
+    gold = load_gold_set(args.gold)
+    if not gold:
+        print(f"{args.gold} has no gold items")
+        return 1
+    if args.configs:
+        with open(args.configs, encoding="utf-8") as f:
+            configs = json.load(f)
+    else:
+        configs = [{"name": "baseline"}]
+
+    app = import_app(args)
+    problems = validate_configs(app, configs)
+    if problems:
+        for problem in problems:
+            print(f"Invalid configuration: {problem}")
+        return 1
+    summaries = []
+    details = {}
+    for config in configs:
+        logger.info("Replaying %d gold items under %s", len(gold), config["name"])
+        summary, results = run_configuration(app, gold, config, args)
+        summaries.append(summary)
+        details[config["name"]] = results
+
+    regressed = find_regressions(summaries, args.max_quality_drop)
+    print_report(summaries, regressed)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"configurations": summaries, "regressed": regressed, "items": details}, f, indent=2, default=str)
+    return 1 if regressed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate Procurement GPT configurations against rated CHAT_HISTORY interactions")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Write rated CHAT_HISTORY interactions to a gold JSONL file")
+    export.add_argument("--output", default="policy_gold.jsonl")
+    export.add_argument("--days", type=int, default=EXPORT_LOOKBACK_DAYS, help="CHAT_HISTORY lookback window")
+
+    run = commands.add_parser("run", help="Replay a gold file under one or more configurations")
+    run.add_argument("gold", help="Gold JSONL file written by export")
+    run.add_argument("--configs", help="JSON list of configurations (default: one baseline run)")
+    run.add_argument("--output", help="Write summaries and per-item results to this JSON file")
+    run.add_argument("--max-quality-drop", type=float, default=MAX_QUALITY_DROP)
+
+    for command in (export, run):
+        command.add_argument("--workers", type=int, default=EVAL_WORKERS)
+        backend = command.add_mutually_exclusive_group()
+        backend.add_argument("--connection", help="Connection name from connections.toml")
+        backend.add_argument("--local-docs", help="Use the offline backend over this directory of .txt/.md documents")
+        backend.add_argument("--local-chunks", help="Use the offline backend over this chunk JSONL file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    return export_command(args) if args.command == "export" else run_command(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
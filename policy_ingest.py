@@ -0,0 +1,623 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from policy_backend import STAGE_NAME, CHUNKS_TABLE, SessionPool, category_for_path, load_chunks_jsonl
+
+logger = logging.getLogger("policy_gpt")
+
+### Incremental ingestion for POLICY_DOCS_CHUNKS
+#
+# cortex_search_starter.sql rebuilds RAW_TEXT and POLICY_DOCS_CHUNKS from every file on the
+# stage. This module keeps a manifest of each file's MD5 and only parses, chunks and
+# categorises files that are new or whose content changed; chunks of files removed from the
+# source are deleted. Documents are parsed on a bounded worker pool, a file that fails is
+# reported and skipped rather than failing the run, and chunks are written in bulk batches.
+#
+#   python policy_ingest.py --connection my_conn                   # sync @policy_documents
+#   python policy_ingest.py --connection my_conn --dry-run         # only report what would change
+#   python policy_ingest.py --connection my_conn --adopt-existing  # first run after a full rebuild
+#   python policy_ingest.py --local-dir ./policies --output chunks.jsonl   # offline, pure Python
+
+MANIFEST_TABLE = "POLICY_DOCS_MANIFEST"
+PARSE_MODE = "LAYOUT" # Same PARSE_DOCUMENT mode as cortex_search_starter.sql
+CHUNK_SIZE = 1512 # Same SPLIT_TEXT_RECURSIVE_CHARACTER settings as cortex_search_starter.sql
+CHUNK_OVERLAP = 256
+CHUNK_SEPARATORS = ["\n\n", "\n", " ", ""]
+INGEST_WORKERS = 4 # Documents parsed concurrently
+INGEST_BATCH_ROWS = 1000 # Chunks buffered before they are written in one transaction
+INSERT_ROWS_PER_STATEMENT = 200 # Rows per multi-row INSERT inside a batch
+SESSION_CHECKOUT_TIMEOUT_SECONDS = 600 # Parsing a large PDF can hold a session for minutes
+SESSION_HEALTH_CHECK_IDLE_SECONDS = 120 # Pooled sessions idle longer than this are pinged before reuse
+
+### Planning
+
+class IngestPlan:
+    """What a sync has to do, by relative path"""
+
+    def __init__(self, new, changed, removed, unchanged):
+        self.new = new
+        self.changed = changed
+        self.removed = removed
+        self.unchanged = unchanged
+
+    @property
+    def to_parse(self):
+        return self.new + self.changed
+
+    def summary(self):
+        return (f"{len(self.new)} new, {len(self.changed)} changed, "
+                f"{len(self.removed)} removed, {len(self.unchanged)} unchanged")
+
+def plan_ingestion(source_files, manifest):
+    """Compare {path: {md5, ...}} in the source with the {path: md5} manifest"""
+    new, changed, unchanged = [], [], []
+    for path in sorted(source_files):
+        if path not in manifest:
+            new.append(path)
+        elif manifest[path] != source_files[path]["md5"]:
+            changed.append(path)
+        else:
+            unchanged.append(path)
+    removed = sorted(path for path in manifest if path not in source_files)
+    return IngestPlan(new, changed, removed, unchanged)
+
+### Pure-Python splitter
+
+def split_text_recursive(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP, separators=CHUNK_SEPARATORS):
+    """Recursive character splitting in the manner of SPLIT_TEXT_RECURSIVE_CHARACTER.
+
+    Splits on the first separator present, merges the pieces back up to chunk_size with
+    overlap carried between chunks, and recurses with the next separator into pieces that are
+    still too long.
+    """
+    separator, remaining = separators[-1], []
+    for i, candidate in enumerate(separators):
+        if candidate == "" or candidate in text:
+            separator, remaining = candidate, separators[i + 1:]
+            break
+
+    pieces = text.split(separator) if separator else list(text)
+    chunks = []
+    short_pieces = []
+    for piece in pieces:
+        if len(piece) < chunk_size:
+            short_pieces.append(piece)
+            continue
+        if short_pieces:
+            chunks.extend(merge_splits(short_pieces, separator, chunk_size, overlap))
+            short_pieces = []
+        if remaining:
+            chunks.extend(split_text_recursive(piece, chunk_size, overlap, remaining))
+        else:
+            chunks.append(piece)
+    if short_pieces:
+        chunks.extend(merge_splits(short_pieces, separator, chunk_size, overlap))
+    return chunks
+
+def merge_splits(pieces, separator, chunk_size, overlap):
+    """Join pieces into chunks of at most chunk_size, starting each chunk with ~overlap chars of the last"""
+    chunks = []
+    current = []
+    total = 0
+    for piece in pieces:
+        joined_length = len(piece) + (len(separator) if current else 0)
+        if current and total + joined_length > chunk_size:
+            chunk = separator.join(current).strip()
+            if chunk:
+                chunks.append(chunk)
+            # Drop pieces from the front until what is left fits the overlap
+            while current and (total > overlap or total + len(piece) + len(separator) > chunk_size):
+                total -= len(current[0]) + (len(separator) if len(current) > 1 else 0)
+                current.pop(0)
+            joined_length = len(piece) + (len(separator) if current else 0)
+        current.append(piece)
+        total += joined_length
+    chunk = separator.join(current).strip()
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+### Sources
+
+class HtmlTextExtractor(HTMLParser):
+    """Visible text of an HTML document, one block per line"""
+
+    SKIPPED_TAGS = {"script", "style", "head"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self._skipping:
+            self._skipping -= 1
+        elif tag in {"p", "div", "li", "h1", "h2", "h3", "h4", "tr", "br"}:
+            self.parts.append("\n\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+    def text(self):
+        return "".join(self.parts)
+
+class LocalDirectorySource:
+    """Documents in a local directory, parsed and split in pure Python"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def refresh(self):
+        pass
+
+    def list_files(self):
+        files = {}
+        for root_dir, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if file_name.startswith("."):
+                    continue
+                full_path = os.path.join(root_dir, file_name)
+                with open(full_path, "rb") as f:
+                    md5 = hashlib.md5(f.read()).hexdigest()
+                stat = os.stat(full_path)
+                files[os.path.relpath(full_path, self.directory).replace(os.sep, "/")] = {
+                    "md5": md5,
+                    "size": stat.st_size,
+                    "last_modified": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(stat.st_mtime))
+                }
+        return files
+
+    def parse(self, path):
+        full_path = os.path.join(self.directory, path)
+        extension = os.path.splitext(path)[1].lower()
+        if extension in (".txt", ".md"):
+            with open(full_path, encoding="utf-8", errors="replace") as f:
+                return f.read()
+        if extension in (".html", ".htm"):
+            extractor = HtmlTextExtractor()
+            with open(full_path, encoding="utf-8", errors="replace") as f:
+                extractor.feed(f.read())
+            return extractor.text()
+        if extension == ".pdf":
+            try:
+                from pypdf import PdfReader
+            except ImportError:
+                raise RuntimeError("pypdf is not installed; PDFs can only be parsed in Snowflake or with pypdf")
+            return "\n\n".join(page.extract_text() or "" for page in PdfReader(full_path).pages)
+        raise ValueError(f"Unsupported file type: {extension or 'no extension'}")
+
+    def load(self, path):
+        """Chunk rows for one document"""
+        return [
+            {"chunk": chunk, "chunk_index": chunk_index}
+            for chunk_index, chunk in enumerate(split_text_recursive(self.parse(path)))
+        ]
+
+class SnowflakeStageSource:
+    """Documents on the policy stage, parsed and split by Cortex on a pooled session per worker"""
+
+    def __init__(self, session_pool, stage=STAGE_NAME):
+        self.session_pool = session_pool
+        self.stage = stage
+
+    def _sql(self, query, params=None):
+        with self.session_pool.checkout() as session:
+            return session.sql(query, params=params).collect()
+
+    def refresh(self):
+        """Pick up files uploaded since the directory table was last refreshed"""
+        self._sql(f"ALTER STAGE {self.stage.lstrip('@')} REFRESH")
+
+    def list_files(self):
+        rows = self._sql(f"SELECT RELATIVE_PATH, MD5, SIZE, LAST_MODIFIED FROM DIRECTORY({self.stage})")
+        return {
+            row['RELATIVE_PATH']: {"md5": row['MD5'], "size": row['SIZE'], "last_modified": row['LAST_MODIFIED']}
+            for row in rows
+        }
+
+    def load(self, path):
+        separators = "[" + ", ".join(repr(separator) for separator in CHUNK_SEPARATORS) + "]"
+        rows = self._sql(f"""
+        SELECT d.SIZE,
+               d.FILE_URL,
+               BUILD_SCOPED_FILE_URL({self.stage}, d.RELATIVE_PATH) AS SCOPED_FILE_URL,
+               c.value::TEXT AS CHUNK,
+               c.INDEX::INTEGER AS CHUNK_INDEX
+        FROM DIRECTORY({self.stage}) d,
+             LATERAL FLATTEN(input => SNOWFLAKE.CORTEX.SPLIT_TEXT_RECURSIVE_CHARACTER(
+                 TO_VARCHAR(SNOWFLAKE.CORTEX.PARSE_DOCUMENT('{self.stage}', d.RELATIVE_PATH, {{'mode': '{PARSE_MODE}'}}):content),
+                 'markdown',
+                 {CHUNK_SIZE},
+                 {CHUNK_OVERLAP},
+                 {separators}
+             )) c
+        WHERE d.RELATIVE_PATH = ?
+        ORDER BY CHUNK_INDEX
+        """, params=[path])
+        return [
+            {
+                "chunk": row['CHUNK'],
+                "chunk_index": row['CHUNK_INDEX'],
+                "size": row['SIZE'],
+                "file_url": row['FILE_URL'],
+                "scoped_file_url": row['SCOPED_FILE_URL']
+            }
+            for row in rows
+        ]
+
+### Chunk stores
+
+class IngestedDocument:
+    """One parsed document waiting to be written"""
+
+    def __init__(self, path, file_info, chunks):
+        self.path = path
+        self.file_info = file_info
+        self.category = category_for_path(path)
+        self.chunks = chunks
+
+class LocalChunkStore:
+    """Chunks in a JSONL file (as read by policy_backend.load_chunks_jsonl) plus a JSON manifest"""
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.manifest_path = output_path + ".manifest.json"
+        self._chunks = {}
+        self._manifest = {}
+        if os.path.exists(output_path):
+            for chunk in load_chunks_jsonl(output_path):
+                self._chunks.setdefault(chunk['relative_path'], []).append(chunk)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self._manifest = json.load(f)
+
+    def ensure_tables(self):
+        pass
+
+    def manifest(self):
+        return {path: entry["md5"] for path, entry in self._manifest.items()}
+
+    def write_batch(self, documents):
+        for document in documents:
+            self._chunks[document.path] = [
+                {
+                    "chunk": chunk["chunk"],
+                    "chunk_index": chunk["chunk_index"],
+                    "relative_path": document.path,
+                    "category": document.category
+                }
+                for chunk in document.chunks
+            ]
+            self._manifest[document.path] = {
+                "md5": document.file_info["md5"],
+                "size": document.file_info["size"],
+                "category": document.category,
+                "chunk_count": len(document.chunks)
+            }
+
+    def remove(self, paths):
+        for path in paths:
+            self._chunks.pop(path, None)
+            self._manifest.pop(path, None)
+
+    def close(self):
+        """Write the chunk file and manifest (once, at the end of the run)"""
+        with open(self.output_path, "w", encoding="utf-8") as f:
+            for path in sorted(self._chunks):
+                for chunk in self._chunks[path]:
+                    f.write(json.dumps(chunk) + "\n")
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f, indent=2, default=str)
+
+class SnowflakeChunkStore:
+    """POLICY_DOCS_CHUNKS plus the POLICY_DOCS_MANIFEST table"""
+
+    def __init__(self, session_pool, chunks_table=CHUNKS_TABLE, manifest_table=MANIFEST_TABLE):
+        self.session_pool = session_pool
+        self.chunks_table = chunks_table
+        self.manifest_table = manifest_table
+
+    def _sql(self, query, params=None):
+        with self.session_pool.checkout() as session:
+            return session.sql(query, params=params).collect()
+
+    def ensure_tables(self):
+        self._sql(f"""
+        CREATE TABLE IF NOT EXISTS {self.chunks_table} (
+            RELATIVE_PATH VARCHAR(16777216),
+            SIZE NUMBER(38,0),
+            FILE_URL VARCHAR(16777216),
+            SCOPED_FILE_URL VARCHAR(16777216),
+            CHUNK VARCHAR(16777216),
+            CHUNK_INDEX INTEGER,
+            CATEGORY VARCHAR(16777216)
+        )
+        """)
+        self._sql(f"""
+        CREATE TABLE IF NOT EXISTS {self.manifest_table} (
+            RELATIVE_PATH STRING,
+            MD5 STRING,
+            SIZE NUMBER(38,0),
+            LAST_MODIFIED TIMESTAMP_TZ,
+            CATEGORY STRING,
+            CHUNK_COUNT INTEGER,
+            INGESTED_AT TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+        )
+        """)
+
+    def manifest(self):
+        rows = self._sql(f"SELECT RELATIVE_PATH, MD5 FROM {self.manifest_table}")
+        return {row['RELATIVE_PATH']: row['MD5'] for row in rows}
+
+    def adopt_existing(self, source_files):
+        """Record files that already have chunks (from a full rebuild) as ingested, without re-parsing"""
+        rows = self._sql(f"SELECT RELATIVE_PATH, COUNT(*) AS CHUNK_COUNT FROM {self.chunks_table} GROUP BY RELATIVE_PATH")
+        adopted = [row['RELATIVE_PATH'] for row in rows if row['RELATIVE_PATH'] in source_files]
+        counts = {row['RELATIVE_PATH']: row['CHUNK_COUNT'] for row in rows}
+        if adopted:
+            with self.session_pool.checkout() as session:
+                self._merge_manifest(session, [
+                    (path, source_files[path], category_for_path(path), counts[path]) for path in adopted
+                ])
+        return adopted
+
+    def write_batch(self, documents):
+        """Replace the chunks of every document in the batch in one transaction"""
+        paths = [document.path for document in documents]
+        rows = [
+            [document.path, chunk.get("size"), chunk.get("file_url"), chunk.get("scoped_file_url"),
+             chunk["chunk"], chunk["chunk_index"], document.category]
+            for document in documents
+            for chunk in document.chunks
+        ]
+        with self.session_pool.checkout() as session:
+            session.sql("BEGIN").collect()
+            try:
+                self._delete_chunks(session, paths)
+                row_placeholder = "(?, ?, ?, ?, ?, ?, ?)"
+                for start in range(0, len(rows), INSERT_ROWS_PER_STATEMENT):
+                    statement_rows = rows[start:start + INSERT_ROWS_PER_STATEMENT]
+                    session.sql(f"""
+                    INSERT INTO {self.chunks_table}
+                        (RELATIVE_PATH, SIZE, FILE_URL, SCOPED_FILE_URL, CHUNK, CHUNK_INDEX, CATEGORY)
+                    VALUES {', '.join([row_placeholder] * len(statement_rows))}
+                    """, params=[value for row in statement_rows for value in row]).collect()
+                self._merge_manifest(session, [
+                    (document.path, document.file_info, document.category, len(document.chunks))
+                    for document in documents
+                ])
+                session.sql("COMMIT").collect()
+            except Exception:
+                session.sql("ROLLBACK").collect()
+                raise
+
+    def remove(self, paths):
+        if not paths:
+            return
+        placeholders = ", ".join(["?"] * len(paths))
+        with self.session_pool.checkout() as session:
+            session.sql("BEGIN").collect()
+            try:
+                self._delete_chunks(session, paths)
+                session.sql(f"DELETE FROM {self.manifest_table} WHERE RELATIVE_PATH IN ({placeholders})",
+                            params=list(paths)).collect()
+                session.sql("COMMIT").collect()
+            except Exception:
+                session.sql("ROLLBACK").collect()
+                raise
+
+    def refresh_search_service(self, service_name):
+        """Make the search service pick up the changes now instead of at its TARGET_LAG"""
+        self._sql(f"ALTER CORTEX SEARCH SERVICE {service_name} REFRESH")
+
+    def close(self):
+        pass
+
+    def _delete_chunks(self, session, paths):
+        placeholders = ", ".join(["?"] * len(paths))
+        session.sql(f"DELETE FROM {self.chunks_table} WHERE RELATIVE_PATH IN ({placeholders})",
+                    params=list(paths)).collect()
+
+    def _merge_manifest(self, session, entries):
+        row_placeholder = "(?, ?, ?, ?, ?, ?)"
+        params = []
+        for path, file_info, category, chunk_count in entries:
+            params.extend([path, file_info["md5"], file_info["size"], str(file_info["last_modified"]),
+                           category, chunk_count])
+        session.sql(f"""
+        MERGE INTO {self.manifest_table} t
+        USING (
+            SELECT column1 AS RELATIVE_PATH, column2 AS MD5, column3 AS SIZE,
+                   column4::TIMESTAMP_TZ AS LAST_MODIFIED, column5 AS CATEGORY, column6 AS CHUNK_COUNT
+            FROM VALUES {', '.join([row_placeholder] * len(entries))}
+        ) s
+        ON t.RELATIVE_PATH = s.RELATIVE_PATH
+        WHEN MATCHED THEN UPDATE SET
+            MD5 = s.MD5, SIZE = s.SIZE, LAST_MODIFIED = s.LAST_MODIFIED,
+            CATEGORY = s.CATEGORY, CHUNK_COUNT = s.CHUNK_COUNT, INGESTED_AT = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT (RELATIVE_PATH, MD5, SIZE, LAST_MODIFIED, CATEGORY, CHUNK_COUNT)
+            VALUES (s.RELATIVE_PATH, s.MD5, s.SIZE, s.LAST_MODIFIED, s.CATEGORY, s.CHUNK_COUNT)
+        """, params=params).collect()
+
+### Runner
+
+class IngestReport:
+    """Outcome of a run: chunks per ingested file, error per failed file, throughput"""
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.ingested = {}
+        self.failed = {}
+        self.removed = []
+        self.elapsed_seconds = 0.0
+        self.source_bytes = 0
+
+    def summary(self):
+        chunks = sum(self.ingested.values())
+        rate = (f", {len(self.ingested) / self.elapsed_seconds:.1f} files/s, "
+                f"{chunks / self.elapsed_seconds:.0f} chunks/s, "
+                f"{self.source_bytes / self.elapsed_seconds / 1e6:.2f} MB/s") if self.elapsed_seconds else ""
+        return (f"{self.plan.summary()}; ingested {len(self.ingested)} files ({chunks} chunks), "
+                f"{len(self.failed)} failed, {len(self.removed)} removed in {self.elapsed_seconds:.1f}s{rate}")
+
+def load_document(source, path, file_info):
+    chunks = source.load(path)
+    if not chunks:
+        raise ValueError("no text extracted")
+    return IngestedDocument(path, file_info, chunks)
+
+def write_documents(store, documents, report):
+    """Write a batch; if the batch fails, retry file by file so one bad document can't sink the rest"""
+    try:
+        store.write_batch(documents)
+        for document in documents:
+            report.ingested[document.path] = len(document.chunks)
+        return
+    except Exception as e:
+        if len(documents) == 1:
+            report.failed[documents[0].path] = f"write failed: {e}"
+            logger.warning("Writing %s failed: %s", documents[0].path, e)
+            return
+        logger.warning("Batch of %d documents failed (%s); retrying one at a time", len(documents), e)
+    for document in documents:
+        write_documents(store, [document], report)
+
+def run_ingestion(source, store, plan, source_files, workers=INGEST_WORKERS, batch_rows=INGEST_BATCH_ROWS):
+    """Remove deleted files, then parse changed files on a worker pool and write them in batches"""
+    report = IngestReport(plan)
+    start = time.perf_counter()
+
+    if plan.removed:
+        store.remove(plan.removed)
+        report.removed = list(plan.removed)
+
+    batch = []
+    batch_rows_pending = 0
+    pending_paths = iter(plan.to_parse)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="policy-ingest") as pool:
+        in_flight = {}
+
+        def submit_next():
+            path = next(pending_paths, None)
+            if path is not None:
+                in_flight[pool.submit(load_document, source, path, source_files[path])] = path
+
+        # Keep at most two documents per worker parsed but unwritten, so memory stays bounded
+        for _ in range(workers * 2):
+            submit_next()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = in_flight.pop(future)
+                submit_next()
+                try:
+                    document = future.result()
+                except Exception as e:
+                    report.failed[path] = str(e)
+                    logger.warning("Parsing %s failed: %s", path, e)
+                    continue
+                report.source_bytes += source_files[path]["size"] or 0
+                batch.append(document)
+                batch_rows_pending += len(document.chunks)
+                if batch_rows_pending >= batch_rows:
+                    write_documents(store, batch, report)
+                    batch, batch_rows_pending = [], 0
+    if batch:
+        write_documents(store, batch, report)
+
+    store.close()
+    report.elapsed_seconds = time.perf_counter() - start
+    return report
+
+def sync(source, store, dry_run=False, adopt_existing=False, search_service=None,
+         workers=INGEST_WORKERS, batch_rows=INGEST_BATCH_ROWS):
+    """Bring the chunk store in line with the source; returns the IngestReport (or the plan for a dry run)"""
+    store.ensure_tables()
+    source.refresh()
+    source_files = source.list_files()
+    manifest = store.manifest()
+
+    if adopt_existing and not dry_run:
+        adopted = store.adopt_existing({path: info for path, info in source_files.items() if path not in manifest})
+        logger.info("Adopted %d files already present in the chunks table", len(adopted))
+        manifest = store.manifest()
+
+    plan = plan_ingestion(source_files, manifest)
+    logger.info("Ingestion plan: %s", plan.summary())
+    if dry_run:
+        return plan
+
+    report = run_ingestion(source, store, plan, source_files, workers, batch_rows)
+    if search_service and (report.removed or report.ingested):
+        store.refresh_search_service(search_service)
+    return report
+
+def create_session_pool(connection_name, size):
+    """Sessions from connections.toml, or the active session when running inside Snowflake"""
+    from snowflake.snowpark import Session
+    from snowflake.snowpark.context import get_active_session
+
+    if connection_name is None:
+        try:
+            active_session = get_active_session()
+            return SessionPool(lambda: active_session, size, SESSION_HEALTH_CHECK_IDLE_SECONDS,
+                               SESSION_CHECKOUT_TIMEOUT_SECONDS, owns_sessions=False)
+        except Exception:
+            return SessionPool(lambda: Session.builder.create(), size, SESSION_HEALTH_CHECK_IDLE_SECONDS,
+                               SESSION_CHECKOUT_TIMEOUT_SECONDS)
+    return SessionPool(
+        lambda: Session.builder.config("connection_name", connection_name).create(),
+        size,
+        SESSION_HEALTH_CHECK_IDLE_SECONDS,
+        SESSION_CHECKOUT_TIMEOUT_SECONDS
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally load policy documents into POLICY_DOCS_CHUNKS")
+    parser.add_argument("--connection", help="Connection name from connections.toml (default connection if omitted)")
+    parser.add_argument("--local-dir", help="Ingest this directory in pure Python instead of the Snowflake stage")
+    parser.add_argument("--output", default="policy_chunks.jsonl", help="Chunk file written in --local-dir mode")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    parser.add_argument("--batch-rows", type=int, default=INGEST_BATCH_ROWS)
+    parser.add_argument("--dry-run", action="store_true", help="Report new/changed/removed files without changing anything")
+    parser.add_argument("--adopt-existing", action="store_true",
+                        help="Treat files that already have chunks as ingested instead of re-parsing them")
+    parser.add_argument("--refresh-search-service", metavar="SERVICE",
+                        help="Refresh this Cortex Search service after changes (e.g. POLICY_SEARCH_SERVICE)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.local_dir:
+        if args.adopt_existing or args.refresh_search_service:
+            parser.error("--adopt-existing and --refresh-search-service only apply to the Snowflake stage")
+        source = LocalDirectorySource(args.local_dir)
+        store = LocalChunkStore(args.output)
+    else:
+        # One session per parse worker, plus one for the batch writer
+        session_pool = create_session_pool(args.connection, args.workers + 1)
+        source = SnowflakeStageSource(session_pool)
+        store = SnowflakeChunkStore(session_pool)
+
+    result = sync(source, store, dry_run=args.dry_run, adopt_existing=args.adopt_existing,
+                  search_service=args.refresh_search_service, workers=args.workers, batch_rows=args.batch_rows)
+    print(result.summary())
+    if not args.dry_run:
+        for path, error in sorted(result.failed.items()):
+            print(f"FAILED {path}: {error}")
+        return 1 if result.failed else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import numpy as np
+
+from policy_backend import tokenize
+from policy_chunk_store import ChunkStore
+
+### In-process hybrid retrieval
+#
+# The procurement corpus is small enough to keep in memory: LocalHybridIndex answers queries in
+# milliseconds from a ChunkStore (BM25 postings plus, when chunk embeddings are available, a
+# float32 embedding matrix, optionally memory-mapped); the two rankings are combined with
+# reciprocal rank fusion. Results have the same shape as Cortex Search results (the requested
+# columns plus "@scores"), so the app can use it in place of, or as a fallback for, the service.
+
+RRF_K = 60 # Reciprocal rank fusion constant; higher flattens the contribution of top ranks
+CANDIDATES_PER_RANKING = 5 # Each ranking contributes limit * this many candidates to the fusion
+
+class LocalHybridIndex:
+    """BM25 + embedding retrieval over a ChunkStore"""
+
+    def __init__(self, store, k1=1.2, b=0.75):
+        self.store = store
+        self.k1 = k1
+        avg_doc_length = float(np.mean(store.doc_lengths)) if len(store) else 0.0
+        self.length_norm = k1 * (1 - b + b * np.asarray(store.doc_lengths) / (avg_doc_length or 1.0))
+        self.category_codes = {category: code for code, category in enumerate(store.categories)}
+        self.embeddings = store.embeddings
+
+    @classmethod
+    def from_chunks(cls, chunks, embedding_model=None):
+        return cls(ChunkStore.from_chunks(chunks, embedding_model))
+
+    @property
+    def has_embeddings(self):
+        return self.embeddings is not None
+
+    def bm25_scores(self, query):
+        scores = np.zeros(len(self.store), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_postings = self.store.postings(term)
+            if term_postings is None:
+                continue
+            ids, freqs = term_postings
+            scores[ids] += self.store.idf(term_postings) * freqs * (self.k1 + 1) / (freqs + self.length_norm[ids])
+        return scores
+
+    def cosine_scores(self, query_embedding):
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        return self.embeddings @ (query / norm if norm else query)
+
+    def search(self, query, columns, filter=None, limit=10, query_embedding=None):
+        """Cortex-Search-shaped results; filter supports {"@eq": {"category": ...}}"""
+        if not len(self.store):
+            return []
+        allowed = None
+        if filter:
+            code = self.category_codes.get(filter["@eq"]["category"])
+            if code is None:
+                return []
+            allowed = np.asarray(self.store.category_ids) == code
+
+        text_scores = self.bm25_scores(query)
+        rankings = [top_indices(np.where(text_scores > 0, text_scores, -np.inf), allowed, limit * CANDIDATES_PER_RANKING)]
+        vector_scores = None
+        if self.embeddings is not None and query_embedding is not None:
+            vector_scores = self.cosine_scores(query_embedding)
+            rankings.append(top_indices(vector_scores, allowed, limit * CANDIDATES_PER_RANKING))
+
+        # Reciprocal rank fusion: robust to BM25 and cosine scores living on different scales
+        fused = {}
+        for ranking in rankings:
+            for rank, chunk_id in enumerate(ranking):
+                fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        best = sorted(fused, key=lambda chunk_id: (-fused[chunk_id], chunk_id))[:limit]
+
+        results = []
+        for chunk_id in best:
+            scores = {"text_match": float(text_scores[chunk_id])}
+            if vector_scores is not None:
+                scores["cosine_similarity"] = float(vector_scores[chunk_id])
+            results.append(dict(self.store.record(chunk_id, columns), **{"@scores": scores}))
+        return results
+
+def top_indices(scores, allowed, count):
+    """Indices of the highest finite scores (optionally masked), best first"""
+    if allowed is not None:
+        scores = np.where(allowed, scores, -np.inf)
+    candidates = np.flatnonzero(np.isfinite(scores))
+    if candidates.size > count:
+        candidates = candidates[np.argpartition(-scores[candidates], count - 1)[:count]]
+    return candidates[np.argsort(-scores[candidates], kind="stable")].tolist()
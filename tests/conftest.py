@@ -0,0 +1,10 @@
+import os
+import sys
+import logging
+
+# The app and its tools are top-level scripts, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Importing the Streamlit app outside `streamlit run` warns about the missing script run context
+for name in ("streamlit", "streamlit.runtime.caching.cache_data_api", "streamlit.runtime.scriptrunner_utils.script_run_context"):
+    logging.getLogger(name).setLevel(logging.ERROR)
@@ -0,0 +1,65 @@
+import DEV_POLICY_GPT_LATEST as app
+from policy_app_common import CHAT_HISTORY_MIGRATED_COLUMNS, CHAT_HISTORY_SCHEMA_VERSION, ChatHistorySchema
+from policy_backend import LocalBackend, SnowflakeBackend
+
+BASE_COLUMNS = ["INTERACTION_ID", "TIMESTAMP", "USER_QUESTION", "AI_RESPONSE", "MODEL_USED",
+                "CATEGORY_FILTER", "SOURCE_DOCUMENTS", "RESPONSE_TIME_MS"]
+
+class ScriptedSnowflakeBackend(SnowflakeBackend):
+    """SnowflakeBackend whose SQL is answered from a fixed table state instead of a session"""
+
+    def __init__(self, columns, comment=None, denied=()):
+        self.chat_history_table = "POC_POLICY.PROCUREMENT_POLICY.CHAT_HISTORY"
+        self.columns = columns
+        self.comment = comment
+        self.denied = denied
+        self.statements = []
+
+    def run_sql(self, query, params=None):
+        statement = query.split()[0].upper()
+        self.statements.append(statement)
+        if statement in self.denied:
+            raise RuntimeError(f"Insufficient privileges to operate on table 'CHAT_HISTORY' ({statement})")
+        if statement == "SELECT":
+            return [{"COLUMN_NAME": column, "COMMENT": self.comment} for column in self.columns]
+        return []
+
+def test_missing_privileges_do_not_block_the_migration():
+    backend = ScriptedSnowflakeBackend(BASE_COLUMNS + ["USER_NAME"], denied=("CREATE", "ALTER", "COMMENT"))
+    columns, added = backend.migrate_chat_history(CHAT_HISTORY_MIGRATED_COLUMNS, CHAT_HISTORY_SCHEMA_VERSION)
+    assert columns == set(BASE_COLUMNS + ["USER_NAME"])
+    assert added == []
+    # An incomplete schema is not marked as migrated
+    assert "COMMENT" not in backend.statements
+
+def test_existing_table_comment_is_kept():
+    backend = ScriptedSnowflakeBackend(BASE_COLUMNS + list(CHAT_HISTORY_MIGRATED_COLUMNS), comment="Procurement GPT chat log")
+    columns, added = backend.migrate_chat_history(CHAT_HISTORY_MIGRATED_COLUMNS, CHAT_HISTORY_SCHEMA_VERSION)
+    assert added == []
+    assert backend.statements == ["CREATE", "SELECT"]
+
+def test_version_marker_is_recorded_after_a_complete_upgrade():
+    backend = ScriptedSnowflakeBackend(BASE_COLUMNS, comment="schema_version=3")
+    columns, added = backend.migrate_chat_history(CHAT_HISTORY_MIGRATED_COLUMNS, CHAT_HISTORY_SCHEMA_VERSION)
+    assert added == list(CHAT_HISTORY_MIGRATED_COLUMNS)
+    assert columns == set(BASE_COLUMNS) | set(CHAT_HISTORY_MIGRATED_COLUMNS)
+    assert backend.statements == ["CREATE", "SELECT", "ALTER", "COMMENT"]
+
+def test_writer_only_inserts_columns_the_table_has():
+    inserted = []
+
+    class RecordingBackend(LocalBackend):
+        def insert_chat_history(self, columns, rows):
+            inserted.append(dict(zip(columns, rows[0])))
+
+    schema = ChatHistorySchema(CHAT_HISTORY_SCHEMA_VERSION, BASE_COLUMNS, [])
+    writer = app.ChatHistoryWriter(RecordingBackend([], sql_latency_seconds=0, jitter=0), schema, None,
+                                   app.StageLatencyStats(10), 100, 60, 1)
+    writer.submit({
+        "interaction_id": "q-1", "question": "Who approves?", "response": "Two approvers.",
+        "model_name": "llama3.1-70b", "category": "ALL", "source_docs": [], "response_time_ms": 900,
+        "user_name": "TEST_USER", "feedback": {"RESPONSE_QUALITY": "GOOD"}
+    })
+    writer.close()
+    assert set(inserted[0]) == set(BASE_COLUMNS) - {"TIMESTAMP"}
+    assert inserted[0]["INTERACTION_ID"] == "q-1"
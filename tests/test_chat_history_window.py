@@ -0,0 +1,16 @@
+import pytest
+
+import DEV_POLICY_GPT_LATEST as app
+
+def messages(count):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"} for i in range(count)]
+
+@pytest.mark.parametrize("slide_window, expected", [(7, 6), (2, 1), (1, 0), (0, 0)])
+def test_trim_chat_history_keeps_slide_window_minus_one(monkeypatch, slide_window, expected):
+    monkeypatch.setattr(app, "slide_window", slide_window)
+    history = messages(10)
+    assert app.trim_chat_history(history) == history[len(history) - expected:]
+
+def test_short_history_is_kept_whole(monkeypatch):
+    monkeypatch.setattr(app, "slide_window", 7)
+    assert app.trim_chat_history(messages(3)) == messages(3)
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import textwrap
+import threading
+import subprocess
+
+import DEV_POLICY_GPT_LATEST as app
+from policy_app_common import CHAT_HISTORY_MIGRATED_COLUMNS, CHAT_HISTORY_SCHEMA_VERSION, ChatHistorySchema
+from policy_backend import LocalBackend
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RecordingBackend(LocalBackend):
+    """LocalBackend that logs chat history writes in order and can hold inserts at a gate"""
+
+    def __init__(self, insert_gate=None):
+        super().__init__([], sql_latency_seconds=0, jitter=0)
+        self.calls = []
+        self.insert_started = threading.Event()
+        self.insert_gate = insert_gate
+
+    def insert_chat_history(self, columns, rows):
+        self.insert_started.set()
+        if self.insert_gate is not None:
+            assert self.insert_gate.wait(5)
+        super().insert_chat_history(columns, rows)
+        self.calls.append(("insert", [row[0] for row in rows]))
+
+    def merge_chat_feedback(self, columns, rows):
+        super().merge_chat_feedback(columns, rows)
+        self.calls.append(("merge", [interaction_id for interaction_id, _ in rows]))
+
+def make_writer(backend, batch_size=1, flush_interval_seconds=60):
+    columns, added = backend.migrate_chat_history(CHAT_HISTORY_MIGRATED_COLUMNS, CHAT_HISTORY_SCHEMA_VERSION)
+    schema = ChatHistorySchema(CHAT_HISTORY_SCHEMA_VERSION, columns, added)
+    return app.ChatHistoryWriter(backend, schema, url_cache=None, latency_stats=app.StageLatencyStats(10),
+                                 batch_size=batch_size, flush_interval_seconds=flush_interval_seconds,
+                                 max_attempts=1)
+
+def make_record(interaction_id):
+    # No source documents, so the writer never needs presigned URLs
+    return {
+        "interaction_id": interaction_id,
+        "question": "Who approves purchase orders?",
+        "response": "Two approvers above 10,000 USD.",
+        "model_name": "llama3.1-70b",
+        "category": "ALL",
+        "source_docs": [],
+        "response_time_ms": 1200,
+        "user_name": "TEST_USER"
+    }
+
+def test_feedback_for_queued_row_rides_on_the_insert():
+    backend = RecordingBackend()
+    writer = make_writer(backend, batch_size=100)
+    try:
+        writer.submit(make_record("q-1"))
+        writer.submit_feedback("q-1", {"RESPONSE_QUALITY": "GOOD"})
+        assert writer.flush(5)
+    finally:
+        writer.close()
+    assert backend.calls == [("insert", ["q-1"])]
+    assert backend.get_chat_feedback("q-1", ["RESPONSE_QUALITY"])["RESPONSE_QUALITY"] == "GOOD"
+
+def test_feedback_after_the_row_is_claimed_applies_after_its_insert():
+    gate = threading.Event()
+    backend = RecordingBackend(insert_gate=gate)
+    writer = make_writer(backend, batch_size=1)
+    try:
+        writer.submit(make_record("q-2"))
+        # The batch has claimed the row and is blocked inside the INSERT
+        assert backend.insert_started.wait(5)
+        writer.submit_feedback("q-2", {"IS_HALLUCINATION": "YES", "REVIEW_FEEDBACK": "Cites the wrong policy"})
+        gate.set()
+        assert writer.flush(5)
+    finally:
+        gate.set()
+        writer.close()
+    assert backend.calls == [("insert", ["q-2"]), ("merge", ["q-2"])]
+    feedback = backend.get_chat_feedback("q-2", ["IS_HALLUCINATION", "REVIEW_FEEDBACK"])
+    assert feedback == {"IS_HALLUCINATION": "YES", "REVIEW_FEEDBACK": "Cites the wrong policy"}
+
+def test_close_flushes_queued_rows():
+    backend = RecordingBackend()
+    writer = make_writer(backend, batch_size=100)
+    writer.submit(make_record("q-3"))
+    writer.submit(make_record("q-4"))
+    writer.close()
+    assert backend.calls == [("insert", ["q-3", "q-4"])]
+
+def test_rows_still_queued_at_interpreter_exit_are_written(tmp_path):
+    output = tmp_path / "rows.jsonl"
+    script = textwrap.dedent(f"""
+        import json
+
+        import tests.conftest
+        from policy_backend import LocalBackend
+        from tests.test_chat_history_writer import make_record, make_writer
+
+        class FileBackend(LocalBackend):
+            def __init__(self):
+                super().__init__([], sql_latency_seconds=0, jitter=0)
+
+            def insert_chat_history(self, columns, rows):
+                with open({str(output)!r}, "a", encoding="utf-8") as f:
+                    for row in rows:
+                        f.write(json.dumps(dict(zip(columns, row)), default=str) + "\\n")
+
+        writer = make_writer(FileBackend(), batch_size=100)
+        writer.submit(make_record("exit-1"))
+        writer.submit_feedback("exit-1", {{"RESPONSE_QUALITY": "GOOD"}})
+        # No flush() or close(): the atexit hook has to write the row
+    """)
+    subprocess.run([sys.executable, "-c", script], cwd=REPO_ROOT, check=True, timeout=60)
+    rows = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [row["INTERACTION_ID"] for row in rows] == ["exit-1"]
+    assert rows[0]["RESPONSE_QUALITY"] == "GOOD"
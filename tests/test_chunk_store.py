@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+import pytest
+
+import policy_chunk_store
+from policy_chunk_store import ARRAY_NAMES, META_FILE, ChunkStore, open_or_build, store_directory
+from policy_local_index import LocalHybridIndex
+
+COLUMNS = ["chunk", "chunk_index", "relative_path", "category"]
+
+def sample_chunks():
+    rng = np.random.default_rng(7)
+    texts = [
+        ("travel/policy.md", "TRAVEL", "Economy class is required for flights under six hours."),
+        ("travel/policy.md", "TRAVEL", "Hotel stays are reimbursed up to the city rate — café receipts too."),
+        ("purchasing/po.md", "PURCHASING", "Purchase orders above 10,000 USD need two approvals."),
+        ("purchasing/po.md", "PURCHASING", "Sole-source purchases require a written justification."),
+        ("general/faq.md", "", "Questions go to the procurement help desk.")
+    ]
+    chunks = []
+    for chunk_id, (path, category, text) in enumerate(texts):
+        chunks.append({
+            "chunk": text,
+            "chunk_index": chunk_id % 2,
+            "relative_path": path,
+            "category": category,
+            "embedding": (rng.normal(size=8) * (chunk_id + 1)).tolist()
+        })
+    return chunks
+
+def staging_dirs(root):
+    return [name for name in os.listdir(root) if name.endswith(".tmp")]
+
+def test_save_open_round_trip(tmp_path):
+    built = ChunkStore.from_chunks(sample_chunks(), "e5-base-v2")
+    directory = str(tmp_path / "store")
+    built.save(directory)
+    opened = ChunkStore.open(directory)
+
+    assert opened.meta == built.meta
+    assert opened.meta["embedding_model"] == "e5-base-v2"
+    assert opened.paths == built.paths
+    assert opened.categories == built.categories
+    assert opened.vocabulary == built.vocabulary
+
+    # Arrays come back memory-mapped, not copied into the process
+    assert isinstance(opened.texts, np.memmap)
+    assert isinstance(opened.embeddings, np.memmap)
+    for name in ARRAY_NAMES:
+        assert isinstance(getattr(opened, name), np.memmap)
+        np.testing.assert_array_equal(getattr(opened, name), getattr(built, name))
+
+    np.testing.assert_array_equal(opened.embeddings, built.embeddings)
+    np.testing.assert_allclose(np.linalg.norm(opened.embeddings, axis=1), 1.0, rtol=1e-6)
+
+    assert len(opened) == len(built) == 5
+    for chunk_id in range(len(built)):
+        assert opened.record(chunk_id, COLUMNS) == built.record(chunk_id, COLUMNS)
+    for term in built.vocabulary:
+        for opened_part, built_part in zip(opened.postings(term), built.postings(term)):
+            np.testing.assert_array_equal(opened_part, built_part)
+
+def test_store_without_embeddings_round_trips(tmp_path):
+    chunks = [dict(chunk, embedding=None) for chunk in sample_chunks()]
+    directory = str(tmp_path / "store")
+    ChunkStore.from_chunks(chunks, "e5-base-v2").save(directory)
+    opened = ChunkStore.open(directory)
+    assert opened.embeddings is None
+    assert opened.meta["embedding_model"] is None
+    assert not os.path.exists(os.path.join(directory, "embeddings.npy"))
+
+def test_memory_mapped_index_matches_in_memory(tmp_path):
+    chunks = sample_chunks()
+    built = ChunkStore.from_chunks(chunks, "e5-base-v2")
+    directory = str(tmp_path / "store")
+    built.save(directory)
+    query_embedding = chunks[2]["embedding"]
+    for index_filter in (None, {"@eq": {"category": "PURCHASING"}}):
+        expected = LocalHybridIndex(built).search("purchase approvals", COLUMNS, filter=index_filter,
+                                                  limit=3, query_embedding=query_embedding)
+        actual = LocalHybridIndex(ChunkStore.open(directory)).search("purchase approvals", COLUMNS, filter=index_filter,
+                                                                     limit=3, query_embedding=query_embedding)
+        assert actual == expected
+        assert expected
+
+def test_save_renames_staging_directory_into_place(tmp_path):
+    directory = str(tmp_path / "store")
+    ChunkStore.from_chunks(sample_chunks()).save(directory)
+    assert os.path.exists(os.path.join(directory, META_FILE))
+    assert staging_dirs(tmp_path) == []
+
+def test_save_keeps_store_another_process_wrote_first(tmp_path):
+    directory = str(tmp_path / "store")
+    first = sample_chunks()[:2]
+    ChunkStore.from_chunks(first).save(directory)
+    # The rename onto a populated directory fails; the existing store wins and nothing leaks
+    ChunkStore.from_chunks(sample_chunks()).save(directory)
+    assert len(ChunkStore.open(directory)) == len(first)
+    assert staging_dirs(tmp_path) == []
+
+def test_failed_save_removes_staging_and_raises(tmp_path, monkeypatch):
+    def fail_rename(source, destination):
+        raise OSError("disk full")
+    monkeypatch.setattr(policy_chunk_store.os, "rename", fail_rename)
+    directory = str(tmp_path / "store")
+    with pytest.raises(OSError):
+        ChunkStore.from_chunks(sample_chunks()).save(directory)
+    assert not os.path.exists(directory)
+    assert staging_dirs(tmp_path) == []
+
+def test_open_or_build_builds_once_per_version_and_prunes_old(tmp_path):
+    root = str(tmp_path)
+    loads = []
+    def load_chunks():
+        loads.append(1)
+        return sample_chunks()
+
+    first = open_or_build(root, "5-abc", "e5-base-v2", load_chunks)
+    again = open_or_build(root, "5-abc", "e5-base-v2", load_chunks)
+    assert len(loads) == 1
+    assert len(first) == len(again) == 5
+
+    newer = open_or_build(root, "4-def", "e5-base-v2", lambda: sample_chunks()[:4])
+    assert len(newer) == 4
+    assert sorted(os.listdir(root)) == [os.path.basename(store_directory(root, "4-def", "e5-base-v2"))]
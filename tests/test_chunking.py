@@ -0,0 +1,81 @@
+import DEV_POLICY_GPT_LATEST as app
+from policy_ingest import CHUNK_OVERLAP, CHUNK_SIZE, split_text_recursive
+
+def numbered_words(count):
+    # Every word is unique, so the only way two chunks can share text is the splitter's overlap
+    return " ".join(f"word{i}" for i in range(count))
+
+def shared_text(first, second):
+    """Length of the longest suffix of first that is also a prefix of second"""
+    for size in range(min(len(first), len(second)), 0, -1):
+        if first.endswith(second[:size]):
+            return size
+    return 0
+
+def test_chunks_respect_size_limit():
+    text = "\n\n".join(numbered_words(400) for _ in range(5)) + "\n" + "x" * (CHUNK_SIZE * 3)
+    chunks = split_text_recursive(text)
+    assert len(chunks) > 1
+    assert all(0 < len(chunk) <= CHUNK_SIZE for chunk in chunks)
+
+def test_unbroken_text_is_split_by_characters():
+    chunks = split_text_recursive("y" * (CHUNK_SIZE * 2 + 10))
+    assert all(len(chunk) <= CHUNK_SIZE for chunk in chunks)
+    assert len(chunks) >= 3
+
+def test_consecutive_chunks_overlap_within_limit():
+    chunks = split_text_recursive(numbered_words(2000))
+    assert len(chunks) > 2
+    for first, second in zip(chunks, chunks[1:]):
+        overlap = shared_text(first, second)
+        assert 0 < overlap <= CHUNK_OVERLAP
+
+def test_small_limits_are_honoured():
+    chunks = split_text_recursive(numbered_words(200), chunk_size=100, overlap=20)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    for first, second in zip(chunks, chunks[1:]):
+        assert shared_text(first, second) <= 20
+
+def join(first, second):
+    return app.join_overlapping(first, second, app.CHUNK_OVERLAP_CHARS + 16, app.CHUNK_OVERLAP_CHARS // 4)
+
+def test_join_overlapping_drops_repeated_text():
+    repeated = numbered_words(20)
+    assert join("Intro text. " + repeated, repeated + " closing text.") == "Intro text. " + repeated + " closing text."
+    assert join("alpha", "beta") == "alpha\nbeta"
+
+def test_join_overlapping_ignores_one_character_match():
+    assert join("must be approved", "don't split orders") == "must be approved\ndon't split orders"
+
+def test_join_overlapping_ignores_mid_word_match():
+    assert join("Section 4 ends here", "e-tendering applies") == "Section 4 ends here\ne-tendering applies"
+    # Long enough, but starts inside a word of the first chunk
+    tail = numbered_words(20)
+    assert join("prefix" + tail, "fix" + tail + " more") == "prefix" + tail + "\nfix" + tail + " more"
+
+def test_neighbour_merge_reproduces_original_text():
+    text = numbered_words(1500)
+    chunks = split_text_recursive(text)
+    hits = [
+        {"chunk": chunk, "chunk_index": index, "relative_path": "policy.txt", "category": "GENERAL",
+         "@scores": {"text_match": 1.0 / (index + 1)}}
+        for index, chunk in enumerate(chunks)
+    ]
+    # Search order is by relevance, not by position in the document
+    passages = app.merge_neighbor_chunks(list(reversed(hits)))
+    assert len(passages) == 1
+    assert passages[0]["chunk"] == text
+    assert passages[0]["chunk_index"] == 0
+    assert passages[0]["@scores"] == {"text_match": 1.0}
+
+def test_neighbour_merge_keeps_gaps_and_documents_apart():
+    chunks = split_text_recursive(numbered_words(1500))
+    hits = [
+        {"chunk": chunks[0], "chunk_index": 0, "relative_path": "a.txt"},
+        {"chunk": chunks[2], "chunk_index": 2, "relative_path": "a.txt"},
+        {"chunk": chunks[1], "chunk_index": 1, "relative_path": "b.txt"},
+        {"chunk": chunks[3], "chunk_index": 3, "relative_path": "a.txt"}
+    ]
+    passages = app.merge_neighbor_chunks(hits)
+    assert [(p["relative_path"], p["chunk_index"]) for p in passages] == [("a.txt", 0), ("a.txt", 2), ("b.txt", 1)]
+    assert passages[1]["chunk"] == join(chunks[2], chunks[3])
@@ -0,0 +1,43 @@
+import pytest
+
+import DEV_POLICY_GPT_LATEST as app
+import policy_backend
+from policy_backend import LocalBackend
+
+CHUNKS = [
+    {"chunk": "Purchase orders above 10,000 USD need two approvals.", "chunk_index": 0,
+     "relative_path": "PURCHASING-po.md", "category": "PURCHASING"},
+    {"chunk": "Economy class is required for flights under six hours.", "chunk_index": 0,
+     "relative_path": "TRAVEL-travel.md", "category": "TRAVEL"}
+]
+
+class RewriteDownBackend(LocalBackend):
+    """Search works, every LLM completion fails"""
+
+    def complete(self, model, prompt, options=None):
+        raise RuntimeError("Cortex Complete is unavailable")
+
+@pytest.fixture
+def rewrite_down(monkeypatch):
+    monkeypatch.setattr(policy_backend, "_default_backend",
+                        RewriteDownBackend(CHUNKS, search_latency_seconds=0, sql_latency_seconds=0, jitter=0))
+    monkeypatch.setattr(app, "RERANK_MODEL", None)
+    app.get_retrieval_cache.clear()
+    app.invalidate_corpus_cache()
+    yield
+    app.get_retrieval_cache.clear()
+    app.invalidate_corpus_cache()
+
+@pytest.mark.parametrize("mode", ["parallel", "sequential"])
+def test_failed_rewrite_falls_back_to_the_raw_question(rewrite_down, monkeypatch, mode):
+    monkeypatch.setattr(app, "QUERY_REWRITE_MODE", mode)
+    settings = {
+        "model_name": "llama3.1-70b",
+        "category": "ALL",
+        "use_chat_history": True,
+        "chat_history": [{"role": "user", "content": "Tell me about purchasing"},
+                         {"role": "assistant", "content": "Purchasing rules cover orders and approvals."}]
+    }
+    _, relative_paths, included, _ = app.create_prompt("Do those purchase orders need approvals?", settings)
+    assert "PURCHASING-po.md" in relative_paths
+    assert included
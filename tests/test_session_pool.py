@@ -0,0 +1,90 @@
+import time
+import threading
+
+import pytest
+
+from policy_backend import SessionPool
+
+class FakeSession:
+    def __init__(self, number):
+        self.number = number
+        self.closed = False
+
+    def sql(self, query, params=None):
+        return self
+
+    def collect(self):
+        return [[1]]
+
+    def close(self):
+        self.closed = True
+
+class SessionLost(Exception):
+    errno = 390111 # Session no longer exists
+
+def make_pool(size=1, checkout_timeout_seconds=5):
+    created = []
+    def factory():
+        created.append(FakeSession(len(created)))
+        return created[-1]
+    return SessionPool(factory, size, health_check_idle_seconds=120,
+                       checkout_timeout_seconds=checkout_timeout_seconds), created
+
+def test_statement_error_returns_session_to_pool():
+    pool, created = make_pool()
+    with pytest.raises(ValueError):
+        with pool.checkout():
+            raise ValueError("Object 'GPT_DOCUMENT_LINKS' does not exist")
+    with pool.checkout() as pooled_session:
+        assert pooled_session is created[0]
+    assert len(created) == 1
+    assert not created[0].closed
+
+def test_session_error_discards_and_replaces_session():
+    pool, created = make_pool()
+    with pytest.raises(SessionLost):
+        with pool.checkout():
+            raise SessionLost("Session no longer exists")
+    assert created[0].closed
+    with pool.checkout() as pooled_session:
+        assert pooled_session is created[1]
+
+def test_discard_wakes_a_waiting_checkout():
+    pool, created = make_pool(checkout_timeout_seconds=5)
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold_then_fail():
+        with pytest.raises(SessionLost):
+            with pool.checkout():
+                holding.set()
+                release.wait(5)
+                raise SessionLost("Session no longer exists")
+
+    holder = threading.Thread(target=hold_then_fail)
+    holder.start()
+    assert holding.wait(5)
+    threading.Timer(0.1, release.set).start()
+    start = time.monotonic()
+    with pool.checkout() as pooled_session:
+        waited = time.monotonic() - start
+    holder.join(5)
+    assert pooled_session is created[1]
+    assert waited < 2
+
+def test_checkout_times_out_when_pool_is_exhausted():
+    pool, _ = make_pool(checkout_timeout_seconds=0.2)
+    with pool.checkout():
+        with pytest.raises(TimeoutError):
+            with pool.checkout():
+                pass
+
+def test_shared_session_is_not_bounded():
+    shared = FakeSession(0)
+    pool = SessionPool(lambda: shared, 1, 120, 0.1, owns_sessions=False)
+    with pool.checkout() as first, pool.checkout() as second:
+        assert first is second is shared
+    with pytest.raises(SessionLost):
+        with pool.checkout():
+            raise SessionLost("Session no longer exists")
+    assert not shared.closed